@@ -1,17 +1,41 @@
+import time
+IMPORT_STARTED = time.perf_counter()
+
 import telebot
 from telebot import types
 import os
-import requests
 import re
-import time
 import threading
-from deep_translator import GoogleTranslator
-from flask import Flask, request
+import queue
+import csv
+import gzip
+import io
+import tempfile
+import json
+import zlib
+import functools
+import html
+import random
+import contextvars
+from collections import OrderedDict, Counter
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeout, as_completed
+from urllib.parse import quote
+from flask import Flask, request, jsonify
 import sqlite3
 import logging
 
-# Настраиваем логирование
-logging.basicConfig(level=logging.INFO)
+import logs
+import db
+import metrics
+from metrics import span, traced
+from db import (
+    get_connection, release_connection, close_pool, init_db, normalize_title,
+    add_item, add_items_bulk, find_item_id, iter_items, claim_stale_items, update_items_metadata, get_items_page, search_items,
+    get_item_by_id, update_item, delete_item, update_items, delete_items, get_stats, create_state_store
+)
+
+# Логирование через очередь (logs.setup_logging) включают точки входа - bootstrap() и
+# create_app(): импорт модуля не запускает поток-слушатель
 logger = logging.getLogger(__name__)
 
 # ========== HTTP СЕРВЕР ДЛЯ RENDER ==========
@@ -21,33 +45,235 @@ app = Flask(__name__)
 TOKEN = os.getenv('TELEGRAM_TOKEN')
 OMDB_API_KEY = os.getenv('OMDB_API_KEY', "7717512b")
 KINOPOISK_API_KEY = os.getenv('KINOPOISK_API_KEY', "ZS97X1F-7M144TE-Q24BJS9-BAWFJDE")
-DATABASE_URL = os.getenv('DATABASE_URL')
 
 # Автоматически генерируем WEBHOOK_URL для Render
 RENDER_EXTERNAL_URL = os.getenv('RENDER_EXTERNAL_URL')
-if RENDER_EXTERNAL_URL:
-    WEBHOOK_URL = f"{RENDER_EXTERNAL_URL}/webhook"
-    logger.info(f"🌐 WEBHOOK_URL сгенерирован: {WEBHOOK_URL}")
-else:
-    WEBHOOK_URL = None
-    logger.warning("⚠️ RENDER_EXTERNAL_URL не установлен, вебхук не настроен")
+WEBHOOK_URL = f"{RENDER_EXTERNAL_URL}/webhook" if RENDER_EXTERNAL_URL else None
+
+# Режим приема вебхуков: queue - ставим в очередь и сразу отвечаем, inline - обрабатываем в запросе
+WEBHOOK_MODE = os.getenv('WEBHOOK_MODE', 'queue')
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', 4))
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', 200))
+WEBHOOK_ENQUEUE_TIMEOUT = float(os.getenv('WEBHOOK_ENQUEUE_TIMEOUT', 1))
+
+# Параллельный поиск по внешним провайдерам
+LOOKUP_WORKERS = int(os.getenv('LOOKUP_WORKERS', 8))
+LOOKUP_DEADLINE = float(os.getenv('LOOKUP_DEADLINE', 8))
+
+# Кэш ответов внешних провайдеров (секунды)
+LOOKUP_CACHE_SIZE = int(os.getenv('LOOKUP_CACHE_SIZE', 1000))
+LOOKUP_CACHE_TTL = int(os.getenv('LOOKUP_CACHE_TTL', 7 * 24 * 3600))
+LOOKUP_CACHE_NEGATIVE_TTL = int(os.getenv('LOOKUP_CACHE_NEGATIVE_TTL', 6 * 3600))
+
+# Кэш готовых карточек, страниц списков и результатов поиска. Записи этого процесса
+# сбрасывают его сразу, записи других воркеров - через версию чата в таблице chat_versions,
+# которую кэш перечитывает не чаще раза в RENDER_VERSION_CHECK секунд на чат.
+# RENDER_CACHE_TTL - предельный возраст записи кэша, даже если версия не менялась
+RENDER_CACHE_SIZE = int(os.getenv('RENDER_CACHE_SIZE', 5000))
+RENDER_CACHE_TTL = float(os.getenv('RENDER_CACHE_TTL', 30))
+RENDER_VERSION_CHECK = float(os.getenv('RENDER_VERSION_CHECK', 2))
+
+# Общий HTTP клиент для внешних провайдеров
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 10))
+HTTP_RETRIES = int(os.getenv('HTTP_RETRIES', 2))
+HTTP_BACKOFF = float(os.getenv('HTTP_BACKOFF', 0.3))
+KINOPOISK_TIMEOUT = float(os.getenv('KINOPOISK_TIMEOUT', 10))
+KINOPOISK_CONCURRENCY = int(os.getenv('KINOPOISK_CONCURRENCY', 4))
+OMDB_TIMEOUT = float(os.getenv('OMDB_TIMEOUT', 5))
+OMDB_CONCURRENCY = int(os.getenv('OMDB_CONCURRENCY', 4))
+
+# Перевод русских названий для OMDB
+TRANSLATE_URL = os.getenv('TRANSLATE_URL', 'https://translate.google.com/m')
+TRANSLATE_TIMEOUT = float(os.getenv('TRANSLATE_TIMEOUT', 5))
+TRANSLATE_CONCURRENCY = int(os.getenv('TRANSLATE_CONCURRENCY', 2))
+TRANSLATE_CACHE_SIZE = int(os.getenv('TRANSLATE_CACHE_SIZE', 2000))
+TRANSLATE_CACHE_TTL = int(os.getenv('TRANSLATE_CACHE_TTL', 30 * 24 * 3600))
+TRANSLATE_GRACE = float(os.getenv('TRANSLATE_GRACE', 1.5))
+
+# Хранилище состояний диалогов: memory, database или sqlite:///путь/к/файлу.db
+STATE_STORE = os.getenv('STATE_STORE', 'database')
+STATE_TTL = int(os.getenv('STATE_TTL', 3600))
+
+# Фоновое обновление рейтингов
+REFRESH_ENABLED = os.getenv('REFRESH_ENABLED', '1') == '1'
+REFRESH_INTERVAL = float(os.getenv('REFRESH_INTERVAL', 600))
+REFRESH_BATCH_SIZE = int(os.getenv('REFRESH_BATCH_SIZE', 10))
+REFRESH_MAX_AGE = int(os.getenv('REFRESH_MAX_AGE', 30 * 24 * 3600))
+REFRESH_MISSING_AGE = int(os.getenv('REFRESH_MISSING_AGE', 24 * 3600))
+# Сколько запросов к Кинопоиску и OMDB в сутки фоновое обновление может потратить из квоты (на процесс)
+REFRESH_DAILY_QUOTA = int(os.getenv('REFRESH_DAILY_QUOTA', 400))
+# Через сколько секунд запись, взятую упавшим воркером, можно взять снова
+REFRESH_CLAIM_TTL = int(os.getenv('REFRESH_CLAIM_TTL', 3600))
+REFRESH_LOOKUP_WORKERS = int(os.getenv('REFRESH_LOOKUP_WORKERS', 4))
+# Если у провайдера столько запросов в работе, пользователи ищут сами - обновление ждет
+REFRESH_BUSY_IN_FLIGHT = int(os.getenv('REFRESH_BUSY_IN_FLIGHT', 1))
+
+# Пакетный импорт списков из файла
+IMPORT_MAX_TITLES = int(os.getenv('IMPORT_MAX_TITLES', 5000))
+IMPORT_MAX_FILE_SIZE = int(os.getenv('IMPORT_MAX_FILE_SIZE', 2 * 1024 * 1024))
+# Импорт ищет в своих пулах, общих для всех импортов: поиск пользователей не ждет за тысячами названий
+IMPORT_CONCURRENCY = int(os.getenv('IMPORT_CONCURRENCY', 4))
+# До трех запросов к провайдерам на название, чтобы поиски импорта не ждали друг друга до дедлайна
+IMPORT_LOOKUP_WORKERS = int(os.getenv('IMPORT_LOOKUP_WORKERS', IMPORT_CONCURRENCY * 3))
+IMPORT_PROGRESS_INTERVAL = float(os.getenv('IMPORT_PROGRESS_INTERVAL', 3))
+
+# Сколько одновременных соединений Telegram может открыть к вебхуку
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', 40))
+
+# Без токена модуль импортируется (для проверок и инструментов), но бот не запустится:
+# токен проверяется в require_token() при старте сервера
+class TracedTeleBot(telebot.TeleBot):
+    """TeleBot, замеряющий время запросов к Telegram API"""
+
+    @traced('telegram.send_message')
+    def send_message(self, *args, **kwargs):
+        return super().send_message(*args, **kwargs)
+
+    @traced('telegram.edit_message_text')
+    def edit_message_text(self, *args, **kwargs):
+        return super().edit_message_text(*args, **kwargs)
+
+    @traced('telegram.edit_message_reply_markup')
+    def edit_message_reply_markup(self, *args, **kwargs):
+        return super().edit_message_reply_markup(*args, **kwargs)
+
+    @traced('telegram.answer_callback_query')
+    def answer_callback_query(self, *args, **kwargs):
+        return super().answer_callback_query(*args, **kwargs)
+
+    @traced('telegram.send_document')
+    def send_document(self, *args, **kwargs):
+        return super().send_document(*args, **kwargs)
+
+# threaded=False: хэндлеры выполняются в потоке, который обрабатывает update (воркер
+# очереди), - так сохраняется порядок обновлений чата и трассировка видит все участки
+bot = TracedTeleBot(TOKEN or '0:TELEGRAM_TOKEN_NOT_SET', threaded=False)
+
+# ========== ОЧЕРЕДЬ ОБНОВЛЕНИЙ ==========
+class QueueFull(Exception):
+    """Очередь обновлений переполнена"""
+
+def update_chat_id(update):
+    """Определяет чат, к которому относится update"""
+    if update.message:
+        return update.message.chat.id
+    if update.edited_message:
+        return update.edited_message.chat.id
+    if update.callback_query:
+        if update.callback_query.message:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+    return update.update_id
+
+class UpdateDispatcher:
+    """Пул воркеров, обрабатывающих обновления в фоне.
+
+    Каждый чат закреплен за одним воркером, поэтому обновления одного чата
+    обрабатываются строго по порядку, а разные чаты - параллельно.
+    """
+
+    def __init__(self, handler, workers=4, queue_size=200):
+        self.handler = handler
+        self.workers = workers
+        shard_size = max(1, queue_size // workers)
+        self._queues = [queue.Queue(maxsize=shard_size) for _ in range(workers)]
+        self._threads = []
+        self._lock = threading.Lock()
+        self.enqueued = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.max_depth = 0
+        self._closing = False
+
+    def start(self):
+        with self._lock:
+            if self._threads or self._closing:
+                return
+            for i, q in enumerate(self._queues):
+                t = threading.Thread(target=self._worker, args=(q,), name=f"update-worker-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+            logger.info(f"🧵 Запущено воркеров обработки обновлений: {self.workers}")
+
+    def submit(self, update, timeout=1.0):
+        """Ставит update в очередь его чата, при переполнении бросает QueueFull"""
+        if self._closing:
+            raise QueueFull()
+        self.start()
+        q = self._queues[hash(update_chat_id(update)) % self.workers]
+        try:
+            q.put(update, timeout=timeout)
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            raise QueueFull()
+        with self._lock:
+            self.enqueued += 1
+            self.max_depth = max(self.max_depth, self.depth())
+
+    def _worker(self, q):
+        while True:
+            update = q.get()
+            try:
+                self.handler([update])
+                with self._lock:
+                    self.processed += 1
+            except Exception as e:
+                with self._lock:
+                    self.failed += 1
+                logger.error(f"❌ Ошибка обработки update {update.update_id}: {e}")
+            finally:
+                q.task_done()
+
+    def depth(self):
+        return sum(q.qsize() for q in self._queues)
+
+    def shutdown(self, timeout=30.0):
+        """Перестает принимать обновления и дожидается обработки уже принятых"""
+        self._closing = True
+        deadline = time.monotonic() + timeout
+        while any(q.unfinished_tasks for q in self._queues):
+            if time.monotonic() >= deadline:
+                logger.warning(f"⚠️ Не дождались обработки {self.depth()} обновлений при остановке")
+                return False
+            time.sleep(0.1)
+        logger.info("✅ Очередь обновлений обработана, воркеры остановлены")
+        return True
 
-# Глобальная переменная для SQLite соединения
-sqlite_conn = None
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'depth': self.depth(),
+            'shard_depths': [q.qsize() for q in self._queues],
+            'capacity': sum(q.maxsize for q in self._queues),
+            'max_depth': self.max_depth,
+            'enqueued': self.enqueued,
+            'processed': self.processed,
+            'failed': self.failed,
+            'rejected': self.rejected,
+        }
+
+def process_updates(updates):
+    """Обрабатывает обновления, замеряя каждый участок"""
+    with metrics.trace('update'):
+        bot.process_new_updates(updates)
 
-# Проверка токена
-if not TOKEN:
-    logger.error("❌❌❌ ВНИМАНИЕ: TELEGRAM_TOKEN не установлен!")
-    logger.error("❌❌❌ Установите переменную окружения TELEGRAM_TOKEN на Render")
-    exit(1)
+# Порядок обновлений чата держится на том, что хэндлеры выполняются в воркере очереди.
+# У TeleBot с threaded=True они уходили бы в его собственный пул потоков
+if bot.threaded:
+    raise RuntimeError("Очередь обновлений требует TeleBot(threaded=False)")
 
-bot = telebot.TeleBot(TOKEN)
-logger.info(f"🤖 Бот инициализирован с токеном: {TOKEN[:10]}...")
+dispatcher = UpdateDispatcher(
+    process_updates,
+    workers=WEBHOOK_WORKERS,
+    queue_size=WEBHOOK_QUEUE_SIZE
+)
 
 # ========== ВЕБХУК РУТЫ ==========
 @app.route('/')
 def home():
-    logger.info("📄 Главная страница запрошена")
+    logger.debug("📄 Главная страница запрошена")
     return """
     <!DOCTYPE html>
     <html>
@@ -73,8 +299,46 @@ def home():
 
 @app.route('/health')
 def health_check():
-    logger.info("🏥 Health check запрошен")
-    return "OK", 200
+    logger.debug("🏥 Health check запрошен")
+    if db.degraded():
+        # Без трафика автомат сам не закроется: проверка здоровья служит пробным подключением
+        release_connection(get_connection())
+    health = db.database_health()
+    status = 'ok' if health['state'] == db.CircuitBreaker.CLOSED else 'degraded'
+    # 200 и в деградации: перезапуск сервиса не вернет базу данных
+    return jsonify({'status': status, 'database': health}), 200
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Гистограммы участков и счетчики в формате Prometheus"""
+    gauges = metrics.stat_gauges('kinobot_db_pool', db.pool_stats())
+    gauges += metrics.stat_gauges('kinobot_sqlite', db.sqlite_stats())
+    gauges += metrics.stat_gauges('kinobot_db', dict(db.database_health(), degraded=int(db.degraded())))
+    gauges += metrics.stat_gauges('kinobot_webhook_queue', dispatcher.stats())
+    gauges += metrics.stat_gauges('kinobot_lookup_cache', lookup_cache.stats())
+    gauges += metrics.stat_gauges('kinobot_render_cache', render_cache.stats())
+    gauges += metrics.stat_gauges('kinobot_translator', translator.stats())
+    gauges += metrics.stat_gauges('kinobot_refresher', refresher.stats())
+    gauges += metrics.stat_gauges('kinobot_logging', logs.logging_stats())
+    for provider, provider_stats in http_client.stats().items():
+        gauges += metrics.stat_gauges('kinobot_http', provider_stats, provider=provider)
+    return metrics.render_prometheus(gauges), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+@app.route('/stats')
+def stats():
+    return jsonify({
+        'db_pool': db.pool_stats(),
+        'sqlite': db.sqlite_stats(),
+        'database': db.database_health(),
+        'webhook_queue': dispatcher.stats(),
+        'lookup_cache': lookup_cache.stats(),
+        'render_cache': render_cache.stats(),
+        'http': http_client.stats(),
+        'translator': translator.stats(),
+        'refresher': refresher.stats(),
+        'logging': logs.logging_stats(),
+        'startup': {'import_seconds': round(STARTUP_SECONDS, 4)}
+    })
 
 @app.route('/ping')
 def ping():
@@ -87,14 +351,14 @@ def set_webhook():
         return "❌ WEBHOOK_URL не установлен", 500
     
     try:
-        logger.info(f"🔄 Устанавливаю вебхук на {WEBHOOK_URL}")
+        logger.info("🔄 Устанавливаю вебхук на %s", WEBHOOK_URL)
         bot.remove_webhook()
         time.sleep(0.5)
         
         # Устанавливаем вебхук
         success = bot.set_webhook(url=WEBHOOK_URL)
         if success:
-            logger.info(f"✅ Вебхук установлен: {WEBHOOK_URL}")
+            logger.info("✅ Вебхук установлен: %s", WEBHOOK_URL)
             return f"✅ Вебхук установлен: {WEBHOOK_URL}", 200
         else:
             logger.error("❌ Не удалось установить вебхук")
@@ -121,7 +385,8 @@ def check_webhook():
 
 @app.route('/webhook', methods=['POST'])
 def webhook():
-    logger.info(f"📨 Получен вебхук в {time.strftime('%H:%M:%S')}")
+    # Вебхук приходит на каждое действие пользователя - в лог попадает только выборка
+    logger.info("📨 Получен вебхук", extra=logs.SAMPLED)
     
     if request.headers.get('content-type') != 'application/json':
         logger.error(f"❌ Неверный content-type: {request.headers.get('content-type')}")
@@ -129,21 +394,32 @@ def webhook():
     
     try:
         json_string = request.get_data().decode('utf-8')
-        logger.info(f"📝 Длина данных: {len(json_string)} символов")
+        logger.debug("📝 Длина данных: %s символов", len(json_string))
         
         update = types.Update.de_json(json_string)
         
         # Логируем что получили
         if update.message:
-            logger.info(f"📩 Сообщение от {update.message.chat.id}: '{update.message.text}'")
+            logger.debug("📩 Сообщение от %s: '%s'", update.message.chat.id, update.message.text)
         elif update.callback_query:
-            logger.info(f"🔘 Callback от {update.callback_query.from_user.id}: {update.callback_query.data}")
+            logger.debug("🔘 Callback от %s: %s", update.callback_query.from_user.id, update.callback_query.data)
         else:
-            logger.info(f"📦 Update другого типа: {update}")
+            logger.debug("📦 Update другого типа: %s", update.update_id)
         
-        # Обрабатываем update
-        bot.process_new_updates([update])
-        logger.info(f"✅ Вебхук обработан успешно")
+        if WEBHOOK_MODE == 'inline':
+            # Обрабатываем update прямо в запросе
+            process_updates([update])
+            logger.debug("✅ Вебхук обработан успешно")
+            return ''
+        
+        # Ставим update в очередь и сразу отвечаем Telegram
+        try:
+            dispatcher.submit(update, timeout=WEBHOOK_ENQUEUE_TIMEOUT)
+        except QueueFull:
+            # Telegram повторит доставку позже
+            logger.warning(f"⚠️ Очередь обновлений переполнена ({dispatcher.depth()}), update {update.update_id} отклонен")
+            return 'Busy', 503
+        logger.debug("✅ Вебхук поставлен в очередь (глубина: %s)", dispatcher.depth())
         
         return ''
         
@@ -153,456 +429,500 @@ def webhook():
         traceback.print_exc()
         return 'Error', 500
 
-# ========== БАЗА ДАННЫХ ==========
-def get_connection():
-    """Создает подключение к БД"""
-    global sqlite_conn
-    
-    # Всегда используем PostgreSQL/Supabase
-    if not DATABASE_URL or DATABASE_URL == '':
-        logger.warning("⚠️ DATABASE_URL не установлен, используем SQLite in-memory")
-        
-        # Используем одно соединение для SQLite
-        if sqlite_conn is None:
-            sqlite_conn = sqlite3.connect(':memory:', check_same_thread=False)
-            logger.info("✅ Создано новое SQLite соединение")
-        
-        return sqlite_conn
-    
-    logger.info(f"🔗 Подключаемся к PostgreSQL...")
-    
-    try:
-        import psycopg2
-        from urllib.parse import urlparse
-        
-        result = urlparse(DATABASE_URL)
-        
-        conn_params = {
-            'host': result.hostname,
-            'port': result.port,
-            'database': result.path[1:],
-            'user': result.username,
-            'password': result.password,
-            'sslmode': 'require'
-        }
-        
-        conn = psycopg2.connect(**conn_params)
-        logger.info("✅ Успешное подключение к PostgreSQL")
-        return conn
-        
-    except Exception as e:
-        logger.error(f"❌ Ошибка подключения к PostgreSQL: {e}")
-        # В режиме разработки используем SQLite в памяти
-        logger.warning("⚠️ Используем in-memory SQLite")
-        
-        if sqlite_conn is None:
-            sqlite_conn = sqlite3.connect(':memory:', check_same_thread=False)
-            logger.info("✅ Создано новое SQLite соединение")
-        
-        return sqlite_conn
-
-def init_db():
-    """Создает таблицы"""
-    logger.info("🔄 Инициализация базы данных...")
-    conn = get_connection()
-    if not conn:
-        logger.error("❌ Не удалось подключиться к БД")
-        return False
-    
-    cur = conn.cursor()
-    
-    try:
-        is_sqlite = isinstance(conn, sqlite3.Connection)
-        
-        if is_sqlite:
-            # SQLite версия с полем жанра
-            cur.execute('''
-                CREATE TABLE IF NOT EXISTS items (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    type VARCHAR(20) NOT NULL,
-                    title VARCHAR(255) NOT NULL,
-                    original_title VARCHAR(255),
-                    year VARCHAR(10),
-                    genre VARCHAR(255),
-                    kp_rating REAL,
-                    imdb_rating REAL,
-                    kp_url TEXT,
-                    imdb_url TEXT,
-                    watched INTEGER DEFAULT 0,
-                    comment TEXT,
-                    added_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            logger.info("✅ Таблица items создана (SQLite)")
-        else:
-            # PostgreSQL версия с полем жанра
-            cur.execute('''
-                CREATE TABLE IF NOT EXISTS items (
-                    id SERIAL PRIMARY KEY,
-                    type VARCHAR(20) NOT NULL,
-                    title VARCHAR(255) NOT NULL,
-                    original_title VARCHAR(255),
-                    year VARCHAR(10),
-                    genre VARCHAR(255),
-                    kp_rating REAL,
-                    imdb_rating REAL,
-                    kp_url TEXT,
-                    imdb_url TEXT,
-                    watched INTEGER DEFAULT 0,
-                    comment TEXT,
-                    added_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            logger.info("✅ Таблица items создана (PostgreSQL)")
-        
-        conn.commit()
-        logger.info("✅ База данных инициализирована")
-        return True
-    except Exception as e:
-        logger.error(f"❌ Ошибка БД: {e}")
-        import traceback
-        traceback.print_exc()
+# ========== СОСТОЯНИЯ ДИАЛОГОВ ==========
+state_store = create_state_store(STATE_STORE, STATE_TTL)
+
+def chat_state(message):
+    """Название текущего шага диалога; читается из хранилища один раз на сообщение"""
+    if not hasattr(message, '_chat_state'):
+        state = state_store.get(message.chat.id)
+        message._chat_state = state.get('state') if state else None
+    return message._chat_state
+
+# ========== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ==========
+DEGRADED_TEXT = ("⚠️ *База данных временно недоступна.*\n\n"
+                 "Списки и поиск вернутся, как только она восстановится. "
+                 "Новые фильмы и изменения не пропадут: они будут записаны позже.")
+DEGRADED_ALERT = "⚠️ База данных временно недоступна"
+QUEUED_ALERT = "⏳ Сохранится, когда база данных станет доступна"
+
+def reply_degraded(chat_id):
+    """Сообщает, что база недоступна, если это так. True - ответ уже отправлен"""
+    if not db.degraded():
         return False
-    finally:
-        # НЕ закрываем соединение для SQLite!
-        if not isinstance(conn, sqlite3.Connection):
-            conn.close()
+    bot.send_message(chat_id, DEGRADED_TEXT, parse_mode='Markdown', reply_markup=main_keyboard())
+    return True
 
-def add_item(item_type, title, original_title, year, genre=None, kp_rating=None, imdb_rating=None, kp_url=None, imdb_url=None):
-    """Добавляет фильм/сериал"""
-    logger.info(f"➕ Добавление: {title} (тип: {item_type}, год: {year}, жанр: {genre})")
-    
-    conn = get_connection()
-    if not conn:
-        logger.error("❌ Нет подключения к БД")
-        return None
-    
-    cur = conn.cursor()
-    try:
-        is_sqlite = isinstance(conn, sqlite3.Connection)
-        
-        if is_sqlite:
-            cur.execute('''
-                INSERT INTO items (type, title, original_title, year, genre, kp_rating, imdb_rating, kp_url, imdb_url) 
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (item_type, title, original_title, year, genre, kp_rating, imdb_rating, kp_url, imdb_url))
-            
-            conn.commit()
-            cur.execute('SELECT last_insert_rowid()')
-            result = cur.fetchone()
-        else:
-            cur.execute('''
-                INSERT INTO items (type, title, original_title, year, genre, kp_rating, imdb_rating, kp_url, imdb_url) 
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                RETURNING id
-            ''', (item_type, title, original_title, year, genre, kp_rating, imdb_rating, kp_url, imdb_url))
-            
-            conn.commit()
-            result = cur.fetchone()
-        
-        if result:
-            item_id = result[0]
-            logger.info(f"✅ Успешно добавлено с ID: {item_id}")
-            return item_id
-        else:
-            logger.warning("⚠️ Элемент не добавлен")
+def is_russian_text(text):
+    return bool(re.search('[а-яА-Я]', text))
+
+def has_english_title(film):
+    """Есть ли у найденного фильма оригинальное (не русское) название"""
+    original_title = film.get('original_title') if film else None
+    return bool(original_title) and not is_russian_text(original_title)
+
+# ========== ПЕРЕВОД НАЗВАНИЙ ==========
+class TitleTranslator:
+    """Переводчик названий через мобильную страницу Google Translate с кэшем переводов.
+
+    Запросы идут через общий http_client (провайдер 'translate'): те же keep-alive,
+    повторы, лимит одновременных запросов и метрики, что у остальных провайдеров.
+    """
+
+    # Перевод на мобильной странице: <div class="result-container">...</div> (в старой верстке class="t0")
+    RESULT_RE = re.compile(r'<div class="(?:result-container|t0)">(.*?)</div>', re.S)
+
+    def __init__(self, source='ru', target='en', max_size=2000, ttl=30 * 24 * 3600):
+        self.source = source
+        self.target = target
+        self.max_size = max_size
+        self.ttl = ttl
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def _request(self, text):
+        response = http_client.get('translate', TRANSLATE_URL, params={'sl': self.source, 'tl': self.target, 'q': text})
+        response.raise_for_status()
+        match = self.RESULT_RE.search(response.text)
+        if not match:
+            raise ValueError('перевод не найден в ответе')
+        return html.unescape(match.group(1)).strip()
+
+    def _cached(self, text):
+        with self._lock:
+            entry = self._cache.get(text)
+            if entry and entry[1] > time.time():
+                self._cache.move_to_end(text)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
             return None
+
+    def _remember(self, text, translated):
+        with self._lock:
+            self._cache[text] = (translated, time.time() + self.ttl)
+            self._cache.move_to_end(text)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+
+    def translate(self, text):
+        """Переводит одно название; при ошибке возвращает исходный текст"""
+        translated = self._cached(text)
+        if translated is not None:
+            return translated
+        try:
+            with span('provider.translate'):
+                translated = self._request(text)
+        except Exception as e:
+            with self._lock:
+                self.errors += 1
+            logger.warning(f"⚠️ Не удалось перевести '{text}': {e}")
+            return text
+        if not translated:
+            return text
+        self._remember(text, translated)
+        return translated
+
+    def translate_batch(self, texts):
+        """Переводит список названий, сохраняя порядок; повторы переводятся один раз"""
+        translated = {text: self.translate(text) for text in dict.fromkeys(texts)}
+        return [translated[text] for text in texts]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._cache),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'errors': self.errors,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+translator = TitleTranslator(max_size=TRANSLATE_CACHE_SIZE, ttl=TRANSLATE_CACHE_TTL)
+
+def translate_russian_to_english(text):
+    return translator.translate(text)
+
+# ========== HTTP КЛИЕНТ ==========
+# Счетчик запросов текущей задачи по провайдерам; metrics.submit переносит его в потоки поиска
+http_meter = contextvars.ContextVar('kinobot_http_meter', default=None)
+
+class HttpClient:
+    """Общая HTTP сессия с keep-alive, повторами и лимитами по провайдерам"""
+
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, providers, pool_size=10, retries=2, backoff=0.3):
+        self.providers = providers
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff = backoff
+        self._session = None
+        self._session_lock = threading.Lock()
+        self._limits = {name: threading.BoundedSemaphore(cfg['concurrency']) for name, cfg in providers.items()}
+        self._latency = {name: metrics.histogram('kinobot_http_request_seconds', provider=name) for name in providers}
+        self._counters = {name: {'requests': 0, 'retries': 0, 'errors': 0, 'in_flight': 0} for name in providers}
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    # requests.Session создаем только при первом запросе к провайдеру
+                    import requests
+                    from requests.adapters import HTTPAdapter
+                    session = requests.Session()
+                    # Отдельный пул keep-alive соединений на каждый хост
+                    adapter = HTTPAdapter(pool_connections=len(self.providers) or 1, pool_maxsize=self.pool_size, max_retries=0)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    self._session = session
+        return self._session
+
+    def _count(self, provider, name, delta=1):
+        with self._lock:
+            self._counters[provider][name] += delta
+
+    def _retry_delay(self, response, attempt):
+        retry_after = response.headers.get('Retry-After')
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), self.backoff * 10)
+        # Полный джиттер: случайная пауза до экспоненциальной границы
+        return random.uniform(0, self.backoff * (2 ** attempt))
+
+    def get(self, provider, url, **kwargs):
+        """GET-запрос к провайдеру; повторяет только при 429 и 5xx"""
+        cfg = self.providers[provider]
+        kwargs.setdefault('timeout', cfg['timeout'])
+        
+        for attempt in range(self.retries + 1):
+            # Слот провайдера держим только на время запроса: пауза перед повтором его не занимает
+            with self._limits[provider]:
+                self._count(provider, 'in_flight')
+                self._count(provider, 'requests')
+                meter = http_meter.get()
+                if meter is not None:
+                    with self._lock:
+                        meter[provider] += 1
+                start = time.monotonic()
+                try:
+                    response = self.session.get(url, **kwargs)
+                except Exception:
+                    self._count(provider, 'errors')
+                    raise
+                finally:
+                    self._latency[provider].observe(time.monotonic() - start)
+                    self._count(provider, 'in_flight', -1)
             
-    except Exception as e:
-        logger.error(f"❌ Ошибка при добавлении в БД: {e}")
-        import traceback
-        traceback.print_exc()
-        return None
-    finally:
-        # Закрываем только для PostgreSQL
-        if not isinstance(conn, sqlite3.Connection):
-            conn.close()
-
-def get_items(item_type):
-    """Получает все фильмы/сериалы"""
-    conn = get_connection()
-    if not conn:
-        logger.error("❌ Нет подключения к БД")
-        return []
-    
-    cur = conn.cursor()
-    try:
-        is_sqlite = isinstance(conn, sqlite3.Connection)
+            if response.status_code in self.RETRY_STATUSES and attempt < self.retries:
+                self._count(provider, 'retries')
+                delay = self._retry_delay(response, attempt)
+                logger.warning(f"🔁 {provider} ответил {response.status_code}, повтор через {delay:.2f} с")
+                response.close()
+                time.sleep(delay)
+                continue
+            return response
+
+    def in_flight(self, provider):
+        with self._lock:
+            return self._counters[provider]['in_flight']
+
+    def stats(self):
+        with self._lock:
+            counters = {name: dict(values) for name, values in self._counters.items()}
+        return {
+            name: dict(counters[name], latency=self._latency[name].snapshot())
+            for name in self.providers
+        }
+
+http_client = HttpClient(
+    {
+        'kinopoisk': {'timeout': KINOPOISK_TIMEOUT, 'concurrency': KINOPOISK_CONCURRENCY},
+        'omdb': {'timeout': OMDB_TIMEOUT, 'concurrency': OMDB_CONCURRENCY},
+        'translate': {'timeout': TRANSLATE_TIMEOUT, 'concurrency': TRANSLATE_CONCURRENCY},
+    },
+    pool_size=HTTP_POOL_SIZE,
+    retries=HTTP_RETRIES,
+    backoff=HTTP_BACKOFF
+)
+
+# ========== КЭШ ПОИСКА ==========
+class LookupCache:
+    """Двухуровневый кэш ответов провайдеров: LRU в памяти + таблица в БД"""
+
+    def __init__(self, max_size=1000, ttl=7 * 24 * 3600, negative_ttl=6 * 3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    def _remember(self, provider, key, value, expires_at):
+        with self._lock:
+            self._memory[(provider, key)] = (value, expires_at)
+            self._memory.move_to_end((provider, key))
+            while len(self._memory) > self.max_size:
+                self._memory.popitem(last=False)
+
+    def get(self, provider, key):
+        """Возвращает (найдено в кэше, значение)"""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get((provider, key))
+            if entry and entry[1] > now:
+                self._memory.move_to_end((provider, key))
+                self.memory_hits += 1
+                return True, entry[0]
         
-        if is_sqlite:
-            cur.execute('''
-                SELECT id, title, original_title, year, genre, kp_rating, imdb_rating, kp_url, imdb_url, watched, comment 
-                FROM items WHERE type = ? ORDER BY title
-            ''', (item_type,))
-        else:
-            cur.execute('''
-                SELECT id, title, original_title, year, genre, kp_rating, imdb_rating, kp_url, imdb_url, watched, comment 
-                FROM items WHERE type = %s ORDER BY title
-            ''', (item_type,))
+        entry = self._load(provider, key)
+        if entry and entry[1] > now:
+            self._remember(provider, key, entry[0], entry[1])
+            with self._lock:
+                self.db_hits += 1
+            return True, entry[0]
         
-        return cur.fetchall()
-    except Exception as e:
-        logger.error(f"❌ Ошибка при получении данных: {e}")
-        return []
-    finally:
-        # Закрываем только для PostgreSQL
-        if not isinstance(conn, sqlite3.Connection):
-            conn.close()
-
-def search_items(search_term, search_type=None, limit=50):
-    """Ищет фильмы/сериалы по названию"""
-    conn = get_connection()
-    if not conn:
-        logger.error("❌ Нет подключения к БД")
-        return []
-    
-    cur = conn.cursor()
-    try:
-        is_sqlite = isinstance(conn, sqlite3.Connection)
-        search_term = f"%{search_term.lower()}%"
+        with self._lock:
+            self.misses += 1
+        return False, None
+
+    def set(self, provider, key, value):
+        expires_at = time.time() + (self.ttl if value is not None else self.negative_ttl)
+        self._remember(provider, key, value, expires_at)
+        self._store(provider, key, value, expires_at)
+        with self._lock:
+            self.stores += 1
+
+    @traced('db.lookup_cache_load')
+    def _load(self, provider, key):
+        conn = get_connection()
+        if not conn:
+            return None
         
-        if search_type:
-            # Поиск в конкретном типе
-            if is_sqlite:
-                query = '''
-                    SELECT id, title, original_title, year, genre, kp_rating, imdb_rating, kp_url, imdb_url, watched, comment 
-                    FROM items 
-                    WHERE type = ? AND (LOWER(title) LIKE ? OR LOWER(original_title) LIKE ?)
-                    ORDER BY title
-                    LIMIT ?
-                '''
-                cur.execute(query, (search_type, search_term, search_term, limit))
-            else:
-                query = '''
-                    SELECT id, title, original_title, year, genre, kp_rating, imdb_rating, kp_url, imdb_url, watched, comment 
-                    FROM items 
-                    WHERE type = %s AND (LOWER(title) LIKE %s OR LOWER(original_title) LIKE %s)
-                    ORDER BY title
-                    LIMIT %s
-                '''
-                cur.execute(query, (search_type, search_term, search_term, limit))
-        else:
-            # Поиск по всем типам
-            if is_sqlite:
-                query = '''
-                    SELECT id, title, original_title, year, genre, kp_rating, imdb_rating, kp_url, imdb_url, watched, comment 
-                    FROM items 
-                    WHERE LOWER(title) LIKE ? OR LOWER(original_title) LIKE ?
-                    ORDER BY type, title
-                    LIMIT ?
-                '''
-                cur.execute(query, (search_term, search_term, limit))
+        cur = conn.cursor()
+        try:
+            if isinstance(conn, sqlite3.Connection):
+                cur.execute("SELECT payload, expires_at FROM lookup_cache WHERE provider = ? AND cache_key = ?", (provider, key))
             else:
-                query = '''
-                    SELECT id, title, original_title, year, genre, kp_rating, imdb_rating, kp_url, imdb_url, watched, comment 
-                    FROM items 
-                    WHERE LOWER(title) LIKE %s OR LOWER(original_title) LIKE %s
-                    ORDER BY type, title
-                    LIMIT %s
-                '''
-                cur.execute(query, (search_term, search_term, limit))
-        
-        results = cur.fetchall()
-        logger.info(f"🔍 Найдено результатов: {len(results)}")
-        return results
-        
-    except Exception as e:
-        logger.error(f"❌ Ошибка при поиске: {e}")
-        import traceback
-        traceback.print_exc()
-        return []
-    finally:
-        # Закрываем только для PostgreSQL
-        if not isinstance(conn, sqlite3.Connection):
-            conn.close()
-
-def get_item_by_id(item_id):
-    """Получает по ID"""
-    conn = get_connection()
-    if not conn:
-        logger.error("❌ Нет подключения к БД")
-        return None
-    
-    cur = conn.cursor()
-    try:
-        is_sqlite = isinstance(conn, sqlite3.Connection)
-        
-        if is_sqlite:
-            cur.execute('''
-                SELECT id, type, title, original_title, year, genre, kp_rating, imdb_rating, kp_url, imdb_url, watched, comment 
-                FROM items WHERE id = ?
-            ''', (item_id,))
-        else:
-            cur.execute('''
-                SELECT id, type, title, original_title, year, genre, kp_rating, imdb_rating, kp_url, imdb_url, watched, comment 
-                FROM items WHERE id = %s
-            ''', (item_id,))
-        return cur.fetchone()
-    except Exception as e:
-        logger.error(f"❌ Ошибка при получении элемента: {e}")
-        return None
-    finally:
-        # Закрываем только для PostgreSQL
-        if not isinstance(conn, sqlite3.Connection):
-            conn.close()
-
-def update_item(item_id, **kwargs):
-    """Обновляет данные"""
-    conn = get_connection()
-    if not conn or not kwargs:
-        return False
-    
-    cur = conn.cursor()
-    try:
-        is_sqlite = isinstance(conn, sqlite3.Connection)
-        
-        if is_sqlite:
-            set_clause = ", ".join([f"{key} = ?" for key in kwargs.keys()])
-            values = list(kwargs.values())
-            values.append(item_id)
-            
-            cur.execute(f"UPDATE items SET {set_clause} WHERE id = ?", values)
-        else:
-            set_clause = ", ".join([f"{key} = %s" for key in kwargs.keys()])
-            values = list(kwargs.values())
-            values.append(item_id)
-            
-            cur.execute(f"UPDATE items SET {set_clause} WHERE id = %s", values)
-        
-        conn.commit()
-        return cur.rowcount > 0
-    except Exception as e:
-        logger.error(f"❌ Ошибка при обновлении: {e}")
-        return False
-    finally:
-        # Закрываем только для PostgreSQL
-        if not isinstance(conn, sqlite3.Connection):
-            conn.close()
-
-def delete_item(item_id):
-    """Удаляет запись"""
-    conn = get_connection()
-    if not conn:
-        logger.error("❌ Нет подключения к БД")
-        return False
-    
-    cur = conn.cursor()
-    try:
-        is_sqlite = isinstance(conn, sqlite3.Connection)
-        
-        if is_sqlite:
-            cur.execute("DELETE FROM items WHERE id = ?", (item_id,))
-        else:
-            cur.execute("DELETE FROM items WHERE id = %s", (item_id,))
+                cur.execute("SELECT payload, expires_at FROM lookup_cache WHERE provider = %s AND cache_key = %s", (provider, key))
+            row = cur.fetchone()
+            if row:
+                return json.loads(row[0]) if row[0] else None, row[1]
+            return None
+        except Exception as e:
+            logger.error(f"❌ Ошибка чтения кэша поиска: {e}")
+            return None
+        finally:
+            release_connection(conn)
+
+    @traced('db.lookup_cache_store')
+    def _store(self, provider, key, value, expires_at):
+        conn = get_connection()
+        if not conn:
+            return
         
-        conn.commit()
-        return cur.rowcount > 0
-    except Exception as e:
-        logger.error(f"❌ Ошибка при удалении: {e}")
-        return False
-    finally:
-        # Закрываем только для PostgreSQL
-        if not isinstance(conn, sqlite3.Connection):
-            conn.close()
+        cur = conn.cursor()
+        try:
+            payload = json.dumps(value, ensure_ascii=False) if value is not None else None
+            if isinstance(conn, sqlite3.Connection):
+                cur.execute('''
+                    INSERT INTO lookup_cache (provider, cache_key, payload, expires_at) VALUES (?, ?, ?, ?)
+                    ON CONFLICT (provider, cache_key) DO UPDATE SET payload = excluded.payload, expires_at = excluded.expires_at
+                ''', (provider, key, payload, expires_at))
+            else:
+                cur.execute('''
+                    INSERT INTO lookup_cache (provider, cache_key, payload, expires_at) VALUES (%s, %s, %s, %s)
+                    ON CONFLICT (provider, cache_key) DO UPDATE SET payload = excluded.payload, expires_at = excluded.expires_at
+                ''', (provider, key, payload, expires_at))
+            conn.commit()
+        except Exception as e:
+            logger.error(f"❌ Ошибка записи кэша поиска: {e}")
+        finally:
+            release_connection(conn)
 
-# ========== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ==========
-def is_russian_text(text):
-    return bool(re.search('[а-яА-Я]', text))
+    def stats(self):
+        with self._lock:
+            lookups = self.memory_hits + self.db_hits + self.misses
+            return {
+                'size': len(self._memory),
+                'max_size': self.max_size,
+                'memory_hits': self.memory_hits,
+                'db_hits': self.db_hits,
+                'misses': self.misses,
+                'stores': self.stores,
+                'hit_rate': round((self.memory_hits + self.db_hits) / lookups, 3) if lookups else 0.0,
+            }
 
-def translate_russian_to_english(text):
-    try:
-        translator = GoogleTranslator(source='ru', target='en')
-        return translator.translate(text)
-    except:
-        return text
+lookup_cache = LookupCache(
+    max_size=LOOKUP_CACHE_SIZE,
+    ttl=LOOKUP_CACHE_TTL,
+    negative_ttl=LOOKUP_CACHE_NEGATIVE_TTL
+)
+
+def cached_lookup(provider):
+    """Кэширует ответы провайдера по нормализованному названию.
+
+    Функция провайдера возвращает None, если ничего не найдено (кэшируется
+    с коротким TTL), и бросает исключение при сетевой ошибке (не кэшируется).
+    С fresh=True кэш не читается, а свежий ответ перезаписывает старый.
+    """
+    def decorator(fetch):
+        @functools.wraps(fetch)
+        def wrapper(title, fresh=False):
+            key = normalize_title(title)[:255]
+            hit, value = (False, None) if fresh else lookup_cache.get(provider, key)
+            if hit:
+                # Отдаем копию, чтобы вызывающий код не испортил кэш
+                return dict(value) if value else value
+            try:
+                value = fetch(title)
+            except Exception as e:
+                logger.error(f"❌ Ошибка поиска ({provider}): {e}")
+                return None
+            lookup_cache.set(provider, key, value)
+            return value
+        return wrapper
+    return decorator
 
+@cached_lookup('kinopoisk')
+@traced('provider.kinopoisk')
 def search_kinopoisk(title):
     if not KINOPOISK_API_KEY:
         return None
     
     headers = {'X-API-KEY': KINOPOISK_API_KEY}
-    url = f"https://api.kinopoisk.dev/v1.4/movie/search?page=1&limit=3&query={requests.utils.quote(title)}"
+    url = f"https://api.kinopoisk.dev/v1.4/movie/search?page=1&limit=3&query={quote(title)}"
     
+    response = http_client.get('kinopoisk', url, headers=headers)
+    response.raise_for_status()
+    data = response.json()
+    if data.get('docs') and data['docs']:
+        film = data['docs'][0]
+        
+        # Получаем жанры
+        genres = []
+        for genre in film.get('genres', []):
+            if genre.get('name'):
+                genres.append(genre['name'])
+        genre_str = ', '.join(genres[:3]) if genres else None
+        
+        return {
+            'title': film.get('name', 'Неизвестно'),
+            'original_title': film.get('alternativeName', film.get('name', 'Неизвестно')),
+            'year': film.get('year', 'Неизвестно'),
+            'genre': genre_str,
+            'kp_rating': round(film.get('rating', {}).get('kp', 0), 1) if film.get('rating', {}).get('kp') else None,
+            'imdb_rating': round(film.get('rating', {}).get('imdb', 0), 1) if film.get('rating', {}).get('imdb') else None,
+            'type': film.get('type', 'movie'),
+            'kp_url': f"https://www.kinopoisk.ru/film/{film.get('id', '')}" if film.get('id') else None
+        }
+    return None
+
+@cached_lookup('omdb')
+@traced('provider.omdb')
+def search_omdb_title(search_title):
+    """Один запрос к OMDB по точному названию"""
+    url = f"http://www.omdbapi.com/?t={quote(search_title)}&apikey={OMDB_API_KEY}"
+    response = http_client.get('omdb', url)
+    response.raise_for_status()
+    data = response.json()
+    if data.get('Response') == 'True':
+        imdb_rating = None
+        for rating_item in data.get('Ratings', []):
+            if rating_item['Source'] == 'Internet Movie Database':
+                try:
+                    imdb_rating = float(rating_item['Value'].split('/')[0])
+                    break
+                except:
+                    pass
+        
+        # Получаем жанр из OMDB
+        genre_str = data.get('Genre', None)
+        if genre_str and ',' in genre_str:
+            genre_str = genre_str.split(',')[0]  # Берем первый жанр
+        
+        return {
+            'title': data.get('Title', search_title),
+            'original_title': data.get('Title', search_title),
+            'year': data.get('Year', 'Неизвестно'),
+            'genre': genre_str,
+            'imdb_rating': round(imdb_rating, 1) if imdb_rating else None,
+            'kp_rating': None,
+            'type': 'movie' if data.get('Type') == 'movie' else 'series',
+            'imdb_url': f"https://www.imdb.com/title/{data.get('imdbID', '')}" if data.get('imdbID') else None
+        }
+    
+    # "Movie not found!" - честный промах, остальные ошибки (лимит, ключ) не кэшируем
+    error = data.get('Error', '')
+    if 'not found' not in error.lower():
+        raise RuntimeError(error or 'пустой ответ OMDB')
+    return None
+
+# ========== ПАРАЛЛЕЛЬНЫЙ ПОИСК ==========
+lookup_executor = ThreadPoolExecutor(max_workers=LOOKUP_WORKERS, thread_name_prefix='lookup')
+import_lookup_executor = ThreadPoolExecutor(max_workers=IMPORT_LOOKUP_WORKERS, thread_name_prefix='import-lookup')
+refresh_executor = ThreadPoolExecutor(max_workers=REFRESH_LOOKUP_WORKERS, thread_name_prefix='refresh-lookup')
+# Худший случай одного search_film без повторов: Кинопоиск и до трех вариантов названия на OMDB
+LOOKUP_MAX_REQUESTS = 4
+
+def wait_lookup(future, deadline, provider):
+    """Ждет ответ провайдера не дольше общего дедлайна поиска"""
     try:
-        response = requests.get(url, headers=headers, timeout=10)
-        if response.status_code == 200:
-            data = response.json()
-            if data.get('docs') and data['docs']:
-                film = data['docs'][0]
-                
-                # Получаем жанры
-                genres = []
-                for genre in film.get('genres', []):
-                    if genre.get('name'):
-                        genres.append(genre['name'])
-                genre_str = ', '.join(genres[:3]) if genres else None
-                
-                return {
-                    'title': film.get('name', 'Неизвестно'),
-                    'original_title': film.get('alternativeName', film.get('name', 'Неизвестно')),
-                    'year': film.get('year', 'Неизвестно'),
-                    'genre': genre_str,
-                    'kp_rating': round(film.get('rating', {}).get('kp', 0), 1) if film.get('rating', {}).get('kp') else None,
-                    'imdb_rating': round(film.get('rating', {}).get('imdb', 0), 1) if film.get('rating', {}).get('imdb') else None,
-                    'type': film.get('type', 'movie'),
-                    'kp_url': f"https://www.kinopoisk.ru/film/{film.get('id', '')}" if film.get('id') else None
-                }
+        return future.result(timeout=max(0, deadline - time.monotonic()))
+    except FuturesTimeout:
+        future.cancel()
+        logger.warning(f"⏱ {provider} не ответил до дедлайна, продолжаем без него")
     except Exception as e:
-        logger.error(f"❌ Ошибка поиска на Кинопоиске: {e}")
+        logger.error(f"❌ Ошибка поиска ({provider}): {e}")
     return None
 
-def search_omdb(title):
-    if not OMDB_API_KEY:
+def search_omdb_translated(title, kp_future, fresh=False):
+    """Ищет на OMDB по машинному переводу, если Кинопоиск не дал оригинального названия"""
+    try:
+        kp_result = kp_future.result(timeout=TRANSLATE_GRACE)
+    except Exception:
+        kp_result = None
+    if has_english_title(kp_result):
+        # Переводить незачем: OMDB поищем по названию с Кинопоиска
         return None
-    
-    search_titles = [translate_russian_to_english(title), title] if is_russian_text(title) else [title]
-    
-    for search_title in search_titles:
-        url = f"http://www.omdbapi.com/?t={requests.utils.quote(search_title)}&apikey={OMDB_API_KEY}"
-        try:
-            response = requests.get(url, timeout=5)
-            data = response.json()
-            if data.get('Response') == 'True':
-                imdb_rating = None
-                for rating_item in data.get('Ratings', []):
-                    if rating_item['Source'] == 'Internet Movie Database':
-                        try:
-                            imdb_rating = float(rating_item['Value'].split('/')[0])
-                            break
-                        except:
-                            pass
-                
-                # Получаем жанр из OMDB
-                genre_str = data.get('Genre', None)
-                if genre_str and ',' in genre_str:
-                    genre_str = genre_str.split(',')[0]  # Берем первый жанр
-                
-                return {
-                    'title': data.get('Title', search_title),
-                    'original_title': data.get('Title', search_title),
-                    'year': data.get('Year', 'Неизвестно'),
-                    'genre': genre_str,
-                    'imdb_rating': round(imdb_rating, 1) if imdb_rating else None,
-                    'kp_rating': None,
-                    'type': 'movie' if data.get('Type') == 'movie' else 'series',
-                    'imdb_url': f"https://www.imdb.com/title/{data.get('imdbID', '')}" if data.get('imdbID') else None
-                }
-        except Exception as e:
-            logger.error(f"❌ Ошибка поиска на OMDB: {e}")
-            continue
-    return None
+    return search_omdb_title(translate_russian_to_english(title), fresh=fresh)
 
-def search_film(title, item_type=None):
+def search_film(title, item_type=None, fresh=False, executor=lookup_executor):
     results = {}
+    deadline = time.monotonic() + LOOKUP_DEADLINE
+    russian = is_russian_text(title)
+    
+    # Запускаем всех провайдеров сразу, а не по очереди
+    kp_future = metrics.submit(executor, search_kinopoisk, title, fresh=fresh)
+    omdb_futures = []
+    if OMDB_API_KEY:
+        if russian:
+            omdb_futures.append(metrics.submit(executor, search_omdb_translated, title, kp_future, fresh=fresh))
+        omdb_futures.append(metrics.submit(executor, search_omdb_title, title, fresh=fresh))
     
-    kp_result = search_kinopoisk(title)
+    kp_result = wait_lookup(kp_future, deadline, 'Кинопоиск')
     if kp_result:
         results.update(kp_result)
-        eng_title = kp_result.get('original_title') if is_russian_text(title) else title
-    else:
-        eng_title = title
+        if russian and OMDB_API_KEY and has_english_title(kp_result):
+            # Оригинальное название с Кинопоиска точнее машинного перевода
+            omdb_futures.insert(0, metrics.submit(executor, search_omdb_title, kp_result['original_title'], fresh=fresh))
+    
+    omdb_result = None
+    for future in omdb_futures:
+        if omdb_result:
+            future.cancel()
+            continue
+        omdb_result = wait_lookup(future, deadline, 'OMDB')
     
-    omdb_result = search_omdb(eng_title)
     if omdb_result:
         if not results:
             results = omdb_result
@@ -629,6 +949,359 @@ def search_film(title, item_type=None):
     
     return results
 
+# ========== ОБНОВЛЕНИЕ РЕЙТИНГОВ ==========
+class TokenBucket:
+    """Квота: rate жетонов в секунду, не больше capacity про запас.
+
+    Стартует пустой, чтобы частые перезапуски не тратили квоту залпом.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def take(self, amount):
+        """Забирает до amount целых жетонов, возвращает сколько удалось"""
+        with self.lock:
+            self._refill()
+            taken = max(0, min(amount, int(self.tokens)))
+            self.tokens -= taken
+            return taken
+    
+    def give_back(self, amount):
+        """Возвращает неистраченное; отрицательный amount - перерасход, он уйдет в долг"""
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + amount)
+    
+    def available(self):
+        with self.lock:
+            self._refill()
+            return max(0, int(self.tokens))
+
+RATING_COLUMNS = ('kp_rating', 'imdb_rating')
+URL_COLUMNS = ('kp_url', 'imdb_url')
+
+def metadata_changes(current, result):
+    """Что можно обновить по ответу провайдеров.
+
+    Рейтинги обновляются, остальные поля только дописываются, если пустые. Если
+    провайдер нашел по названию другой фильм (ссылки не совпадают), запись не трогаем.
+    """
+    # Ничего не нашлось - в result заглушка из search_film, писать нечего
+    if not any(result.get(column) for column in URL_COLUMNS):
+        return {}
+    
+    stored_urls = [column for column in URL_COLUMNS if current.get(column)]
+    for column in stored_urls:
+        if result.get(column) and result[column] != current[column]:
+            return {}
+    if stored_urls and not any(result.get(column) == current[column] for column in stored_urls):
+        # Сверить не с чем: ответ может быть про однофамильца
+        return {}
+    
+    changes = {}
+    for column in db.METADATA_COLUMNS:
+        value = result.get(column)
+        if value is None or value == '' or value == 'Неизвестно':
+            continue
+        if column in RATING_COLUMNS:
+            value = round(float(value), 1)
+            if current.get(column) is not None and round(float(current[column]), 1) == value:
+                continue
+            changes[column] = value
+        elif current.get(column) in (None, '', 'Неизвестно'):
+            changes[column] = str(value)[:255]
+    return changes
+
+class MetadataRefresher:
+    """Фоновый поток: обходит записи от самых устаревших и обновляет рейтинги.
+
+    Квота считается в запросах к провайдерам, а не в поисках. Уступает провайдеров
+    пользовательским поискам и ищет на своем пуле потоков.
+    """
+    PROVIDERS = ('kinopoisk', 'omdb')
+
+    def __init__(self, interval, batch_size, budget):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.budget = budget
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._counters = {'cycles': 0, 'checked': 0, 'updated': 0, 'requests': 0, 'skipped_busy': 0, 'skipped_quota': 0}
+    
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='metadata-refresher', daemon=True)
+            self._thread.start()
+            logger.info(f"🔄 Фоновое обновление рейтингов: каждые {self.interval:.0f} с, до {self.batch_size} записей")
+    
+    def stop(self, timeout=5.0):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+    
+    def _count(self, name, delta=1):
+        with self._lock:
+            self._counters[name] += delta
+    
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.refresh_once()
+            except Exception as e:
+                logger.error(f"❌ Ошибка фонового обновления рейтингов: {e}")
+    
+    def providers_busy(self):
+        return any(http_client.in_flight(provider) >= REFRESH_BUSY_IN_FLIGHT for provider in self.PROVIDERS)
+    
+    def lookup(self, title, item_type):
+        """Поиск на своем пуле; возвращает (результат, сколько запросов ушло провайдерам)"""
+        meter = Counter()
+        token = http_meter.set(meter)
+        try:
+            result = search_film(title, item_type, fresh=True, executor=refresh_executor)
+        finally:
+            http_meter.reset(token)
+        return result, sum(meter[provider] for provider in self.PROVIDERS)
+    
+    def refresh_once(self):
+        """Один проход: пачка устаревших записей, одна транзакция на запись итогов"""
+        if self.providers_busy():
+            self._count('skipped_busy')
+            return 0
+        
+        # На запись резервируем худший случай, неистраченное возвращаем после поиска
+        limit = min(self.batch_size, self.budget.available() // LOOKUP_MAX_REQUESTS)
+        if not limit:
+            self._count('skipped_quota')
+            return 0
+        
+        rows = claim_stale_items(limit, REFRESH_MAX_AGE, REFRESH_MISSING_AGE, REFRESH_CLAIM_TTL)
+        if not rows:
+            return 0
+        
+        self._count('cycles')
+        changes = {}
+        checked = []
+        for item_id, item_type, title, *metadata in rows:
+            # Пользовательский поиск важнее: ждем, пока провайдеры освободятся
+            while self.providers_busy() and not self._stop.is_set():
+                self._stop.wait(1)
+            if self._stop.is_set():
+                break
+            
+            reserved = self.budget.take(LOOKUP_MAX_REQUESTS)
+            if reserved < LOOKUP_MAX_REQUESTS:
+                self.budget.give_back(reserved)
+                self._count('skipped_quota')
+                break
+            result, used = self.lookup(title, item_type)
+            self.budget.give_back(reserved - used)
+            self._count('requests', used)
+            
+            fields = metadata_changes(dict(zip(db.METADATA_COLUMNS, metadata)), result)
+            if fields:
+                changes[item_id] = fields
+            checked.append(item_id)
+            self._count('checked')
+        
+        # Непроверенные записи (остановка, кончилась квота) не отмечаем обновленными
+        released = [row[0] for row in rows[len(checked):]]
+        updated = update_items_metadata(changes, checked, released)
+        self._count('updated', updated)
+        logger.info(f"🔄 Обновление рейтингов: проверено {len(checked)} из {len(rows)}, изменилось {updated}")
+        return updated
+    
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+        stats['enabled'] = REFRESH_ENABLED
+        stats['running'] = self._thread is not None
+        stats['quota_available'] = self.budget.available()
+        return stats
+
+refresher = MetadataRefresher(
+    REFRESH_INTERVAL,
+    REFRESH_BATCH_SIZE,
+    TokenBucket(REFRESH_DAILY_QUOTA / (24 * 3600), max(REFRESH_BATCH_SIZE, 1) * LOOKUP_MAX_REQUESTS)
+)
+
+# ========== ИМПОРТ СПИСКОВ ==========
+SERIES_TYPES = ('series', 'tv-series', 'animated-series', 'mini-series')
+# Колонки с названием в выгрузках Letterboxd, Кинопоиска и самодельных CSV (по приоритету)
+CSV_TITLE_COLUMNS = ('name', 'title', 'название', 'nameru', 'film', 'фильм')
+
+active_imports = set()
+active_imports_lock = threading.Lock()
+import_executor = ThreadPoolExecutor(max_workers=IMPORT_CONCURRENCY, thread_name_prefix='import')
+
+def parse_import_file(data, filename=''):
+    """Достает названия из CSV или из текстового файла (одно название в строке)"""
+    try:
+        text = data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        text = data.decode('cp1251', errors='replace')
+    
+    lines = text.splitlines()
+    titles = []
+    if filename.lower().endswith('.csv') and lines:
+        delimiter = ';' if lines[0].count(';') > lines[0].count(',') else ','
+        reader = csv.reader(lines, delimiter=delimiter)
+        header = [column.strip().lower() for column in next(reader)]
+        title_column = next((header.index(name) for name in CSV_TITLE_COLUMNS if name in header), 0)
+        for row in reader:
+            if len(row) > title_column and row[title_column].strip():
+                titles.append(row[title_column].strip())
+    else:
+        titles = [line.strip() for line in lines if line.strip()]
+    
+    # Повторы внутри файла убираем сразу, чтобы не искать их дважды
+    seen = set()
+    unique_titles = []
+    for title in titles:
+        key = normalize_title(title)
+        if key and key not in seen:
+            seen.add(key)
+            unique_titles.append(title[:255])
+    return unique_titles[:IMPORT_MAX_TITLES]
+
+def import_item(title, forced_type=None):
+    """Ищет информацию об одном названии для импорта"""
+    try:
+        result = search_film(title, forced_type, executor=import_lookup_executor)
+    except Exception as e:
+        logger.error(f"❌ Ошибка поиска '{title}' при импорте: {e}")
+        result = {'original_title': title, 'year': 'Неизвестно'}
+    
+    item_type = forced_type or ('series' if result.get('type') in SERIES_TYPES else 'movie')
+    return {
+        'type': item_type,
+        'title': title,
+        'original_title': result.get('original_title', title),
+        'year': result.get('year', 'Неизвестно'),
+        'genre': result.get('genre'),
+        'kp_rating': result.get('kp_rating'),
+        'imdb_rating': result.get('imdb_rating'),
+        'kp_url': result.get('kp_url'),
+        'imdb_url': result.get('imdb_url'),
+    }
+
+def run_import(chat_id, titles, forced_type=None):
+    """Импортирует список: параллельный поиск, одна пакетная запись, прогресс в одном сообщении"""
+    total = len(titles)
+    try:
+        progress = bot.send_message(chat_id, f"📥 *Импорт:* 0/{total}", parse_mode='Markdown')
+        
+        def report(text):
+            try:
+                bot.edit_message_text(chat_id=chat_id, message_id=progress.message_id, text=text, parse_mode='Markdown')
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось обновить прогресс импорта: {e}")
+        
+        # Названия, которые уже есть в списке, не ищем: поиск тратит квоту провайдеров,
+        # а запись все равно отбросит дубликат. Без явного типа тип определит поиск,
+        # поэтому пропускаем название, если оно есть в списке с любым типом
+        known = db.existing_titles(chat_id, forced_type)
+        if known:
+            titles = [title for title in titles if normalize_title(title) not in known]
+        
+        items = []
+        last_report = time.monotonic()
+        futures = [import_executor.submit(import_item, title, forced_type) for title in titles]
+        for future in as_completed(futures):
+            items.append(future.result())
+            # Telegram ограничивает частоту правок, поэтому обновляем прогресс не чаще интервала
+            if time.monotonic() - last_report >= IMPORT_PROGRESS_INTERVAL:
+                last_report = time.monotonic()
+                report(f"📥 *Импорт:* ищу информацию {len(items)}/{len(titles)}")
+        
+        report(f"📥 *Импорт:* сохраняю {len(items)} записей...")
+        added = add_items_bulk(chat_id, items)
+        if added is None:
+            report(f"❌ *Импорт не удался:* не получилось сохранить {len(items)} записей. Попробуйте позже.")
+            logger.error(f"❌ Импорт для {chat_id}: пакетная запись не удалась")
+            return
+        
+        text = f"✅ *Импорт завершен!*\n\n📋 Добавлено: {added} из {total}"
+        if added < total:
+            text += f"\n⏭ Уже были в списке: {total - added}"
+        report(text)
+        logger.info(f"📥 Импорт для {chat_id}: добавлено {added} из {total}")
+    except Exception as e:
+        logger.error(f"❌ Ошибка импорта для {chat_id}: {e}")
+        try:
+            bot.send_message(chat_id, "❌ Произошла ошибка при импорте.", reply_markup=main_keyboard())
+        except Exception:
+            pass
+    finally:
+        with active_imports_lock:
+            active_imports.discard(chat_id)
+        # Поток импорта одноразовый - его соединение с локальной базой больше не понадобится
+        db.close_thread_sqlite()
+
+# ========== ВЫГРУЗКА СПИСКОВ ==========
+active_exports = set()
+active_exports_lock = threading.Lock()
+
+def write_export(fileobj, chat_id, export_format, item_type=None):
+    """Потоково пишет записи в gzip-архив: CSV или JSON Lines. Возвращает число строк"""
+    count = 0
+    with gzip.GzipFile(fileobj=fileobj, mode='wb') as archive:
+        with io.TextIOWrapper(archive, encoding='utf-8', newline='') as text:
+            if export_format == 'json':
+                for row in iter_items(chat_id, item_type):
+                    text.write(json.dumps(dict(zip(db.EXPORT_COLUMNS, row)), ensure_ascii=False, default=str))
+                    text.write('\n')
+                    count += 1
+            else:
+                writer = csv.writer(text)
+                writer.writerow(db.EXPORT_COLUMNS)
+                for row in iter_items(chat_id, item_type):
+                    writer.writerow(row)
+                    count += 1
+    return count
+
+def run_export(chat_id, export_format, item_type=None):
+    """Выгружает список во временный файл и отправляет его документом"""
+    extension = 'jsonl' if export_format == 'json' else 'csv'
+    try:
+        # Файл на диске, а не в памяти: размер выгрузки не ограничивает память процесса
+        with tempfile.TemporaryFile() as tmp:
+            count = write_export(tmp, chat_id, export_format, item_type)
+            if not count:
+                bot.send_message(chat_id, "📭 Список пуст, выгружать нечего.", reply_markup=main_keyboard())
+                return
+            
+            tmp.seek(0)
+            bot.send_document(
+                chat_id,
+                tmp,
+                visible_file_name=f"kinobot.{extension}.gz",
+                caption=f"📤 Выгружено записей: {count}",
+                reply_markup=main_keyboard()
+            )
+            logger.info(f"📤 Выгрузка для {chat_id}: {count} записей ({export_format})")
+    except Exception as e:
+        logger.error(f"❌ Ошибка выгрузки для {chat_id}: {e}")
+        try:
+            if not reply_degraded(chat_id):
+                bot.send_message(chat_id, "❌ Произошла ошибка при выгрузке.", reply_markup=main_keyboard())
+        except Exception:
+            pass
+    finally:
+        with active_exports_lock:
+            active_exports.discard(chat_id)
+        db.close_thread_sqlite()
+
 # ========== КЛАВИАТУРЫ ==========
 def main_keyboard():
     markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
@@ -663,33 +1336,86 @@ def search_type_keyboard():
     markup.add(btn1, btn2, btn3, btn4)
     return markup
 
-def list_keyboard(items, prefix="item"):
+def list_keyboard(items, prefix="item", has_prev=False, has_next=False, cursor_id=None, direction='n'):
     markup = types.InlineKeyboardMarkup(row_width=2)
     for item in items:
-        item_id, title, original_title, year, genre, kp_rating, imdb_rating, kp_url, imdb_url, watched, comment = item
-        watched_icon = "✅" if watched else "👁"
-        btn_text = f"{watched_icon} {title}"
-        if year and year != 'Неизвестно':
-            btn_text += f" ({year})"
+        watched_icon = "✅" if item.watched else "👁"
+        btn_text = f"{watched_icon} {item.title}"
+        if item.year and item.year != 'Неизвестно':
+            btn_text += f" ({item.year})"
+        if len(btn_text) > 40:
+            btn_text = btn_text[:37] + "..."
+        markup.add(types.InlineKeyboardButton(btn_text, callback_data=f"{prefix}_{item.id}"))
+    
+    # Курсор страницы - id первой/последней записи (callback_data ограничен 64 байтами)
+    nav = []
+    if has_prev and items:
+        nav.append(types.InlineKeyboardButton("⬅️ Назад", callback_data=f"page_{prefix}_p_{items[0].id}"))
+    if has_next and items:
+        nav.append(types.InlineKeyboardButton("Далее ➡️", callback_data=f"page_{prefix}_n_{items[-1].id}"))
+    if nav:
+        markup.row(*nav)
+    if items:
+        markup.add(types.InlineKeyboardButton(
+            "☑️ Выбрать несколько",
+            callback_data=select_data('v', prefix, direction, cursor_id, 0, page_checksum(items))
+        ))
+    return markup
+
+# Множественный выбор на странице списка.
+# callback_data: sel_{действие}_{тип}_{n|p}_{курсор}_{маска}_{crc}, где курсор и направление
+# задают страницу, маска (hex) - выбранные позиции на ней, crc - контрольная сумма id
+# страницы: если список успел измениться, выбор сбрасывается, а не применяется к другим записям
+def page_checksum(items):
+    return format(zlib.crc32(",".join(str(item.id) for item in items).encode()), '08x')
+
+def select_data(action, item_type, direction, cursor_id, mask, checksum):
+    return f"sel_{action}_{item_type}_{direction}_{cursor_id or 0}_{mask:x}_{checksum}"
+
+def select_keyboard(items, item_type, direction, cursor_id, mask):
+    """Страница списка с отметками выбора и групповыми действиями"""
+    checksum = page_checksum(items)
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    for index, item in enumerate(items):
+        check_icon = "☑️" if mask >> index & 1 else "⬜"
+        watched_icon = "✅" if item.watched else "👁"
+        btn_text = f"{check_icon}{watched_icon} {item.title}"
         if len(btn_text) > 40:
             btn_text = btn_text[:37] + "..."
-        markup.add(types.InlineKeyboardButton(btn_text, callback_data=f"{prefix}_{item_id}"))
+        markup.add(types.InlineKeyboardButton(
+            btn_text, callback_data=select_data('v', item_type, direction, cursor_id, mask ^ (1 << index), checksum)
+        ))
+    
+    def action(text, code):
+        return types.InlineKeyboardButton(text, callback_data=select_data(code, item_type, direction, cursor_id, mask, checksum))
+    
+    if mask:
+        markup.row(action("✅ Просмотрено", 'w'), action("👁 Не просмотрено", 'u'))
+        markup.row(action(f"🗑 Удалить ({bin(mask).count('1')})", 'd'))
+    markup.row(action("↩️ Готово", 'x'))
+    return markup
+
+def select_delete_keyboard(item_type, direction, cursor_id, mask, checksum):
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    markup.add(
+        types.InlineKeyboardButton(f"✅ Да, удалить ({bin(mask).count('1')})",
+                                   callback_data=select_data('D', item_type, direction, cursor_id, mask, checksum)),
+        types.InlineKeyboardButton("❌ Нет, отмена",
+                                   callback_data=select_data('v', item_type, direction, cursor_id, mask, checksum))
+    )
     return markup
 
 def search_results_keyboard(search_results):
     markup = types.InlineKeyboardMarkup(row_width=2)
     for item in search_results:
-        item_id, title, original_title, year, genre, kp_rating, imdb_rating, kp_url, imdb_url, watched, comment = item
-        # Определяем тип элемента
-        item_details = get_item_by_id(item_id)
-        type_icon = "🎬" if item_details and item_details[1] == 'series' else "🎥"
-        watched_icon = "✅" if watched else "👁"
-        btn_text = f"{type_icon}{watched_icon} {title}"
-        if year and year != 'Неизвестно':
-            btn_text += f" ({year})"
+        type_icon = "🎬" if item.type == 'series' else "🎥"
+        watched_icon = "✅" if item.watched else "👁"
+        btn_text = f"{type_icon}{watched_icon} {item.title}"
+        if item.year and item.year != 'Неизвестно':
+            btn_text += f" ({item.year})"
         if len(btn_text) > 40:
             btn_text = btn_text[:37] + "..."
-        markup.add(types.InlineKeyboardButton(btn_text, callback_data=f"item_{item_id}"))
+        markup.add(types.InlineKeyboardButton(btn_text, callback_data=f"item_{item.id}"))
     markup.add(types.InlineKeyboardButton("🔄 Новый поиск", callback_data="new_search"))
     markup.add(types.InlineKeyboardButton("↩️ Назад", callback_data="back_to_main"))
     return markup
@@ -707,57 +1433,48 @@ def item_keyboard(item_id):
 
 # ========== ФОРМАТИРОВАНИЕ ТЕКСТА ==========
 def format_item_details(item):
-    item_id, item_type, title, original_title, year, genre, kp_rating, imdb_rating, kp_url, imdb_url, watched, comment = item
-    
-    type_ru = "сериал" if item_type == 'series' else "фильм"
-    watched_text = "✅ Просмотрено" if watched else "👁 Хочу посмотреть"
+    type_ru = "сериал" if item.type == 'series' else "фильм"
+    watched_text = "✅ Просмотрено" if item.watched else "👁 Хочу посмотреть"
     
-    text = f"🎬 *{type_ru.upper()} #{item_id}*\n\n"
-    text += f"📌 *{title}*\n"
+    text = f"🎬 *{type_ru.upper()} #{item.id}*\n\n"
+    text += f"📌 *{item.title}*\n"
     
-    if original_title and original_title != title:
-        text += f"🌐 *Оригинальное название:* {original_title}\n"
+    if item.original_title and item.original_title != item.title:
+        text += f"🌐 *Оригинальное название:* {item.original_title}\n"
     
-    text += f"📅 *Год:* {year}\n"
+    text += f"📅 *Год:* {item.year}\n"
     
-    if genre:
-        text += f"🎭 *Жанр:* {genre}\n"
+    if item.genre:
+        text += f"🎭 *Жанр:* {item.genre}\n"
     
     text += f"📊 *Статус:* {watched_text}\n"
     
     ratings = []
-    if kp_rating:
-        ratings.append(f"КП: ⭐{kp_rating}")
-    if imdb_rating:
-        ratings.append(f"IMDb: ⭐{imdb_rating}")
+    if item.kp_rating:
+        ratings.append(f"КП: ⭐{item.kp_rating}")
+    if item.imdb_rating:
+        ratings.append(f"IMDb: ⭐{item.imdb_rating}")
     if ratings:
         text += f"⭐ *Рейтинги:* {' | '.join(ratings)}\n"
     
     links = []
-    if kp_url:
-        links.append(f"[Кинопоиск]({kp_url})")
-    if imdb_url:
-        links.append(f"[IMDb]({imdb_url})")
+    if item.kp_url:
+        links.append(f"[Кинопоиск]({item.kp_url})")
+    if item.imdb_url:
+        links.append(f"[IMDb]({item.imdb_url})")
     if links:
         text += f"🔗 *Ссылки:* {' | '.join(links)}\n"
     
-    if comment:
-        text += f"\n💭 *Комментарий:*\n{comment}\n"
+    if item.comment:
+        text += f"\n💭 *Комментарий:*\n{item.comment}\n"
     else:
         text += f"\n💭 *Комментарий:* не добавлен\n"
     
     return text
 
 def format_search_results(search_results, search_term, search_type=None):
-    movies_count = 0
-    series_count = 0
-    
-    for item in search_results:
-        item_details = get_item_by_id(item[0])
-        if item_details and item_details[1] == 'movie':
-            movies_count += 1
-        else:
-            series_count += 1
+    movies_count = sum(1 for item in search_results if item.type == 'movie')
+    series_count = len(search_results) - movies_count
     
     if search_type == 'movie':
         type_text = "фильмов"
@@ -778,26 +1495,137 @@ def format_search_results(search_results, search_term, search_type=None):
     
     return text
 
-def format_stats():
-    all_movies = get_items('movie')
-    all_series = get_items('series')
-    
-    watched_movies = sum(1 for m in all_movies if m[9])
-    watched_series = sum(1 for s in all_series if s[9])
+def format_stats(chat_id):
+    stats = get_stats(chat_id)
+    movies = stats['types'].get('movie', {'total': 0, 'watched': 0})
+    series = stats['types'].get('series', {'total': 0, 'watched': 0})
     
     text = "📊 *Ваша статистика:*\n\n"
-    text += f"🎥 *Фильмы:* {len(all_movies)} (просмотрено: {watched_movies})\n"
-    text += f"🎬 *Сериалы:* {len(all_series)} (просмотрено: {watched_series})\n"
-    text += f"📋 *Всего:* {len(all_movies) + len(all_series)} (просмотрено: {watched_movies + watched_series})"
+    text += f"🎥 *Фильмы:* {movies['total']} (просмотрено: {movies['watched']})\n"
+    text += f"🎬 *Сериалы:* {series['total']} (просмотрено: {series['watched']})\n"
+    text += f"📋 *Всего:* {stats['total']} (просмотрено: {stats['watched']})"
+    
+    if not stats['total']:
+        return text
+    
+    text += f"\n📈 *Просмотрено:* {round(stats['watched_ratio'] * 100)}%\n"
+    
+    ratings = []
+    if stats['kp_avg']:
+        ratings.append(f"КП: ⭐{stats['kp_avg']}")
+    if stats['imdb_avg']:
+        ratings.append(f"IMDb: ⭐{stats['imdb_avg']}")
+    if ratings:
+        text += f"⭐ *Средний рейтинг:* {' | '.join(ratings)}\n"
+    
+    if stats['genres']:
+        top_genres = sorted(stats['genres'].items(), key=lambda g: (-g[1], g[0]))[:5]
+        text += "\n🎭 *Любимые жанры:*\n"
+        for name, count in top_genres:
+            text += f"• {name}: {count}\n"
+    
+    if stats['decades']:
+        text += "\n📅 *По десятилетиям:*\n"
+        for decade, count in sorted(stats['decades'].items()):
+            text += f"• {decade}-е: {count}\n"
     
     return text
 
-# ========== ОБРАБОТЧИКИ СООБЩЕНИЙ ==========
-user_states = {}
+# ========== КЭШ ОТРИСОВКИ ==========
+class RenderCache:
+    """Готовые тексты и клавиатуры по ключу (чат, что показываем) и версии данных чата"""
+
+    KINDS = ('item', 'page', 'search')
+
+    def __init__(self, max_size=5000, ttl=30.0, version_check=2.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.version_check = version_check
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = dict.fromkeys(self.KINDS, 0)
+        self.misses = dict.fromkeys(self.KINDS, 0)
+
+    def get_or_render(self, chat_id, key, render):
+        """Значение из кэша, если данные чата не менялись; иначе render(). None не кэшируется"""
+        kind = key[0]
+        # Версию берем до чтения БД: запись, случившаяся во время отрисовки, сделает результат устаревшим
+        version = db.data_version(chat_id, self.version_check)
+        if version is None:
+            # Версию не узнать - не знаем и того, свежий ли кэш
+            return render()
+        cache_key = (chat_id,) + key
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry and entry[0] == version and entry[1] > now:
+                self._entries.move_to_end(cache_key)
+                self.hits[kind] += 1
+                return entry[2]
+            self.misses[kind] += 1
+        
+        value = render()
+        if value is not None:
+            with self._lock:
+                self._entries[cache_key] = (version, now + self.ttl, value)
+                self._entries.move_to_end(cache_key)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        return value
 
+    def stats(self):
+        with self._lock:
+            hits = sum(self.hits.values())
+            lookups = hits + sum(self.misses.values())
+            stats = {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': hits,
+                'misses': lookups - hits,
+                'hit_rate': round(hits / lookups, 3) if lookups else 0.0,
+            }
+            for kind in self.KINDS:
+                kind_lookups = self.hits[kind] + self.misses[kind]
+                stats[f'{kind}_hit_rate'] = round(self.hits[kind] / kind_lookups, 3) if kind_lookups else 0.0
+            return stats
+
+render_cache = RenderCache(max_size=RENDER_CACHE_SIZE, ttl=RENDER_CACHE_TTL, version_check=RENDER_VERSION_CHECK)
+
+def render_item(chat_id, item_id):
+    """Карточка записи: (текст, клавиатура) или None, если записи нет"""
+    def render():
+        item = get_item_by_id(chat_id, item_id)
+        if not item:
+            return None
+        return format_item_details(item), item_keyboard(item_id)
+    return render_cache.get_or_render(chat_id, ('item', item_id), render)
+
+def render_list_page(chat_id, item_type, cursor_id=None, direction='next'):
+    """Клавиатура страницы списка или None, если список пуст"""
+    def render():
+        items, has_prev, has_next = get_items_page(chat_id, item_type, cursor_id, direction)
+        if not items:
+            return None
+        return list_keyboard(items, item_type, has_prev, has_next, cursor_id, 'p' if direction == 'prev' else 'n')
+    return render_cache.get_or_render(chat_id, ('page', item_type, cursor_id, direction), render)
+
+def render_search(chat_id, search_term, search_type=None):
+    """Результаты поиска: (id всех найденных, текст, клавиатура первых 10) или None"""
+    def render():
+        search_results = search_items(chat_id, search_term, search_type, limit=50)
+        if not search_results:
+            return None
+        return (
+            [item.id for item in search_results],
+            format_search_results(search_results, search_term, search_type),
+            search_results_keyboard(search_results[:10]),
+        )
+    return render_cache.get_or_render(chat_id, ('search', search_type, search_term.lower()), render)
+
+# ========== ОБРАБОТЧИКИ СООБЩЕНИЙ ==========
 @bot.message_handler(commands=['start', 'help'])
 def start(message):
-    logger.info(f"🚀 Команда /start от {message.chat.id}")
+    logger.info("🚀 Команда /start от %s", message.chat.id)
     try:
         bot.send_message(
             message.chat.id, 
@@ -809,21 +1637,123 @@ def start(message):
             "• 💬 Добавлять комментарии к фильмам\n"
             "• 🗑 Удалять записи из списка\n"
             "• 🔍 Искать по вашему списку\n"
-            "• ⭐ Автоматически находить рейтинги и жанры\n\n"
+            "• ⭐ Автоматически находить рейтинги и жанры\n"
+            "• 📥 Импортировать список из файла (/import)\n"
+            "• 📤 Выгрузить список в CSV или JSON (/export)\n\n"
             "Выберите действие ниже:",
             parse_mode='Markdown',
             reply_markup=main_keyboard()
         )
-        logger.info(f"✅ Ответ на /start отправлен {message.chat.id}")
+        logger.debug("✅ Ответ на /start отправлен %s", message.chat.id)
     except Exception as e:
         logger.error(f"❌ Ошибка при отправке /start: {e}")
 
+@bot.message_handler(commands=['import'])
+def import_help(message):
+    logger.info("📥 Команда /import от %s", message.chat.id)
+    try:
+        bot.send_message(
+            message.chat.id,
+            "📥 *Импорт списка*\n\n"
+            "Пришлите файл документом:\n"
+            "• `.txt` - одно название в строке\n"
+            "• `.csv` - выгрузка Letterboxd или Кинопоиска (колонка Name/Title/Название)\n\n"
+            "Чтобы импортировать все как сериалы или как фильмы, напишите в подписи к файлу "
+            "'сериалы' или 'фильмы'. Иначе тип определю сам.",
+            parse_mode='Markdown'
+        )
+    except Exception as e:
+        logger.error(f"❌ Ошибка при отправке /import: {e}")
+
+@bot.message_handler(commands=['export'])
+def export_list(message):
+    chat_id = message.chat.id
+    logger.info("📤 Команда /export от %s", chat_id)
+    
+    try:
+        args = message.text.lower().split()[1:]
+        export_format = 'json' if 'json' in args else 'csv'
+        if any(arg.startswith('сериал') or arg == 'series' for arg in args):
+            item_type = 'series'
+        elif any(arg.startswith('фильм') or arg == 'movies' for arg in args):
+            item_type = 'movie'
+        else:
+            item_type = None
+        
+        with active_exports_lock:
+            if chat_id in active_exports:
+                bot.send_message(chat_id, "⏳ Предыдущая выгрузка еще идет, дождитесь ее окончания.")
+                return
+            active_exports.add(chat_id)
+        
+        bot.send_message(chat_id, "📤 Готовлю файл... (`/export json` - в формате JSON Lines, `/export фильмы` или `/export сериалы` - только один список)", parse_mode='Markdown')
+        threading.Thread(
+            target=run_export,
+            args=(chat_id, export_format, item_type),
+            name=f"export-{chat_id}",
+            daemon=True
+        ).start()
+    except Exception as e:
+        logger.error(f"❌ Ошибка при обработке /export: {e}")
+
+@bot.message_handler(content_types=['document'])
+def import_document(message):
+    chat_id = message.chat.id
+    document = message.document
+    logger.info("📥 Файл для импорта от %s: %s", chat_id, document.file_name)
+    
+    try:
+        if document.file_size and document.file_size > IMPORT_MAX_FILE_SIZE:
+            bot.send_message(chat_id, f"❌ Файл слишком большой (максимум {IMPORT_MAX_FILE_SIZE // 1024} КБ).")
+            return
+        
+        with active_imports_lock:
+            if chat_id in active_imports:
+                bot.send_message(chat_id, "⏳ Предыдущий импорт еще идет, дождитесь его окончания.")
+                return
+            active_imports.add(chat_id)
+        
+        try:
+            file_info = bot.get_file(document.file_id)
+            titles = parse_import_file(bot.download_file(file_info.file_path), document.file_name or '')
+        except Exception:
+            with active_imports_lock:
+                active_imports.discard(chat_id)
+            raise
+        
+        if not titles:
+            with active_imports_lock:
+                active_imports.discard(chat_id)
+            bot.send_message(chat_id, "❌ Не нашел в файле ни одного названия.", reply_markup=main_keyboard())
+            return
+        
+        caption = (message.caption or '').lower()
+        if 'сериал' in caption or 'series' in caption:
+            forced_type = 'series'
+        elif 'фильм' in caption or 'movie' in caption:
+            forced_type = 'movie'
+        else:
+            forced_type = None
+        
+        # Импорт идет в отдельном потоке, чтобы не держать очередь обновлений этого чата
+        threading.Thread(
+            target=run_import,
+            args=(chat_id, titles, forced_type),
+            name=f"import-{chat_id}",
+            daemon=True
+        ).start()
+    except Exception as e:
+        logger.error(f"❌ Ошибка при приеме файла импорта: {e}")
+        bot.send_message(chat_id, "❌ Не удалось прочитать файл.", reply_markup=main_keyboard())
+
 @bot.message_handler(func=lambda message: message.text == '🎬 Список сериалов')
 def show_series(message):
-    logger.info(f"📺 Запрос списка сериалов от {message.chat.id}")
+    logger.info("📺 Запрос списка сериалов от %s", message.chat.id)
     try:
-        items = get_items('series')
-        if not items:
+        markup = render_list_page(message.chat.id, 'series')
+        if not markup and reply_degraded(message.chat.id):
+            return
+        if not markup:
             text = "📭 Список сериалов пуст.\n\nДобавьте первый сериал через меню '➕ Добавить фильм или сериал'"
             bot.send_message(message.chat.id, text, parse_mode='Markdown', reply_markup=main_keyboard())
         else:
@@ -831,18 +1761,20 @@ def show_series(message):
                 message.chat.id,
                 "📺 *Ваш список сериалов:*\n\nВыберите сериал для детального просмотра:",
                 parse_mode='Markdown',
-                reply_markup=list_keyboard(items, "series")
+                reply_markup=markup
             )
-        logger.info(f"✅ Список сериалов отправлен {message.chat.id}")
+        logger.debug("✅ Список сериалов отправлен %s", message.chat.id)
     except Exception as e:
         logger.error(f"❌ Ошибка при показе сериалов: {e}")
 
 @bot.message_handler(func=lambda message: message.text == '🎥 Список фильмов')
 def show_movies(message):
-    logger.info(f"🎥 Запрос списка фильмов от {message.chat.id}")
+    logger.info("🎥 Запрос списка фильмов от %s", message.chat.id)
     try:
-        items = get_items('movie')
-        if not items:
+        markup = render_list_page(message.chat.id, 'movie')
+        if not markup and reply_degraded(message.chat.id):
+            return
+        if not markup:
             text = "📭 Список фильмов пуст.\n\nДобавьте первый фильм через меню '➕ Добавить фильм или сериал'"
             bot.send_message(message.chat.id, text, parse_mode='Markdown', reply_markup=main_keyboard())
         else:
@@ -850,15 +1782,15 @@ def show_movies(message):
                 message.chat.id,
                 "🎞 *Ваш список фильмов:*\n\nВыберите фильм для детального просмотра:",
                 parse_mode='Markdown',
-                reply_markup=list_keyboard(items, "movie")
+                reply_markup=markup
             )
-        logger.info(f"✅ Список фильмов отправлен {message.chat.id}")
+        logger.debug("✅ Список фильмов отправлен %s", message.chat.id)
     except Exception as e:
         logger.error(f"❌ Ошибка при показе фильмов: {e}")
 
 @bot.message_handler(func=lambda message: message.text == '🔍 Поиск в списке')
 def start_search(message):
-    logger.info(f"🔍 Запрос поиска от {message.chat.id}")
+    logger.info("🔍 Запрос поиска от %s", message.chat.id)
     try:
         bot.send_message(
             message.chat.id,
@@ -869,15 +1801,15 @@ def start_search(message):
             parse_mode='Markdown',
             reply_markup=search_type_keyboard()
         )
-        user_states[message.chat.id] = {'state': 'choosing_search_type'}
-        logger.info(f"✅ Меню поиска отправлено {message.chat.id}")
+        state_store.set(message.chat.id, {'state': 'choosing_search_type'})
+        logger.debug("✅ Меню поиска отправлено %s", message.chat.id)
     except Exception as e:
         logger.error(f"❌ Ошибка при начале поиска: {e}")
 
 @bot.message_handler(func=lambda message: message.text in ['🎬 Поиск сериалов', '🎥 Поиск фильмов', '🔍 Поиск везде'])
 def choose_search_type(message):
     chat_id = message.chat.id
-    logger.info(f"🔍 Выбор типа поиска от {chat_id}: {message.text}")
+    logger.info("🔍 Выбор типа поиска от %s: %s", chat_id, message.text)
     
     try:
         if message.text == '🎬 Поиск сериалов':
@@ -890,10 +1822,10 @@ def choose_search_type(message):
             search_type = None
             type_text = "везде"
         
-        user_states[chat_id] = {
+        state_store.set(chat_id, {
             'state': 'entering_search_term',
             'search_type': search_type
-        }
+        })
         
         if search_type:
             bot.send_message(
@@ -909,30 +1841,34 @@ def choose_search_type(message):
                 parse_mode='Markdown',
                 reply_markup=types.ReplyKeyboardRemove()
             )
-        logger.info(f"✅ Запрос поискового запроса отправлен {chat_id}")
+        logger.debug("✅ Запрос поискового запроса отправлен %s", chat_id)
     except Exception as e:
         logger.error(f"❌ Ошибка при выборе типа поиска: {e}")
 
-@bot.message_handler(func=lambda message: message.chat.id in user_states and user_states[message.chat.id]['state'] == 'entering_search_term')
+@bot.message_handler(func=lambda message: chat_state(message) == 'entering_search_term')
 def perform_search(message):
     chat_id = message.chat.id
     search_term = message.text.strip()
-    search_type = user_states[chat_id].get('search_type')
+    search_type = (state_store.get(chat_id) or {}).get('search_type')
     
-    logger.info(f"🔍 Выполнение поиска от {chat_id}: '{search_term}', тип: {search_type}")
+    logger.info("🔍 Выполнение поиска от %s: '%s', тип: %s", chat_id, search_term, search_type)
     
     if not search_term:
         bot.send_message(chat_id, "❌ Поисковый запрос не может быть пустым.", 
                        reply_markup=search_type_keyboard())
-        user_states[chat_id]['state'] = 'choosing_search_type'
+        state_store.update(chat_id, state='choosing_search_type')
         return
     
     try:
         bot.send_message(chat_id, f"🔍 *Ищу '{search_term}'...*", parse_mode='Markdown')
         
-        search_results = search_items(search_term, search_type, limit=50)
+        rendered = render_search(chat_id, search_term, search_type)
         
-        if not search_results:
+        if not rendered and reply_degraded(chat_id):
+            state_store.delete(chat_id)
+            return
+        
+        if not rendered:
             if search_type == 'movie':
                 text = f"🎥 *Фильмы не найдены*\n\nПо запросу '{search_term}' не найдено фильмов в вашем списке."
             elif search_type == 'series':
@@ -946,62 +1882,61 @@ def perform_search(message):
                 parse_mode='Markdown',
                 reply_markup=main_keyboard()
             )
-            del user_states[chat_id]
-            logger.info(f"🔍 Поиск не дал результатов для {chat_id}")
+            state_store.delete(chat_id)
+            logger.debug("🔍 Поиск не дал результатов для %s", chat_id)
             return
         
-        # Сохраняем результаты поиска в состоянии пользователя
-        user_states[chat_id]['search_results'] = search_results
-        user_states[chat_id]['search_term'] = search_term
-        user_states[chat_id]['state'] = 'showing_search_results'
-        
-        # Показываем первые 10 результатов
-        results_to_show = search_results[:10]
+        found_ids, text, markup = rendered
         
-        bot.send_message(
+        # Сохраняем результаты поиска в состоянии пользователя
+        state_store.update(
             chat_id,
-            format_search_results(results_to_show, search_term, search_type),
-            parse_mode='Markdown',
-            reply_markup=search_results_keyboard(results_to_show)
+            state='showing_search_results',
+            search_results=found_ids,
+            search_term=search_term
         )
-        logger.info(f"✅ Результаты поиска отправлены {chat_id}")
+        
+        # Клавиатура содержит первые 10 результатов
+        bot.send_message(chat_id, text, parse_mode='Markdown', reply_markup=markup)
+        logger.debug("✅ Результаты поиска отправлены %s", chat_id)
         
     except Exception as e:
         logger.error(f"❌ Ошибка при выполнении поиска: {e}")
         bot.send_message(chat_id, "❌ Произошла ошибка при поиске.", reply_markup=main_keyboard())
-        if chat_id in user_states:
-            del user_states[chat_id]
+        state_store.delete(chat_id)
 
 @bot.message_handler(func=lambda message: message.text == '📊 Статистика')
 def show_stats(message):
-    logger.info(f"📊 Запрос статистики от {message.chat.id}")
+    logger.info("📊 Запрос статистики от %s", message.chat.id)
     try:
-        bot.send_message(message.chat.id, format_stats(), parse_mode='Markdown')
-        logger.info(f"✅ Статистика отправлена {message.chat.id}")
+        if reply_degraded(message.chat.id):
+            return
+        bot.send_message(message.chat.id, format_stats(message.chat.id), parse_mode='Markdown')
+        logger.debug("✅ Статистика отправлена %s", message.chat.id)
     except Exception as e:
         logger.error(f"❌ Ошибка при показе статистики: {e}")
 
 @bot.message_handler(func=lambda message: message.text == '➕ Добавить фильм или сериал')
 def add_item_start(message):
-    logger.info(f"➕ Запрос добавления от {message.chat.id}")
+    logger.info("➕ Запрос добавления от %s", message.chat.id)
     try:
         bot.send_message(message.chat.id, "🎬 *Что вы хотите добавить?*\n\nВы можете ввести название на русском или английском языке.", 
                          parse_mode='Markdown', reply_markup=type_keyboard())
-        user_states[message.chat.id] = {'state': 'choosing_type'}
-        logger.info(f"✅ Меню выбора типа отправлено {message.chat.id}")
+        state_store.set(message.chat.id, {'state': 'choosing_type'})
+        logger.debug("✅ Меню выбора типа отправлено %s", message.chat.id)
     except Exception as e:
         logger.error(f"❌ Ошибка при начале добавления: {e}")
 
 @bot.message_handler(func=lambda message: message.text in ['Фильм', 'Сериал'])
 def choose_type(message):
     chat_id = message.chat.id
-    logger.info(f"🎬 Выбор типа от {chat_id}: {message.text}")
+    logger.info("🎬 Выбор типа от %s: %s", chat_id, message.text)
     
     try:
-        user_states[chat_id] = {
+        state_store.set(chat_id, {
             'state': 'entering_title',
             'type': 'movie' if message.text == 'Фильм' else 'series'
-        }
+        })
         type_ru = "фильм" if message.text == 'Фильм' else "сериал"
         bot.send_message(chat_id, 
                          f"🎥 *Введите название {type_ru}а:*\n\n"
@@ -1010,28 +1945,27 @@ def choose_type(message):
                          f"• Я поищу рейтинги и жанры на Кинопоиске и IMDb",
                          parse_mode='Markdown',
                          reply_markup=types.ReplyKeyboardRemove())
-        logger.info(f"✅ Запрос названия отправлен {chat_id}")
+        logger.debug("✅ Запрос названия отправлен %s", chat_id)
     except Exception as e:
         logger.error(f"❌ Ошибка при выборе типа: {e}")
 
 @bot.message_handler(func=lambda message: message.text in ['Назад', '↩️ Назад'])
 def back_to_main(message):
-    logger.info(f"↩️ Возврат в главное меню от {message.chat.id}")
+    logger.info("↩️ Возврат в главное меню от %s", message.chat.id)
     try:
         bot.send_message(message.chat.id, "Главное меню:", reply_markup=main_keyboard())
-        if message.chat.id in user_states:
-            del user_states[message.chat.id]
-        logger.info(f"✅ Возврат в главное меню выполнен {message.chat.id}")
+        state_store.delete(message.chat.id)
+        logger.debug("✅ Возврат в главное меню выполнен %s", message.chat.id)
     except Exception as e:
         logger.error(f"❌ Ошибка при возврате в главное меню: {e}")
 
-@bot.message_handler(func=lambda message: message.chat.id in user_states and user_states[message.chat.id]['state'] == 'entering_title')
+@bot.message_handler(func=lambda message: chat_state(message) == 'entering_title')
 def enter_title(message):
     chat_id = message.chat.id
     title = message.text.strip()
-    item_type = user_states[chat_id]['type']
+    item_type = state_store.get(chat_id)['type']
     
-    logger.info(f"🎬 Ввод названия от {chat_id}: '{title}', тип: {item_type}")
+    logger.info("🎬 Ввод названия от %s: '%s', тип: %s", chat_id, title, item_type)
     
     if not title:
         bot.send_message(chat_id, "❌ Название не может быть пустым. Попробуйте еще раз:", 
@@ -1040,21 +1974,20 @@ def enter_title(message):
     
     try:
         # Проверяем, существует ли уже такой фильм
-        existing_items = get_items(item_type)
-        for item in existing_items:
-            if item[1].lower() == title.lower():
-                bot.send_message(chat_id, 
-                               f"❌ *'{title}'* уже есть в вашем списке!\n\n"
-                               f"Попробуйте добавить другой {item_type}.",
-                               parse_mode='Markdown',
-                               reply_markup=main_keyboard())
-                del user_states[chat_id]
-                return
+        if find_item_id(chat_id, item_type, title):
+            bot.send_message(chat_id, 
+                           f"❌ *'{title}'* уже есть в вашем списке!\n\n"
+                           f"Попробуйте добавить другой {item_type}.",
+                           parse_mode='Markdown',
+                           reply_markup=main_keyboard())
+            state_store.delete(chat_id)
+            return
         
         bot.send_message(chat_id, f"🔍 *Ищу информацию о '{title}'...*", parse_mode='Markdown')
         result = search_film(title, item_type)
         
         item_id = add_item(
+            chat_id=chat_id,
             item_type=item_type,
             title=title,
             original_title=result.get('original_title', title),
@@ -1066,7 +1999,13 @@ def enter_title(message):
             imdb_url=result.get('imdb_url')
         )
         
-        if item_id:
+        if item_id == db.QUEUED:
+            bot.send_message(chat_id,
+                           f"⏳ *База данных временно недоступна.*\n\n'{title}' будет добавлен, как только она восстановится.",
+                           parse_mode='Markdown', reply_markup=main_keyboard())
+            state_store.delete(chat_id)
+            logger.info("⏳ Добавление '%s' отложено для %s", title, chat_id)
+        elif item_id:
             type_ru = "фильм" if item_type == 'movie' else "сериал"
             
             found_kp = result.get('kp_rating') is not None
@@ -1092,7 +2031,7 @@ def enter_title(message):
             
             bot.send_message(chat_id, message_text, parse_mode='Markdown')
             
-            user_states[chat_id] = {'state': 'adding_comment', 'item_id': item_id}
+            state_store.set(chat_id, {'state': 'adding_comment', 'item_id': item_id})
             bot.send_message(
                 chat_id,
                 "💭 *Хотите добавить комментарий?*\n\n"
@@ -1100,91 +2039,101 @@ def enter_title(message):
                 parse_mode='Markdown',
                 reply_markup=skip_keyboard()
             )
-            logger.info(f"✅ Фильм добавлен с ID {item_id} для {chat_id}")
+            logger.info("✅ Фильм добавлен с ID %s для %s", item_id, chat_id)
+        elif find_item_id(chat_id, item_type, title):
+            # Пока искали информацию, это название уже успели добавить
+            bot.send_message(chat_id, f"❌ *'{title}'* уже есть в вашем списке!",
+                           parse_mode='Markdown', reply_markup=main_keyboard())
+            state_store.delete(chat_id)
+            logger.info("⚠️ Дубликат '%s' отклонен для %s", title, chat_id)
         else:
             bot.send_message(chat_id, "❌ Ошибка при сохранении.", reply_markup=main_keyboard())
-            del user_states[chat_id]
+            state_store.delete(chat_id)
             logger.error(f"❌ Ошибка добавления фильма для {chat_id}")
             
     except Exception as e:
         logger.error(f"❌ Ошибка при вводе названия: {e}")
         bot.send_message(chat_id, "❌ Произошла ошибка при добавлении.", reply_markup=main_keyboard())
-        if chat_id in user_states:
-            del user_states[chat_id]
+        state_store.delete(chat_id)
 
-@bot.message_handler(func=lambda message: message.chat.id in user_states and user_states[message.chat.id].get('state') == 'adding_comment')
+@bot.message_handler(func=lambda message: chat_state(message) == 'adding_comment')
 def add_comment(message):
     chat_id = message.chat.id
-    item_id = user_states[chat_id]['item_id']
+    item_id = state_store.get(chat_id)['item_id']
     
-    logger.info(f"💭 Добавление комментария от {chat_id} для item {item_id}")
+    logger.info("💭 Добавление комментария от %s для item %s", chat_id, item_id)
     
     try:
         if message.text == '➡️ Пропустить комментарий':
             bot.send_message(chat_id, "➡️ Комментарий пропущен.", reply_markup=main_keyboard())
-            logger.info(f"💭 Комментарий пропущен для {chat_id}")
+            logger.info("💭 Комментарий пропущен для %s", chat_id)
         else:
-            if update_item(item_id, comment=message.text):
+            updated = update_item(chat_id, item_id, comment=message.text)
+            if updated == db.QUEUED:
+                bot.send_message(chat_id, f"💭 {QUEUED_ALERT}", reply_markup=main_keyboard())
+            elif updated:
                 bot.send_message(chat_id, "💭 *Комментарий добавлен!*", parse_mode='Markdown', reply_markup=main_keyboard())
-                logger.info(f"💭 Комментарий добавлен для {chat_id}")
+                logger.info("💭 Комментарий добавлен для %s", chat_id)
             else:
                 bot.send_message(chat_id, "❌ Ошибка при добавлении комментария.", reply_markup=main_keyboard())
                 logger.error(f"❌ Ошибка добавления комментария для {chat_id}")
         
-        item = get_item_by_id(item_id)
-        if item:
+        rendered = render_item(chat_id, item_id)
+        if rendered:
+            text, markup = rendered
             bot.send_message(
                 chat_id,
-                format_item_details(item),
+                text,
                 parse_mode='Markdown',
                 disable_web_page_preview=True,
-                reply_markup=item_keyboard(item_id)
+                reply_markup=markup
             )
-            logger.info(f"✅ Детали фильма отправлены {chat_id}")
+            logger.debug("✅ Детали фильма отправлены %s", chat_id)
         
-        del user_states[chat_id]
+        state_store.delete(chat_id)
         
     except Exception as e:
         logger.error(f"❌ Ошибка при добавлении комментария: {e}")
         bot.send_message(chat_id, "❌ Произошла ошибка.", reply_markup=main_keyboard())
-        if chat_id in user_states:
-            del user_states[chat_id]
+        state_store.delete(chat_id)
 
-@bot.message_handler(func=lambda message: message.chat.id in user_states and user_states[message.chat.id].get('state') == 'editing_comment')
+@bot.message_handler(func=lambda message: chat_state(message) == 'editing_comment')
 def edit_comment(message):
     chat_id = message.chat.id
-    item_id = user_states[chat_id]['item_id']
+    item_id = state_store.get(chat_id)['item_id']
     
-    logger.info(f"💭 Редактирование комментария от {chat_id} для item {item_id}")
+    logger.info("💭 Редактирование комментария от %s для item %s", chat_id, item_id)
     
     try:
-        if update_item(item_id, comment=message.text):
+        updated = update_item(chat_id, item_id, comment=message.text)
+        if updated == db.QUEUED:
+            bot.send_message(chat_id, f"💭 {QUEUED_ALERT}", reply_markup=main_keyboard())
+        elif updated:
             bot.send_message(chat_id, "💭 *Комментарий обновлен!*", parse_mode='Markdown')
-            item = get_item_by_id(item_id)
+            text, markup = render_item(chat_id, item_id)
             bot.send_message(
                 chat_id,
-                format_item_details(item),
+                text,
                 parse_mode='Markdown',
                 disable_web_page_preview=True,
-                reply_markup=item_keyboard(item_id)
+                reply_markup=markup
             )
-            logger.info(f"💭 Комментарий обновлен для {chat_id}")
+            logger.info("💭 Комментарий обновлен для %s", chat_id)
         else:
             bot.send_message(chat_id, "❌ Ошибка при обновлении.")
             logger.error(f"❌ Ошибка обновления комментария для {chat_id}")
         
-        del user_states[chat_id]
+        state_store.delete(chat_id)
         
     except Exception as e:
         logger.error(f"❌ Ошибка при редактировании комментария: {e}")
         bot.send_message(chat_id, "❌ Произошла ошибка.", reply_markup=main_keyboard())
-        if chat_id in user_states:
-            del user_states[chat_id]
+        state_store.delete(chat_id)
 
 @bot.message_handler(func=lambda message: True)
 def handle_all_messages(message):
     """Обрабатывает все сообщения для отладки"""
-    logger.info(f"📩 ВСЕ СООБЩЕНИЯ: chat_id={message.chat.id}, text='{message.text}'")
+    logger.debug("📩 ВСЕ СООБЩЕНИЯ: chat_id=%s, text='%s'", message.chat.id, message.text)
     
     try:
         # Если сообщение не обработано другими обработчиками
@@ -1194,78 +2143,159 @@ def handle_all_messages(message):
                 f"🤖 Получил: '{message.text}'\n\nИспользуйте кнопки меню 👇",
                 reply_markup=main_keyboard()
             )
-            logger.info(f"✅ Тестовый ответ отправлен для {message.chat.id}")
+            logger.debug("✅ Тестовый ответ отправлен для %s", message.chat.id)
     except Exception as e:
         logger.error(f"❌ Ошибка в handle_all_messages: {e}")
 
 # ========== ОБРАБОТЧИКИ CALLBACK ==========
+def handle_selection(call):
+    """Множественный выбор: отметки, групповые просмотрено/не просмотрено и удаление"""
+    chat_id = call.message.chat.id
+    message_id = call.message.message_id
+    
+    _, action, item_type, direction, cursor, mask, checksum = call.data.split('_')
+    cursor_id = int(cursor) or None
+    mask = int(mask, 16)
+    page_direction = 'prev' if direction == 'p' else 'next'
+    
+    items, _, _ = get_items_page(chat_id, item_type, cursor_id, page_direction)
+    if not items:
+        bot.answer_callback_query(call.id, DEGRADED_ALERT if db.degraded() else "📭 Список пуст")
+        return
+    if page_checksum(items) != checksum:
+        bot.edit_message_reply_markup(chat_id=chat_id, message_id=message_id,
+                                      reply_markup=select_keyboard(items, item_type, direction, cursor_id, 0))
+        bot.answer_callback_query(call.id, "🔄 Список изменился, выбор сброшен")
+        return
+    
+    selected = [item.id for index, item in enumerate(items) if mask >> index & 1]
+    
+    if action == 'v':
+        markup = select_keyboard(items, item_type, direction, cursor_id, mask)
+        notice = None
+    elif action == 'x':
+        markup = render_list_page(chat_id, item_type, cursor_id, page_direction) or list_keyboard([], item_type)
+        notice = None
+    elif action in ('w', 'u'):
+        updated = update_items(chat_id, selected, watched=1 if action == 'w' else 0)
+        if not updated and db.degraded():
+            bot.answer_callback_query(call.id, DEGRADED_ALERT)
+            return
+        # Выбор сохраняется: id на странице не изменились, меняются только отметки просмотра
+        items, _, _ = get_items_page(chat_id, item_type, cursor_id, page_direction)
+        markup = select_keyboard(items, item_type, direction, cursor_id, mask)
+        notice = f"{'✅' if action == 'w' else '👁'} Отмечено: {updated}"
+        logger.info("✅ Групповая отметка %s: %s записей для %s", action, updated, chat_id)
+    elif action == 'd':
+        markup = select_delete_keyboard(item_type, direction, cursor_id, mask, checksum)
+        notice = f"🗑 Удалить выбранные ({len(selected)})? Это действие нельзя отменить."
+    elif action == 'D':
+        deleted = delete_items(chat_id, selected)
+        if not deleted and db.degraded():
+            bot.answer_callback_query(call.id, DEGRADED_ALERT)
+            return
+        markup = render_list_page(chat_id, item_type, cursor_id, page_direction) or list_keyboard([], item_type)
+        notice = f"🗑 Удалено: {deleted}"
+        logger.info("🗑 Групповое удаление: %s записей для %s", deleted, chat_id)
+    else:
+        bot.answer_callback_query(call.id)
+        return
+    
+    bot.edit_message_reply_markup(chat_id=chat_id, message_id=message_id, reply_markup=markup)
+    bot.answer_callback_query(call.id, notice)
+
 @bot.callback_query_handler(func=lambda call: True)
 def handle_callback(call):
     chat_id = call.message.chat.id
     message_id = call.message.message_id
     
-    logger.info(f"🔘 Callback от {chat_id}: {call.data}")
+    logger.info("🔘 Callback от %s: %s", chat_id, call.data)
     
     try:
         if call.data.startswith('item_') or call.data.startswith('series_') or call.data.startswith('movie_'):
             item_id = int(call.data.split('_')[1])
-            item = get_item_by_id(item_id)
-            if item:
+            rendered = render_item(chat_id, item_id)
+            if rendered:
+                text, markup = rendered
                 bot.edit_message_text(
                     chat_id=chat_id,
                     message_id=message_id,
-                    text=format_item_details(item),
+                    text=text,
                     parse_mode='Markdown',
                     disable_web_page_preview=True,
-                    reply_markup=item_keyboard(item_id)
+                    reply_markup=markup
                 )
-                logger.info(f"✅ Детали фильма {item_id} отправлены {chat_id}")
+                logger.debug("✅ Детали фильма %s отправлены %s", item_id, chat_id)
             else:
-                bot.answer_callback_query(call.id, "❌ Запись не найдена")
+                bot.answer_callback_query(call.id, DEGRADED_ALERT if db.degraded() else "❌ Запись не найдена")
                 logger.error(f"❌ Запись не найдена: {item_id}")
         
+        elif call.data.startswith('sel_'):
+            handle_selection(call)
+        
+        elif call.data.startswith('page_'):
+            _, item_type, direction, cursor_id = call.data.split('_')
+            markup = render_list_page(chat_id, item_type, int(cursor_id), 'prev' if direction == 'p' else 'next')
+            if not markup and db.degraded():
+                # Не стираем текущую страницу пустой клавиатурой
+                bot.answer_callback_query(call.id, DEGRADED_ALERT)
+                return
+            bot.edit_message_reply_markup(
+                chat_id=chat_id,
+                message_id=message_id,
+                reply_markup=markup or list_keyboard([], item_type)
+            )
+            bot.answer_callback_query(call.id)
+            logger.debug("📄 Страница списка %s отправлена %s", item_type, chat_id)
+        
         elif call.data.startswith('watch_'):
             item_id = int(call.data.split('_')[1])
-            if update_item(item_id, watched=1):
-                item = get_item_by_id(item_id)
+            updated = update_item(chat_id, item_id, watched=1)
+            if updated == db.QUEUED:
+                bot.answer_callback_query(call.id, QUEUED_ALERT)
+            elif updated:
+                text, markup = render_item(chat_id, item_id)
                 bot.edit_message_text(
                     chat_id=chat_id,
                     message_id=message_id,
-                    text=format_item_details(item),
+                    text=text,
                     parse_mode='Markdown',
                     disable_web_page_preview=True,
-                    reply_markup=item_keyboard(item_id)
+                    reply_markup=markup
                 )
                 bot.answer_callback_query(call.id, "✅ Отмечено как просмотренное")
-                logger.info(f"✅ Фильм {item_id} отмечен как просмотренный для {chat_id}")
+                logger.info("✅ Фильм %s отмечен как просмотренный для %s", item_id, chat_id)
             else:
                 bot.answer_callback_query(call.id, "❌ Ошибка")
                 logger.error(f"❌ Ошибка отметки просмотренного: {item_id}")
         
         elif call.data.startswith('unwatch_'):
             item_id = int(call.data.split('_')[1])
-            if update_item(item_id, watched=0):
-                item = get_item_by_id(item_id)
+            updated = update_item(chat_id, item_id, watched=0)
+            if updated == db.QUEUED:
+                bot.answer_callback_query(call.id, QUEUED_ALERT)
+            elif updated:
+                text, markup = render_item(chat_id, item_id)
                 bot.edit_message_text(
                     chat_id=chat_id,
                     message_id=message_id,
-                    text=format_item_details(item),
+                    text=text,
                     parse_mode='Markdown',
                     disable_web_page_preview=True,
-                    reply_markup=item_keyboard(item_id)
+                    reply_markup=markup
                 )
                 bot.answer_callback_query(call.id, "👁 Отмечено как 'хочу посмотреть'")
-                logger.info(f"✅ Фильм {item_id} отмечен как 'хочу посмотреть' для {chat_id}")
+                logger.info("✅ Фильм %s отмечен как 'хочу посмотреть' для %s", item_id, chat_id)
             else:
                 bot.answer_callback_query(call.id, "❌ Ошибка")
                 logger.error(f"❌ Ошибка отметки 'хочу посмотреть': {item_id}")
         
         elif call.data.startswith('comment_'):
             item_id = int(call.data.split('_')[1])
-            user_states[chat_id] = {'state': 'editing_comment', 'item_id': item_id}
+            state_store.set(chat_id, {'state': 'editing_comment', 'item_id': item_id})
             
-            item = get_item_by_id(item_id)
-            current_comment = item[11] if item and item[11] else "нет комментария"
+            item = get_item_by_id(chat_id, item_id)
+            current_comment = item.comment if item and item.comment else "нет комментария"
             
             bot.delete_message(chat_id, message_id)
             bot.send_message(
@@ -1274,7 +2304,7 @@ def handle_callback(call):
                 parse_mode='Markdown',
                 reply_markup=types.ForceReply(selective=True)
             )
-            logger.info(f"💭 Запрос редактирования комментария для {item_id} от {chat_id}")
+            logger.info("💭 Запрос редактирования комментария для %s от %s", item_id, chat_id)
         
         elif call.data.startswith('delete_'):
             item_id = int(call.data.split('_')[1])
@@ -1290,14 +2320,14 @@ def handle_callback(call):
                 parse_mode='Markdown',
                 reply_markup=markup
             )
-            logger.info(f"🗑 Запрос подтверждения удаления для {item_id} от {chat_id}")
+            logger.info("🗑 Запрос подтверждения удаления для %s от %s", item_id, chat_id)
         
         elif call.data.startswith('confirm_delete_'):
             item_id = int(call.data.split('_')[2])
-            item = get_item_by_id(item_id)
+            item = get_item_by_id(chat_id, item_id)
             if item:
-                title = item[2]
-                if delete_item(item_id):
+                title = item.title
+                if delete_item(chat_id, item_id):
                     bot.edit_message_text(
                         chat_id=chat_id,
                         message_id=message_id,
@@ -1305,7 +2335,7 @@ def handle_callback(call):
                         parse_mode='Markdown'
                     )
                     bot.answer_callback_query(call.id, "✅ Удалено")
-                    logger.info(f"🗑 Фильм {item_id} удален для {chat_id}")
+                    logger.info("🗑 Фильм %s удален для %s", item_id, chat_id)
                 else:
                     bot.answer_callback_query(call.id, "❌ Ошибка при удалении")
                     logger.error(f"❌ Ошибка удаления фильма {item_id}")
@@ -1316,28 +2346,28 @@ def handle_callback(call):
         elif call.data == 'back_to_list' or call.data == 'back_to_main':
             bot.delete_message(chat_id, message_id)
             bot.send_message(chat_id, "Главное меню:", reply_markup=main_keyboard())
-            if chat_id in user_states:
-                del user_states[chat_id]
-            logger.info(f"↩️ Возврат в главное меню по callback от {chat_id}")
+            state_store.delete(chat_id)
+            logger.info("↩️ Возврат в главное меню по callback от %s", chat_id)
         
         elif call.data == 'new_search':
             bot.delete_message(chat_id, message_id)
             start_search(call.message)
-            logger.info(f"🔍 Новый поиск по callback от {chat_id}")
+            logger.info("🔍 Новый поиск по callback от %s", chat_id)
         
         elif call.data.startswith('show_'):
             item_id = int(call.data.split('_')[1])
-            item = get_item_by_id(item_id)
-            if item:
+            rendered = render_item(chat_id, item_id)
+            if rendered:
+                text, markup = rendered
                 bot.edit_message_text(
                     chat_id=chat_id,
                     message_id=message_id,
-                    text=format_item_details(item),
+                    text=text,
                     parse_mode='Markdown',
                     disable_web_page_preview=True,
-                    reply_markup=item_keyboard(item_id)
+                    reply_markup=markup
                 )
-                logger.info(f"✅ Показан фильм {item_id} для {chat_id}")
+                logger.info("✅ Показан фильм %s для %s", item_id, chat_id)
                 
     except Exception as e:
         logger.error(f"❌ Ошибка обработки callback: {e}")
@@ -1349,6 +2379,80 @@ def handle_callback(call):
             pass
 
 # ========== ЗАПУСК ПРИЛОЖЕНИЯ ==========
+def require_token():
+    """Останавливает запуск, если не задан TELEGRAM_TOKEN"""
+    if not TOKEN:
+        logger.error("❌❌❌ ВНИМАНИЕ: TELEGRAM_TOKEN не установлен!")
+        logger.error("❌❌❌ Установите переменную окружения TELEGRAM_TOKEN на Render")
+        exit(1)
+
+def register_webhook():
+    """Регистрирует вебхук, если он еще не указывает на нас"""
+    if not WEBHOOK_URL:
+        logger.warning("⚠️ WEBHOOK_URL не установлен, вебхук не настроен")
+        return False
+    
+    try:
+        webhook_info = bot.get_webhook_info()
+        if webhook_info.url == WEBHOOK_URL and webhook_info.max_connections == WEBHOOK_MAX_CONNECTIONS:
+            logger.info(f"✅ Вебхук уже установлен: {WEBHOOK_URL}")
+            return True
+        
+        logger.info(f"🔧 Настраиваю вебхук на {WEBHOOK_URL}")
+        success = bot.set_webhook(
+            url=WEBHOOK_URL,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            timeout=60
+        )
+        if success:
+            logger.info("✅ Вебхук установлен успешно")
+        else:
+            logger.error("❌ Не удалось установить вебхук")
+        return success
+    except Exception as e:
+        logger.error(f"❌ Ошибка установки вебхука: {e}")
+        return False
+
+def bootstrap():
+    """Разовая подготовка деплоя: схема БД и вебхук.
+
+    Под gunicorn вызывается из мастер-процесса до запуска воркеров
+    (см. gunicorn.conf.py), а не в каждом воркере.
+    """
+    logs.setup_logging()
+    require_token()
+    logger.info(f"🤖 Бот инициализирован с токеном: {TOKEN[:10]}...")
+    
+    if init_db():
+        logger.info("🗄️ База данных: ✅ инициализирована")
+    else:
+        logger.warning("🗄️ База данных: ⚠️ проблемы с инициализацией")
+    
+    register_webhook()
+    
+    # Соединения мастер-процесса не должны достаться воркерам после fork
+    close_pool()
+
+def create_app():
+    """WSGI-приложение для production-сервера (gunicorn wsgi:app)"""
+    logs.setup_logging()
+    require_token()
+    logger.info(f"⏱ Модуль бота загружен за {STARTUP_SECONDS * 1000:.0f} мс")
+    if WEBHOOK_MODE == 'queue':
+        dispatcher.start()
+    if REFRESH_ENABLED:
+        refresher.start()
+    return app
+
+def shutdown(timeout=30.0):
+    """Плавная остановка воркера: дорабатываем принятые обновления и закрываем пул"""
+    logger.info("🛑 Остановка: дорабатываем очередь обновлений...")
+    refresher.stop()
+    dispatcher.shutdown(timeout)
+    close_pool()
+
+STARTUP_SECONDS = time.perf_counter() - IMPORT_STARTED
+
 if __name__ == '__main__':
     print("=" * 60)
     print(f"🚀 Запуск КиноБота в {time.strftime('%Y-%m-%d %H:%M:%S')}")
@@ -1357,47 +2461,14 @@ if __name__ == '__main__':
     print(f"🌐 WEBHOOK_URL: {WEBHOOK_URL or 'не установлен'}")
     print("=" * 60)
     
-    # Инициализируем БД
-    if init_db():
-        print("🗄️  База данных: ✅ инициализирована")
-    else:
-        print("🗄️  База данных: ⚠️ проблемы с инициализацией")
-    
-    # Настраиваем вебхук если есть URL
-    if WEBHOOK_URL:
-        print(f"🔧 Настраиваю вебхук на {WEBHOOK_URL}")
-        try:
-            bot.remove_webhook()
-            time.sleep(1)
-            success = bot.set_webhook(
-                url=WEBHOOK_URL,
-                max_connections=100,
-                timeout=60
-            )
-            if success:
-                print("✅ Вебхук установлен успешно")
-            else:
-                print("❌ Не удалось установить вебхук")
-                
-            # Проверяем вебхук
-            webhook_info = bot.get_webhook_info()
-            print(f"📊 Информация о вебхуке:")
-            print(f"   URL: {webhook_info.url}")
-            print(f"   Ошибок: {webhook_info.last_error_message or 'нет'}")
-            
-        except Exception as e:
-            print(f"❌ Ошибка установки вебхука: {e}")
-    else:
-        print("⚠️ WEBHOOK_URL не установлен, вебхук не настроен")
-        print("ℹ️ На Render это должно устанавливаться автоматически")
+    bootstrap()
     
     # Запускаем сервер
     port = int(os.getenv('PORT', 10000))
-    print(f"🌐 Запуск Flask на порту {port}")
+    print(f"🌐 Запуск Flask (dev-сервер) на порту {port}")
     print(f"🌐 Главная страница: http://0.0.0.0:{port}/")
-    if WEBHOOK_URL:
-        print(f"🌐 Вебхук: {WEBHOOK_URL}")
+    print("ℹ️ Для production: gunicorn -c gunicorn.conf.py wsgi:app")
     print("=" * 60)
     
     # Запускаем Flask
-    app.run(host='0.0.0.0', port=port, debug=False, use_reloader=False, threaded=True)
+    create_app().run(host='0.0.0.0', port=port, debug=False, use_reloader=False, threaded=True)
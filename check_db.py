@@ -33,7 +33,11 @@ except ImportError as e:
 # Пробуем подключиться к БД
 print("\n🔗 Проверка подключения к БД...")
 try:
-    from bot import get_connection, init_db
+    import time
+    started = time.perf_counter()
+    import db
+    from db import get_connection, release_connection, init_db
+    print(f"⏱ Слой данных загружен за {(time.perf_counter() - started) * 1000:.0f} мс")
     
     conn = get_connection()
     if conn:
@@ -45,11 +49,17 @@ try:
         else:
             print("   Тип: PostgreSQL (Supabase)")
         
+        release_connection(conn)
+        
         # Инициализируем БД
         init_db()
         print("✅ Таблицы инициализированы")
         
-        conn.close()
+        import migrations
+        print(f"   Версия схемы: {migrations.current_version()} из {len(migrations.MIGRATIONS)}")
+        
+        if db.pool_stats():
+            print(f"   Пул соединений: {db.pool_stats()}")
     else:
         print("❌ Не удалось подключиться к БД")
         
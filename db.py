@@ -0,0 +1,1861 @@
+"""Слой данных КиноБота: пул соединений, схема и запросы. Не зависит от Telegram и Flask."""
+import os
+import re
+import time
+import json
+import threading
+import sqlite3
+import logging
+from abc import ABC, abstractmethod
+
+from metrics import traced
+
+logger = logging.getLogger(__name__)
+
+# ========== КОНФИГУРАЦИЯ ==========
+DATABASE_URL = os.getenv('DATABASE_URL')
+
+# Настройки пула соединений PostgreSQL
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', 10))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 10))
+DB_POOL_CHECK_IDLE = float(os.getenv('DB_POOL_CHECK_IDLE', 30))
+DB_CONNECT_TIMEOUT = int(os.getenv('DB_CONNECT_TIMEOUT', 5))
+
+# Автомат защиты: после N неудачных подключений или оборванных запросов подряд обращения
+# к PostgreSQL сразу отклоняются, через DB_BREAKER_RESET секунд пробуем одно подключение
+DB_BREAKER_THRESHOLD = int(os.getenv('DB_BREAKER_THRESHOLD', 3))
+DB_BREAKER_RESET = float(os.getenv('DB_BREAKER_RESET', 30))
+
+# Размер страницы в списках фильмов и сериалов
+PAGE_SIZE = int(os.getenv('PAGE_SIZE', 10))
+
+# Сколько строк за раз забирать с сервера при выгрузке
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 1000))
+
+# Чат-владелец записей, созданных до разделения списков по чатам.
+# 0 - оставить без владельца: такие записи не видны ни одному чату, при старте будет предупреждение
+LEGACY_CHAT_ID = int(os.getenv('LEGACY_CHAT_ID', 0))
+
+# Таблица-сводка для статистики, поддерживаемая триггерами
+STATS_SUMMARY = os.getenv('STATS_SUMMARY', '1') == '1'
+
+# Локальная база SQLite: без DATABASE_URL и при недоступности PostgreSQL.
+# ':memory:' - общая база в памяти процесса (для проверок, данные не сохраняются)
+SQLITE_PATH = os.getenv('SQLITE_PATH', 'kinobot.db')
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')  # в режиме WAL NORMAL не теряет целостность
+SQLITE_BUSY_TIMEOUT = float(os.getenv('SQLITE_BUSY_TIMEOUT', 5))
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', 64 * 1024 * 1024))
+SQLITE_CACHE_SIZE = int(os.getenv('SQLITE_CACHE_SIZE', 16 * 1024))  # КиБ на соединение
+
+# Соединения SQLite: по одному на поток
+sqlite_local = threading.local()
+sqlite_connections = set()
+sqlite_lock = threading.Lock()
+
+# Глобальный пул соединений PostgreSQL (создается при первом обращении)
+db_pool = None
+db_pool_lock = threading.Lock()
+
+# ========== НОРМАЛИЗАЦИЯ ==========
+def normalize_title(title):
+    """Приводит название к виду для сравнения: регистр, ё→е, без пунктуации"""
+    text = title.casefold().replace('ё', 'е')
+    text = re.sub(r'[^\w\s]', ' ', text)
+    return ' '.join(text.split())
+
+# ========== ЗАПИСИ ==========
+class Record:
+    """Компактная запись из БД: поля по именам, без словаря у каждого экземпляра"""
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    @classmethod
+    def columns(cls, alias=None):
+        """Список колонок для SELECT в порядке полей"""
+        prefix = f"{alias}." if alias else ""
+        return ", ".join(prefix + name for name in cls.__slots__)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(
+            getattr(self, name) == getattr(other, name) for name in self.__slots__
+        )
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+class Item(Record):
+    """Карточка фильма/сериала со всеми полями"""
+    __slots__ = ('id', 'type', 'title', 'original_title', 'year', 'genre',
+                 'kp_rating', 'imdb_rating', 'kp_url', 'imdb_url', 'watched', 'comment')
+
+class ItemListing(Record):
+    """Строка списка или результатов поиска: только то, что попадает на кнопку"""
+    __slots__ = ('id', 'type', 'title', 'year', 'watched')
+
+# ========== ВЕРСИИ ДАННЫХ ==========
+# Счетчик изменений списка каждого чата в таблице chat_versions: по нему кэши всех
+# воркеров понимают, что данные поменялись. Растет в той же транзакции, что и запись.
+VERSION_UPSERT_SQL = '''
+    ON CONFLICT (chat_id) DO UPDATE SET version = chat_versions.version + 1
+'''
+
+# Свои записи процесс видит сразу по счетчикам в памяти (растут после commit), а таблицу
+# читает не чаще, чем просит вызывающий: так чужие записи видны с задержкой, но чтение
+# кэша не стоит запроса к БД. Эпоха растет при изменениях сразу многих чатов.
+local_versions = {}
+local_epoch = 0
+checked_versions = {}  # chat_id -> (версия в chat_versions, когда прочитана)
+versions_lock = threading.Lock()
+
+def bump_version(cur, is_sqlite, chat_id):
+    """Отмечает изменение списка чата; вызывается до commit пишущей транзакции"""
+    ph = '?' if is_sqlite else '%s'
+    cur.execute(f"INSERT INTO chat_versions (chat_id, version) VALUES ({ph}, 1) {VERSION_UPSERT_SQL}", (chat_id,))
+
+def bump_item_versions(cur, is_sqlite, item_ids):
+    """Отмечает изменение списков всех чатов, которым принадлежат записи"""
+    for condition, ids in id_conditions(is_sqlite, item_ids):
+        cur.execute(f'''
+            INSERT INTO chat_versions (chat_id, version)
+            SELECT DISTINCT chat_id, 1 FROM items WHERE {condition}
+            {VERSION_UPSERT_SQL}
+        ''', ids)
+
+def note_change(chat_id=None):
+    """Отмечает изменение в этом процессе (без chat_id - всех чатов); вызывается после commit"""
+    global local_epoch
+    
+    with versions_lock:
+        if chat_id is None:
+            local_epoch += 1
+        else:
+            local_versions[chat_id] = local_versions.get(chat_id, 0) + 1
+
+def read_version(chat_id):
+    """Версия списка чата из chat_versions (0 - не менялся) или None, если БД недоступна"""
+    conn = get_connection()
+    if not conn:
+        return None
+    
+    cur = conn.cursor()
+    broken = False
+    try:
+        ph = '?' if isinstance(conn, sqlite3.Connection) else '%s'
+        cur.execute(f"SELECT version FROM chat_versions WHERE chat_id = {ph}", (chat_id,))
+        row = cur.fetchone()
+        conn.commit()
+        return row[0] if row else 0
+    except Exception as e:
+        broken = not rollback(conn)
+        logger.error(f"❌ Ошибка чтения версии данных: {e}")
+        return None
+    finally:
+        release_connection(conn, broken=broken)
+
+@traced('db.data_version')
+def data_version(chat_id, max_age=0.0):
+    """Версия данных чата для кэшей или None, если БД недоступна.
+    
+    Таблица chat_versions перечитывается, если прочитанному значению больше max_age секунд.
+    """
+    now = time.monotonic()
+    with versions_lock:
+        checked = checked_versions.get(chat_id)
+    if checked is None or now - checked[1] >= max_age:
+        shared = read_version(chat_id)
+        if shared is None:
+            return None
+        with versions_lock:
+            checked_versions[chat_id] = (shared, now)
+    else:
+        shared = checked[0]
+    with versions_lock:
+        return local_epoch, local_versions.get(chat_id, 0), shared
+
+# ========== ПУЛ СОЕДИНЕНИЙ ==========
+class PoolTimeout(Exception):
+    """Нет свободного соединения в пуле за отведенное время"""
+
+class ConnectionPool:
+    """Потокобезопасный пул соединений PostgreSQL с проверкой здоровья"""
+
+    def __init__(self, connect, minconn=1, maxconn=10, timeout=10.0, check_idle=30.0):
+        self._connect = connect
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.check_idle = check_idle
+        self._idle = []  # (conn, время возврата в пул)
+        self._size = 0
+        self._in_use = 0
+        self._cond = threading.Condition()
+        self.created = 0
+        self.recycled = 0
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+        # Прогреваем пул минимальным числом соединений
+        for _ in range(minconn):
+            conn = self._new_connection()
+            self._idle.append((conn, time.monotonic()))
+            self._size += 1
+
+    def _new_connection(self):
+        conn = self._connect()
+        self.created += 1
+        return conn
+
+    def _is_healthy(self, conn, idle_since):
+        if conn.closed:
+            return False
+        # Пингуем только соединения, которые долго простаивали
+        if time.monotonic() - idle_since < self.check_idle:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT 1')
+            cur.close()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        self.recycled += 1
+
+    def getconn(self):
+        """Выдает соединение из пула, при необходимости ждет или открывает новое"""
+        start = time.monotonic()
+        deadline = start + self.timeout
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn, idle_since = self._idle.pop()
+                    break
+                if self._size < self.maxconn:
+                    conn, idle_since = None, None
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise PoolTimeout(f"нет свободных соединений за {self.timeout} с")
+                self._cond.wait(remaining)
+            self._in_use += 1
+            self.checkouts += 1
+            waited = time.monotonic() - start
+            self.wait_time_total += waited
+            self.wait_time_max = max(self.wait_time_max, waited)
+
+        try:
+            if conn is not None and not self._is_healthy(conn, idle_since):
+                logger.warning("♻️ Соединение из пула неисправно, пересоздаем")
+                self._discard(conn)
+                conn = None
+            if conn is None:
+                conn = self._new_connection()
+            return conn
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+    def putconn(self, conn, broken=False):
+        """Возвращает соединение в пул, сломанные закрывает"""
+        if not broken and not conn.closed:
+            try:
+                # Не оставляем открытых транзакций у соединений в пуле
+                import psycopg2.extensions
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except Exception:
+                broken = True
+
+        with self._cond:
+            self._in_use -= 1
+            if broken or conn.closed:
+                self._size -= 1
+                self._discard(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            for conn, _ in self._idle:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            self._size -= len(self._idle)
+            self._idle = []
+
+    def stats(self):
+        with self._cond:
+            return {
+                'min': self.minconn,
+                'max': self.maxconn,
+                'size': self._size,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'created': self.created,
+                'recycled': self.recycled,
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'wait_time_total': round(self.wait_time_total, 4),
+                'wait_time_avg': round(self.wait_time_total / self.checkouts, 4) if self.checkouts else 0.0,
+                'wait_time_max': round(self.wait_time_max, 4),
+            }
+
+# ========== АВТОМАТ ЗАЩИТЫ ==========
+class CircuitBreaker:
+    """Автомат защиты: closed - работаем, open - сразу отказываем, half_open - пробное подключение"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, threshold=3, reset_timeout=30.0, on_recover=None):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.on_recover = on_recover
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.rejected = 0
+        self.trips = 0
+        self.last_error = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Можно ли сейчас обращаться к БД. В half_open пропускает одного пробующего"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN and not self.probing:
+                self.probing = True
+                return True
+            self.rejected += 1
+            return False
+
+    def succeeded(self):
+        with self._lock:
+            recovered = self.state != self.CLOSED
+            self.state = self.CLOSED
+            self.failures = 0
+            self.probing = False
+        if recovered:
+            logger.info("✅ PostgreSQL снова доступен, автомат защиты закрыт")
+            if self.on_recover:
+                self.on_recover()
+
+    def failed(self, error):
+        with self._lock:
+            self.failures += 1
+            self.probing = False
+            self.last_error = str(error)
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                if self.state != self.OPEN:
+                    self.trips += 1
+                    logger.error(f"🔌 PostgreSQL недоступен, автомат защиты открыт на {self.reset_timeout:.0f} с")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def abandon(self):
+        """Проба не состоялась по причине, не связанной с доступностью БД"""
+        with self._lock:
+            self.probing = False
+
+    def stats(self):
+        with self._lock:
+            return {
+                'state': self.state,
+                'failures': self.failures,
+                'trips': self.trips,
+                'rejected': self.rejected,
+                'retry_in': round(max(0.0, self.opened_at + self.reset_timeout - time.monotonic()), 1)
+                            if self.state == self.OPEN else 0.0,
+                'last_error': self.last_error,
+            }
+
+def connect_postgres():
+    """Открывает новое соединение с PostgreSQL"""
+    import psycopg2
+    from urllib.parse import urlparse
+
+    result = urlparse(DATABASE_URL)
+
+    conn_params = {
+        'host': result.hostname,
+        'port': result.port,
+        'database': result.path[1:],
+        'user': result.username,
+        'password': result.password,
+        'sslmode': 'require',
+        'connect_timeout': DB_CONNECT_TIMEOUT
+    }
+
+    conn = psycopg2.connect(**conn_params)
+    logger.info("✅ Новое соединение с PostgreSQL открыто")
+    return conn
+
+def close_pool():
+    """Закрывает пул и соединения SQLite (перед fork воркеров и при остановке)"""
+    global db_pool
+    
+    with db_pool_lock:
+        if db_pool is not None:
+            db_pool.closeall()
+            db_pool = None
+    close_sqlite()
+
+def pool_stats():
+    """Метрики пула или None, если он еще не создан"""
+    return db_pool.stats() if db_pool else None
+
+def get_pool():
+    """Лениво создает общий пул соединений"""
+    global db_pool
+
+    if db_pool is None:
+        with db_pool_lock:
+            if db_pool is None:
+                logger.info(f"🔗 Создаем пул соединений PostgreSQL ({DB_POOL_MIN}-{DB_POOL_MAX})...")
+                db_pool = ConnectionPool(
+                    connect_postgres,
+                    minconn=DB_POOL_MIN,
+                    maxconn=DB_POOL_MAX,
+                    timeout=DB_POOL_TIMEOUT,
+                    check_idle=DB_POOL_CHECK_IDLE
+                )
+    return db_pool
+
+# ========== ЛОКАЛЬНАЯ БАЗА SQLITE ==========
+def connect_sqlite():
+    """Открывает соединение с локальной базой: WAL, настроенные pragma и ожидание блокировок"""
+    if SQLITE_PATH == ':memory:':
+        # Общий кэш - одна база в памяти для всех потоков процесса
+        conn = sqlite3.connect('file:kinobot?mode=memory&cache=shared', uri=True,
+                               timeout=SQLITE_BUSY_TIMEOUT, check_same_thread=False)
+    else:
+        conn = sqlite3.connect(SQLITE_PATH, timeout=SQLITE_BUSY_TIMEOUT, check_same_thread=False)
+        # WAL: читатели не ждут писателя, запись не блокирует чтение
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute(f"PRAGMA synchronous = {SQLITE_SYNCHRONOUS}")
+        conn.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE}")
+    conn.execute(f"PRAGMA cache_size = -{SQLITE_CACHE_SIZE}")
+    conn.execute(f"PRAGMA busy_timeout = {int(SQLITE_BUSY_TIMEOUT * 1000)}")
+    return conn
+
+def get_sqlite_connection():
+    """Соединение SQLite текущего потока (открывается при первом обращении)"""
+    conn = getattr(sqlite_local, 'conn', None)
+    if conn is None:
+        conn = connect_sqlite()
+        sqlite_local.conn = conn
+        with sqlite_lock:
+            first = not sqlite_connections
+            sqlite_connections.add(conn)
+        if first:
+            logger.info(f"✅ Локальная база SQLite: {SQLITE_PATH}")
+    return conn
+
+def close_sqlite():
+    """Закрывает соединения SQLite всех потоков"""
+    global sqlite_local
+    
+    with sqlite_lock:
+        connections = list(sqlite_connections)
+        sqlite_connections.clear()
+        sqlite_local = threading.local()
+    for conn in connections:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+def reset_sqlite_after_fork():
+    """Соединения SQLite нельзя переносить через fork: дочерний процесс открывает свои"""
+    global sqlite_local, sqlite_lock
+    
+    sqlite_local = threading.local()
+    sqlite_lock = threading.Lock()
+    sqlite_connections.clear()
+
+os.register_at_fork(after_in_child=reset_sqlite_after_fork)
+
+def close_thread_sqlite():
+    """Закрывает соединение SQLite текущего потока (для короткоживущих потоков)"""
+    conn = getattr(sqlite_local, 'conn', None)
+    if conn is None:
+        return
+    sqlite_local.conn = None
+    with sqlite_lock:
+        sqlite_connections.discard(conn)
+    conn.close()
+
+def sqlite_stats():
+    """Метрики локальной базы или None, если она не используется"""
+    with sqlite_lock:
+        connections = len(sqlite_connections)
+    if not connections:
+        return None
+    return {'path': SQLITE_PATH, 'connections': connections}
+
+# ========== БУФЕР ЗАПИСЕЙ ==========
+# Пока PostgreSQL недоступен, добавления и изменения копятся в локальном SQLite
+# и применяются по порядку после восстановления. Воркеры на одной машине делят
+# файл буфера и применяют его по очереди под блокировкой записи SQLite.
+QUEUED = 'queued'
+
+PENDING_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS pending_writes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        op VARCHAR(20) NOT NULL,
+        chat_id BIGINT NOT NULL,
+        payload TEXT NOT NULL,
+        created_at REAL NOT NULL
+    )
+'''
+
+PENDING_BATCH_SIZE = 100
+
+pending_ready = False
+replay_lock = threading.Lock()
+# Есть отложенные записи, которые еще не применены: новые записи тоже идут в буфер,
+# иначе применение старых перезапишет то, что записано напрямую после восстановления
+writes_pending = threading.Event()
+
+def pending_connection():
+    """Соединение с локальным буфером; таблица создается при первом обращении"""
+    global pending_ready
+    
+    conn = get_sqlite_connection()
+    if not pending_ready:
+        conn.execute(PENDING_TABLE_SQL)
+        conn.commit()
+        pending_ready = True
+    return conn
+
+def queue_write(op, chat_id, payload):
+    """Откладывает запись до восстановления PostgreSQL"""
+    try:
+        conn = pending_connection()
+        conn.execute(
+            "INSERT INTO pending_writes (op, chat_id, payload, created_at) VALUES (?, ?, ?, ?)",
+            (op, chat_id, json.dumps(payload, ensure_ascii=False), time.time())
+        )
+        conn.commit()
+        writes_pending.set()
+        logger.warning(f"⏳ {op} для {chat_id} отложено в буфер")
+        if not degraded() and not replay_lock.locked():
+            # Связь уже есть, буфер ждет применения (восстановление прервалось или еще идет)
+            replay_in_background()
+        return True
+    except Exception as e:
+        logger.error(f"❌ Не удалось сохранить запись в буфер: {e}")
+        return False
+
+def pending_writes_count():
+    try:
+        return pending_connection().execute("SELECT COUNT(*) FROM pending_writes").fetchone()[0]
+    except Exception as e:
+        logger.error(f"❌ Ошибка чтения буфера записей: {e}")
+        return None
+
+def apply_pending_write(cur, op, chat_id, payload):
+    if op == 'add_item':
+        columns = ', '.join(payload)
+        placeholders = ', '.join(['%s'] * (len(payload) + 1))
+        cur.execute(f'''
+            INSERT INTO items (chat_id, {columns}) VALUES ({placeholders})
+            ON CONFLICT (chat_id, type, normalized_title) DO NOTHING
+        ''', [chat_id] + list(payload.values()))
+    elif op == 'update_item':
+        fields = payload['fields']
+        assignments = ", ".join(f"{key} = %s" for key in fields)
+        cur.execute(f"UPDATE items SET {assignments} WHERE id = %s AND chat_id = %s",
+                    list(fields.values()) + [payload['item_id'], chat_id])
+    else:
+        raise ValueError(f"неизвестная операция {op}")
+
+def replay_batch(local):
+    """Применяет самую старую пачку буфера. Возвращает (число примененных, пора ли остановиться)"""
+    rows = local.execute(
+        "SELECT id, op, chat_id, payload FROM pending_writes ORDER BY id LIMIT ?", (PENDING_BATCH_SIZE,)
+    ).fetchall()
+    if not rows:
+        return 0, True
+    
+    conn = get_connection()
+    if not conn:
+        return 0, True
+    
+    cur = conn.cursor()
+    done = []
+    try:
+        for row_id, op, chat_id, payload in rows:
+            try:
+                apply_pending_write(cur, op, chat_id, json.loads(payload))
+                bump_version(cur, False, chat_id)
+                conn.commit()
+                note_change(chat_id)
+            except Exception as e:
+                conn.rollback()
+                if conn.closed:
+                    # Соединение потеряно - остальное применим при следующем восстановлении
+                    raise
+                logger.error(f"❌ Отложенная запись {row_id} ({op}) отброшена: {e}")
+            done.append(row_id)
+    except Exception as e:
+        logger.error(f"❌ Применение отложенных записей прервано: {e}")
+        return len(done), True
+    finally:
+        release_connection(conn, broken=bool(conn.closed))
+        if done:
+            local.executemany("DELETE FROM pending_writes WHERE id = ?", [(row_id,) for row_id in done])
+    return len(done), False
+
+def replay_pending_writes():
+    """Применяет отложенные записи к PostgreSQL по порядку. Возвращает число примененных"""
+    if not DATABASE_URL or not replay_lock.acquire(blocking=False):
+        return 0
+    
+    replayed = 0
+    try:
+        local = pending_connection()
+        while True:
+            # BEGIN IMMEDIATE - блокировка записи на весь файл буфера: пачку применяет один
+            # процесс, остальные ждут и забирают уже следующую, так что порядок сохраняется
+            local.execute("BEGIN IMMEDIATE")
+            try:
+                applied, finished = replay_batch(local)
+                if finished and not local.execute("SELECT 1 FROM pending_writes LIMIT 1").fetchone():
+                    # Под блокировкой записи: новая отложенная запись не проскочит между проверкой и сбросом
+                    writes_pending.clear()
+            finally:
+                local.commit()
+            replayed += applied
+            if finished:
+                break
+        
+        if replayed:
+            logger.info(f"✅ Применено отложенных записей: {replayed}")
+        return replayed
+    except Exception as e:
+        logger.error(f"❌ Ошибка буфера записей: {e}")
+        return replayed
+    finally:
+        replay_lock.release()
+
+def replay_in_background():
+    """Применяет буфер в отдельном потоке, чтобы не задерживать запрос, который восстановил связь"""
+    def run():
+        try:
+            # Записи, отложенные, пока шло применение, не ждут следующего восстановления
+            while replay_pending_writes() and writes_pending.is_set() and not degraded():
+                pass
+        finally:
+            close_thread_sqlite()
+    
+    threading.Thread(target=run, name='db-replay', daemon=True).start()
+
+breaker = CircuitBreaker(DB_BREAKER_THRESHOLD, DB_BREAKER_RESET, on_recover=replay_in_background)
+
+def buffering_writes():
+    """Писать в буфер: PostgreSQL недоступен или буфер еще не применен целиком"""
+    return degraded() or writes_pending.is_set()
+
+def database_health():
+    """Состояние основной БД для /health, /stats и /metrics"""
+    if not DATABASE_URL:
+        return {'backend': 'sqlite', 'state': CircuitBreaker.CLOSED}
+    health = breaker.stats()
+    health['backend'] = 'postgres'
+    # Файл буфера появляется только после сбоя: проверка здоровья не должна его создавать
+    if breaker.trips or writes_pending.is_set() or os.path.exists(SQLITE_PATH):
+        health['pending_writes'] = pending_writes_count()
+    else:
+        health['pending_writes'] = 0
+    return health
+
+# ========== БАЗА ДАННЫХ ==========
+@traced('db.connect')
+def get_connection():
+    """Берет соединение с БД из пула. None, если PostgreSQL недоступен"""
+    if not DATABASE_URL:
+        return get_sqlite_connection()
+    
+    # Пока автомат открыт, не тратим время на заведомо неудачное подключение
+    if not breaker.allow():
+        return None
+    
+    try:
+        conn = get_pool().getconn()
+    except PoolTimeout as e:
+        # Пул занят - это перегрузка, а не недоступность сервера
+        breaker.abandon()
+        logger.error(f"❌ Ошибка подключения к PostgreSQL: {e}")
+        return None
+    except Exception as e:
+        breaker.failed(e)
+        logger.error(f"❌ Ошибка подключения к PostgreSQL: {e}")
+        return None
+    
+    # Успех или сбой засчитывается при возврате: соединение из пула могло умереть, пока простаивало
+    return conn
+
+def degraded():
+    """PostgreSQL недоступен: чтение невозможно, запись копится в буфере"""
+    return bool(DATABASE_URL) and breaker.state != CircuitBreaker.CLOSED
+
+def rollback(conn):
+    """Откатывает транзакцию после ошибки. False - соединение умерло, в пул его не возвращаем"""
+    try:
+        conn.rollback()
+        return True
+    except Exception as e:
+        logger.warning(f"⚠️ Откат не удался, соединение будет закрыто: {e}")
+        return False
+
+def release_connection(conn, broken=False):
+    """Возвращает соединение в пул (соединение SQLite остается у потока)"""
+    if conn is None:
+        return
+    if isinstance(conn, sqlite3.Connection):
+        if broken:
+            try:
+                conn.rollback()
+            except sqlite3.Error:
+                pass
+        return
+    if conn.closed:
+        # psycopg2 закрывает соединение, если запрос оборвался с OperationalError на уровне связи
+        breaker.failed('соединение с PostgreSQL потеряно во время запроса')
+    else:
+        breaker.succeeded()
+    get_pool().putconn(conn, broken=broken)
+
+def init_db():
+    """Применяет миграции схемы и готовит данные к работе"""
+    logger.info("🔄 Инициализация базы данных...")
+    
+    # migrations импортирует этот модуль, поэтому импорт внутри функции
+    from migrations import run_migrations
+    if not run_migrations():
+        return False
+    
+    conn = get_connection()
+    if not conn:
+        logger.error("❌ Не удалось подключиться к БД")
+        return False
+    
+    cur = conn.cursor()
+    
+    try:
+        global search_backend
+        is_sqlite = isinstance(conn, sqlite3.Connection)
+        ph = '?' if is_sqlite else '%s'
+        
+        cur.execute(f"DELETE FROM lookup_cache WHERE expires_at < {ph}", (time.time(),))
+        
+        if LEGACY_CHAT_ID:
+            cur.execute(f"UPDATE items SET chat_id = {ph} WHERE chat_id = 0", (LEGACY_CHAT_ID,))
+            if cur.rowcount > 0:
+                logger.info(f"✅ Записи без владельца ({cur.rowcount}) переданы чату {LEGACY_CHAT_ID}")
+        else:
+            cur.execute("SELECT COUNT(*) FROM items WHERE chat_id = 0")
+            orphaned = cur.fetchone()[0]
+            if orphaned:
+                # Без владельца записи не видны ни в одном чате
+                logger.warning(f"⚠️ {orphaned} записей без владельца не видны ни одному чату - задайте LEGACY_CHAT_ID")
+        
+        init_stats_summary(cur, is_sqlite)
+        # Движок поиска определится заново по схеме после миграций
+        search_backend = None
+        
+        conn.commit()
+        logger.info("✅ База данных инициализирована")
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"❌ Ошибка БД: {e}")
+        import traceback
+        traceback.print_exc()
+        return False
+    finally:
+        release_connection(conn)
+    
+    # Записи, отложенные до прошлой остановки
+    replay_pending_writes()
+    return True
+
+# ========== ПОИСКОВЫЕ ИНДЕКСЫ ==========
+# Движок поиска определяется по схеме при первом обращении: fts5, trigram или like
+search_backend = None
+
+def get_search_backend(cur, is_sqlite):
+    """Определяет доступный движок поиска по схеме БД"""
+    global search_backend
+    
+    if search_backend is None:
+        if is_sqlite:
+            cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'items_fts'")
+            search_backend = 'fts5' if cur.fetchone() else 'like'
+        else:
+            cur.execute("SELECT 1 FROM pg_indexes WHERE indexname = 'idx_items_title_trgm'")
+            search_backend = 'trigram' if cur.fetchone() else 'like'
+    return search_backend
+
+# Ключ чата в индексе items_fts (миграция 17)
+FTS_CHAT_KEY_SQL = "'c' || {table}.chat_id || 'c'"
+
+def fts_chat_key(chat_id):
+    return f"c{chat_id}c"
+
+def like_pattern(term):
+    """Экранирует спецсимволы LIKE в поисковом запросе"""
+    term = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f"%{term}%"
+
+# ========== ДУБЛИКАТЫ ==========
+@traced('db.find_item_id')
+def find_item_id(chat_id, item_type, title):
+    """Ищет в списке чата запись с тем же нормализованным названием (один проход по индексу)"""
+    conn = get_connection()
+    if not conn:
+        logger.error("❌ Нет подключения к БД")
+        return None
+    
+    cur = conn.cursor()
+    try:
+        if isinstance(conn, sqlite3.Connection):
+            cur.execute("SELECT id FROM items WHERE chat_id = ? AND type = ? AND normalized_title = ?", (chat_id, item_type, normalize_title(title)))
+        else:
+            cur.execute("SELECT id FROM items WHERE chat_id = %s AND type = %s AND normalized_title = %s", (chat_id, item_type, normalize_title(title)))
+        result = cur.fetchone()
+        return result[0] if result else None
+    except Exception as e:
+        logger.error(f"❌ Ошибка при поиске дубликата: {e}")
+        return None
+    finally:
+        release_connection(conn)
+
+@traced('db.existing_titles')
+def existing_titles(chat_id, item_type=None):
+    """Нормализованные названия из списка чата одним запросом (покрывающий индекс).
+
+    None, если БД недоступна.
+    """
+    conn = get_connection()
+    if not conn:
+        logger.error("❌ Нет подключения к БД")
+        return None
+    
+    cur = conn.cursor()
+    try:
+        ph = '?' if isinstance(conn, sqlite3.Connection) else '%s'
+        if item_type:
+            cur.execute(f"SELECT normalized_title FROM items WHERE chat_id = {ph} AND type = {ph}", (chat_id, item_type))
+        else:
+            cur.execute(f"SELECT normalized_title FROM items WHERE chat_id = {ph}", (chat_id,))
+        return {row[0] for row in cur.fetchall() if row[0]}
+    except Exception as e:
+        logger.error(f"❌ Ошибка при чтении названий списка: {e}")
+        return None
+    finally:
+        release_connection(conn)
+
+@traced('db.add_item')
+def add_item(chat_id, item_type, title, original_title, year, genre=None, kp_rating=None, imdb_rating=None, kp_url=None, imdb_url=None):
+    """Добавляет фильм/сериал в список чата; если такое название уже есть, возвращает None.
+    
+    Если PostgreSQL недоступен или буфер еще не применен, запись откладывается и возвращается QUEUED.
+    """
+    logger.debug("➕ Добавление: %s (тип: %s, год: %s, жанр: %s)", title, item_type, year, genre)
+    
+    buffered = buffering_writes()
+    conn = None if buffered else get_connection()
+    if not conn:
+        if buffered or degraded():
+            payload = {
+                'type': item_type, 'title': title, 'original_title': original_title, 'year': year,
+                'genre': genre, 'kp_rating': kp_rating, 'imdb_rating': imdb_rating,
+                'kp_url': kp_url, 'imdb_url': imdb_url, 'normalized_title': normalize_title(title),
+            }
+            return QUEUED if queue_write('add_item', chat_id, payload) else None
+        logger.error("❌ Нет подключения к БД")
+        return None
+    
+    cur = conn.cursor()
+    broken = False
+    try:
+        is_sqlite = isinstance(conn, sqlite3.Connection)
+        normalized = normalize_title(title)
+        
+        # Уникальный индекс (chat_id, type, normalized_title) не дает гонке двух добавлений создать дубль
+        if is_sqlite:
+            cur.execute('''
+                INSERT INTO items (chat_id, type, title, original_title, year, genre, kp_rating, imdb_rating, kp_url, imdb_url, normalized_title) 
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (chat_id, type, normalized_title) DO NOTHING
+            ''', (chat_id, item_type, title, original_title, year, genre, kp_rating, imdb_rating, kp_url, imdb_url, normalized))
+            result = (cur.lastrowid,) if cur.rowcount > 0 else None
+        else:
+            cur.execute('''
+                INSERT INTO items (chat_id, type, title, original_title, year, genre, kp_rating, imdb_rating, kp_url, imdb_url, normalized_title) 
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (chat_id, type, normalized_title) DO NOTHING
+                RETURNING id
+            ''', (chat_id, item_type, title, original_title, year, genre, kp_rating, imdb_rating, kp_url, imdb_url, normalized))
+            result = cur.fetchone()
+        
+        if result:
+            bump_version(cur, is_sqlite, chat_id)
+        conn.commit()
+        
+        if result:
+            item_id = result[0]
+            note_change(chat_id)
+            logger.info("✅ Успешно добавлено с ID: %s", item_id)
+            return item_id
+        else:
+            logger.warning(f"⚠️ Элемент не добавлен: '{title}' уже есть в списке")
+            return None
+            
+    except Exception as e:
+        broken = not rollback(conn)
+        logger.error(f"❌ Ошибка при добавлении в БД: {e}")
+        import traceback
+        traceback.print_exc()
+        return None
+    finally:
+        release_connection(conn, broken=broken)
+
+ITEM_COLUMNS = ('chat_id', 'type', 'title', 'original_title', 'year', 'genre', 'kp_rating', 'imdb_rating', 'kp_url', 'imdb_url', 'normalized_title')
+BULK_CHUNK_SIZE = 90  # 90 строк x 11 колонок укладываются в лимит параметров старых SQLite (999)
+
+@traced('db.add_items_bulk')
+def add_items_bulk(chat_id, items):
+    """Добавляет много записей в список чата многострочными INSERT в одной транзакции.
+
+    items - словари с ключами как у add_item (type, title, original_title, ...).
+    Дубликаты (в том числе уже сохраненные) пропускаются. Возвращает число добавленных
+    или None, если записать не удалось.
+    """
+    if not items:
+        return 0
+    
+    conn = get_connection()
+    if not conn:
+        logger.error("❌ Нет подключения к БД")
+        return None
+    
+    cur = conn.cursor()
+    broken = False
+    try:
+        is_sqlite = isinstance(conn, sqlite3.Connection)
+        ph = '?' if is_sqlite else '%s'
+        row_placeholders = "(" + ", ".join([ph] * len(ITEM_COLUMNS)) + ")"
+        inserted = 0
+        
+        for start in range(0, len(items), BULK_CHUNK_SIZE):
+            chunk = items[start:start + BULK_CHUNK_SIZE]
+            values = []
+            for item in chunk:
+                values.append(chat_id)
+                values.extend(item.get(column) for column in ITEM_COLUMNS[1:-1])
+                values.append(normalize_title(item['title']))
+            
+            query = f'''
+                INSERT INTO items ({", ".join(ITEM_COLUMNS)})
+                VALUES {", ".join([row_placeholders] * len(chunk))}
+                ON CONFLICT (chat_id, type, normalized_title) DO NOTHING
+            '''
+            if is_sqlite:
+                cur.execute(query, values)
+                inserted += cur.rowcount
+            else:
+                cur.execute(query + " RETURNING id", values)
+                inserted += len(cur.fetchall())
+        
+        if inserted:
+            bump_version(cur, is_sqlite, chat_id)
+        conn.commit()
+        if inserted:
+            note_change(chat_id)
+        logger.info(f"✅ Пакетно добавлено {inserted} из {len(items)} записей")
+        return inserted
+    except Exception as e:
+        broken = not rollback(conn)
+        logger.error(f"❌ Ошибка при пакетном добавлении: {e}")
+        import traceback
+        traceback.print_exc()
+        return None
+    finally:
+        release_connection(conn, broken=broken)
+
+EXPORT_COLUMNS = ('id', 'type', 'title', 'original_title', 'year', 'genre', 'kp_rating', 'imdb_rating', 'kp_url', 'imdb_url', 'watched', 'comment')
+
+def iter_items(chat_id, item_type=None, batch_size=EXPORT_BATCH_SIZE):
+    """Построчно отдает записи чата для выгрузки, не загружая весь список в память.
+    
+    В PostgreSQL используется именованный (серверный) курсор, в SQLite - fetchmany.
+    Соединение держится до конца итерации или закрытия генератора. Без подключения
+    бросает ConnectionError, чтобы пустой список не путался с недоступной базой.
+    """
+    conn = get_connection()
+    if not conn:
+        logger.error("❌ Нет подключения к БД")
+        raise ConnectionError("нет подключения к БД")
+    
+    is_sqlite = isinstance(conn, sqlite3.Connection)
+    placeholder = '?' if is_sqlite else '%s'
+    sql = f"SELECT {', '.join(EXPORT_COLUMNS)} FROM items WHERE chat_id = {placeholder}"
+    params = (chat_id,)
+    if item_type:
+        sql += f" AND type = {placeholder}"
+        params = (chat_id, item_type)
+    sql += " ORDER BY type, title, id"
+    
+    broken = False
+    if is_sqlite:
+        cur = conn.cursor()
+    else:
+        cur = conn.cursor(name='export_items')
+        cur.itersize = batch_size
+    try:
+        cur.execute(sql, params)
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
+    except Exception as e:
+        logger.error(f"❌ Ошибка при выгрузке данных: {e}")
+        broken = not is_sqlite
+        raise
+    finally:
+        try:
+            cur.close()
+            if not is_sqlite:
+                # Серверный курсор живет внутри транзакции, закрываем ее
+                conn.rollback()
+        except Exception:
+            broken = not is_sqlite
+        release_connection(conn, broken=broken)
+
+@traced('db.get_items_page')
+def get_items_page(chat_id, item_type, cursor_id=None, direction='next', limit=PAGE_SIZE):
+    """Получает одну страницу списка чата по курсору (title, id).
+
+    Курсор - id крайней записи предыдущей страницы, ее название берется
+    подзапросом. Возвращает (строки ItemListing, есть_предыдущая, есть_следующая).
+    """
+    conn = get_connection()
+    if not conn:
+        logger.error("❌ Нет подключения к БД")
+        return [], False, False
+    
+    cur = conn.cursor()
+    try:
+        is_sqlite = isinstance(conn, sqlite3.Connection)
+        ph = '?' if is_sqlite else '%s'
+        columns = ItemListing.columns()
+        backwards = cursor_id is not None and direction == 'prev'
+        
+        if cursor_id is None:
+            cur.execute(f'''
+                SELECT {columns} FROM items
+                WHERE chat_id = {ph} AND type = {ph}
+                ORDER BY title, id
+                LIMIT {ph}
+            ''', (chat_id, item_type, limit + 1))
+        else:
+            op, order = ('<', 'DESC') if backwards else ('>', 'ASC')
+            cur.execute(f'''
+                SELECT {columns} FROM items
+                WHERE chat_id = {ph} AND type = {ph}
+                  AND (title, id) {op} (SELECT title, id FROM items WHERE id = {ph} AND chat_id = {ph})
+                ORDER BY title {order}, id {order}
+                LIMIT {ph}
+            ''', (chat_id, item_type, cursor_id, chat_id, limit + 1))
+        
+        rows = cur.fetchall()
+        has_more = len(rows) > limit
+        rows = [ItemListing(*row) for row in rows[:limit]]
+        
+        if cursor_id is None:
+            return rows, False, has_more
+        if not rows:
+            # Запись-курсор удалена или страница опустела - начинаем сначала
+            release_connection(conn)
+            conn = None
+            return get_items_page(chat_id, item_type, limit=limit)
+        if backwards:
+            return list(reversed(rows)), has_more, True
+        return rows, True, has_more
+    except Exception as e:
+        logger.error(f"❌ Ошибка при получении страницы: {e}")
+        return [], False, False
+    finally:
+        release_connection(conn)
+
+@traced('db.search_items')
+def search_items(chat_id, search_term, search_type=None, limit=50):
+    """Ищет фильмы/сериалы в списке чата по названию, лучшие совпадения первыми (строки ItemListing)"""
+    conn = get_connection()
+    if not conn:
+        logger.error("❌ Нет подключения к БД")
+        return []
+    
+    cur = conn.cursor()
+    try:
+        is_sqlite = isinstance(conn, sqlite3.Connection)
+        term = search_term.lower()
+        backend = get_search_backend(cur, is_sqlite)
+        columns = ItemListing.columns('i')
+        
+        if backend == 'fts5' and len(term) >= 3:
+            # Триграммный FTS5 индекс, ранжирование по bm25. Чат входит в MATCH,
+            # чтобы не перебирать совпадения из чужих списков; колонка чата в ранг не входит
+            phrase = '"' + term.replace('"', '""') + '"'
+            match = f'chat_key : "{fts_chat_key(chat_id)}" AND {{title original_title}} : {phrase}'
+            type_clause = "AND i.type = ?" if search_type else ""
+            params = [match, chat_id] + ([search_type] if search_type else []) + [limit]
+            cur.execute(f'''
+                SELECT {columns}
+                FROM items_fts JOIN items i ON i.id = items_fts.rowid
+                WHERE items_fts MATCH ? AND i.chat_id = ? {type_clause}
+                ORDER BY bm25(items_fts, 1.0, 1.0, 0.0), i.title
+                LIMIT ?
+            ''', params)
+        elif backend == 'trigram':
+            # LIKE по выражению LOWER(...) использует GIN индексы pg_trgm, ранжируем по similarity
+            pattern = like_pattern(term)
+            type_clause = "i.type = %s AND" if search_type else ""
+            params = [chat_id] + ([search_type] if search_type else []) + [pattern, pattern, term, term, limit]
+            cur.execute(f'''
+                SELECT {columns}
+                FROM items i
+                WHERE i.chat_id = %s AND {type_clause} (LOWER(i.title) LIKE %s OR LOWER(i.original_title) LIKE %s)
+                ORDER BY GREATEST(similarity(LOWER(i.title), %s), similarity(LOWER(COALESCE(i.original_title, '')), %s)) DESC, i.title
+                LIMIT %s
+            ''', params)
+        else:
+            # Запасной вариант без индекса (короткие запросы, нет FTS5/pg_trgm)
+            pattern = like_pattern(term)
+            ph = '?' if is_sqlite else '%s'
+            type_clause = f"i.type = {ph} AND" if search_type else ""
+            order = "i.title" if search_type else "i.type, i.title"
+            params = [chat_id] + ([search_type] if search_type else []) + [pattern, pattern, limit]
+            cur.execute(f'''
+                SELECT {columns}
+                FROM items i
+                WHERE i.chat_id = {ph} AND {type_clause} (LOWER(i.title) LIKE {ph} ESCAPE '\\' OR LOWER(i.original_title) LIKE {ph} ESCAPE '\\')
+                ORDER BY {order}
+                LIMIT {ph}
+            ''', params)
+        
+        results = [ItemListing(*row) for row in cur.fetchall()]
+        logger.debug("🔍 Найдено результатов: %s (%s)", len(results), backend)
+        return results
+        
+    except Exception as e:
+        logger.error(f"❌ Ошибка при поиске: {e}")
+        import traceback
+        traceback.print_exc()
+        return []
+    finally:
+        release_connection(conn)
+
+@traced('db.get_item_by_id')
+def get_item_by_id(chat_id, item_id):
+    """Получает запись чата по ID (Item или None)"""
+    conn = get_connection()
+    if not conn:
+        logger.error("❌ Нет подключения к БД")
+        return None
+    
+    cur = conn.cursor()
+    try:
+        is_sqlite = isinstance(conn, sqlite3.Connection)
+        
+        if is_sqlite:
+            cur.execute(f"SELECT {Item.columns()} FROM items WHERE id = ? AND chat_id = ?", (item_id, chat_id))
+        else:
+            cur.execute(f"SELECT {Item.columns()} FROM items WHERE id = %s AND chat_id = %s", (item_id, chat_id))
+        row = cur.fetchone()
+        return Item(*row) if row else None
+    except Exception as e:
+        logger.error(f"❌ Ошибка при получении элемента: {e}")
+        return None
+    finally:
+        release_connection(conn)
+
+@traced('db.update_item')
+def update_item(chat_id, item_id, **kwargs):
+    """Обновляет данные записи чата. Пока пишем в буфер (см. buffering_writes), откладывает и возвращает QUEUED"""
+    if not kwargs:
+        return False
+    
+    if 'title' in kwargs:
+        kwargs['normalized_title'] = normalize_title(kwargs['title'])
+    
+    buffered = buffering_writes()
+    conn = None if buffered else get_connection()
+    if not conn:
+        if (buffered or degraded()) and queue_write('update_item', chat_id, {'item_id': item_id, 'fields': kwargs}):
+            return QUEUED
+        return False
+    
+    cur = conn.cursor()
+    broken = False
+    try:
+        is_sqlite = isinstance(conn, sqlite3.Connection)
+        
+        if is_sqlite:
+            set_clause = ", ".join([f"{key} = ?" for key in kwargs.keys()])
+            values = list(kwargs.values())
+            values.extend([item_id, chat_id])
+            
+            cur.execute(f"UPDATE items SET {set_clause} WHERE id = ? AND chat_id = ?", values)
+        else:
+            set_clause = ", ".join([f"{key} = %s" for key in kwargs.keys()])
+            values = list(kwargs.values())
+            values.extend([item_id, chat_id])
+            
+            cur.execute(f"UPDATE items SET {set_clause} WHERE id = %s AND chat_id = %s", values)
+        
+        updated = cur.rowcount > 0
+        if updated:
+            bump_version(cur, is_sqlite, chat_id)
+        conn.commit()
+        if updated:
+            note_change(chat_id)
+        return updated
+    except Exception as e:
+        broken = not rollback(conn)
+        logger.error(f"❌ Ошибка при обновлении: {e}")
+        return False
+    finally:
+        release_connection(conn, broken=broken)
+
+@traced('db.delete_item')
+def delete_item(chat_id, item_id):
+    """Удаляет запись чата"""
+    conn = get_connection()
+    if not conn:
+        logger.error("❌ Нет подключения к БД")
+        return False
+    
+    cur = conn.cursor()
+    broken = False
+    try:
+        is_sqlite = isinstance(conn, sqlite3.Connection)
+        
+        if is_sqlite:
+            cur.execute("DELETE FROM items WHERE id = ? AND chat_id = ?", (item_id, chat_id))
+        else:
+            cur.execute("DELETE FROM items WHERE id = %s AND chat_id = %s", (item_id, chat_id))
+        
+        deleted = cur.rowcount > 0
+        if deleted:
+            bump_version(cur, is_sqlite, chat_id)
+        conn.commit()
+        if deleted:
+            note_change(chat_id)
+        return deleted
+    except Exception as e:
+        broken = not rollback(conn)
+        logger.error(f"❌ Ошибка при удалении: {e}")
+        return False
+    finally:
+        release_connection(conn, broken=broken)
+
+# ========== ГРУППОВЫЕ ОПЕРАЦИИ ==========
+ID_CHUNK_SIZE = 500  # с запасом меньше лимита параметров старых SQLite (999)
+
+def id_conditions(is_sqlite, item_ids):
+    """Условие по списку id: одно id = ANY(%s) в PostgreSQL, IN (?, ...) частями в SQLite"""
+    item_ids = list(item_ids)
+    if not is_sqlite:
+        yield "id = ANY(%s)", [item_ids]
+        return
+    for start in range(0, len(item_ids), ID_CHUNK_SIZE):
+        chunk = item_ids[start:start + ID_CHUNK_SIZE]
+        yield f"id IN ({', '.join('?' * len(chunk))})", chunk
+
+@traced('db.update_items')
+def update_items(chat_id, item_ids, **kwargs):
+    """Обновляет несколько записей чата одной транзакцией. Возвращает число обновленных"""
+    if not item_ids or not kwargs:
+        return 0
+    
+    conn = get_connection()
+    if not conn:
+        logger.error("❌ Нет подключения к БД")
+        return 0
+    
+    cur = conn.cursor()
+    broken = False
+    try:
+        is_sqlite = isinstance(conn, sqlite3.Connection)
+        ph = '?' if is_sqlite else '%s'
+        assignments = ", ".join(f"{key} = {ph}" for key in kwargs)
+        updated = 0
+        for condition, ids in id_conditions(is_sqlite, item_ids):
+            cur.execute(f"UPDATE items SET {assignments} WHERE chat_id = {ph} AND {condition}",
+                        list(kwargs.values()) + [chat_id] + ids)
+            updated += cur.rowcount
+        
+        if updated:
+            bump_version(cur, is_sqlite, chat_id)
+        conn.commit()
+        if updated:
+            note_change(chat_id)
+        logger.info(f"✅ Групповое обновление: {updated} из {len(item_ids)} записей")
+        return updated
+    except Exception as e:
+        broken = not rollback(conn)
+        logger.error(f"❌ Ошибка при групповом обновлении: {e}")
+        return 0
+    finally:
+        release_connection(conn, broken=broken)
+
+@traced('db.delete_items')
+def delete_items(chat_id, item_ids):
+    """Удаляет несколько записей чата одной транзакцией. Возвращает число удаленных"""
+    if not item_ids:
+        return 0
+    
+    conn = get_connection()
+    if not conn:
+        logger.error("❌ Нет подключения к БД")
+        return 0
+    
+    cur = conn.cursor()
+    broken = False
+    try:
+        is_sqlite = isinstance(conn, sqlite3.Connection)
+        ph = '?' if is_sqlite else '%s'
+        deleted = 0
+        for condition, ids in id_conditions(is_sqlite, item_ids):
+            cur.execute(f"DELETE FROM items WHERE chat_id = {ph} AND {condition}", [chat_id] + ids)
+            deleted += cur.rowcount
+        
+        if deleted:
+            bump_version(cur, is_sqlite, chat_id)
+        conn.commit()
+        if deleted:
+            note_change(chat_id)
+        logger.info(f"🗑 Групповое удаление: {deleted} из {len(item_ids)} записей")
+        return deleted
+    except Exception as e:
+        broken = not rollback(conn)
+        logger.error(f"❌ Ошибка при групповом удалении: {e}")
+        return 0
+    finally:
+        release_connection(conn, broken=broken)
+
+# ========== ОБНОВЛЕНИЕ МЕТАДАННЫХ ==========
+# Возраст метаданных: когда их обновляли последний раз, а если не обновляли - когда добавили
+METADATA_AGE_SQL = "COALESCE(metadata_updated_at, added_date)"
+METADATA_COLUMNS = ('original_title', 'year', 'genre', 'kp_rating', 'imdb_rating', 'kp_url', 'imdb_url')
+
+@traced('db.claim_stale_items')
+def claim_stale_items(limit, max_age, missing_age, lease):
+    """Берет в аренду самые устаревшие записи.
+    
+    Записи без рейтингов считаются устаревшими через missing_age секунд, остальные -
+    через max_age. Аренда (refresh_claimed_at) не дает двум воркерам обновлять одно и
+    то же и истекает через lease секунд, если воркер не вернул запись.
+    Возвращает строки (id, type, title, *METADATA_COLUMNS).
+    """
+    conn = get_connection()
+    if not conn:
+        logger.error("❌ Нет подключения к БД")
+        return []
+    
+    cur = conn.cursor()
+    broken = False
+    try:
+        is_sqlite = isinstance(conn, sqlite3.Connection)
+        columns = ", ".join(('id', 'type', 'title') + METADATA_COLUMNS)
+        
+        if is_sqlite:
+            cutoff = "datetime('now', ?)"
+            params = (f"-{int(max_age)} seconds", f"-{int(missing_age)} seconds", f"-{int(lease)} seconds", limit)
+        else:
+            cutoff = "CURRENT_TIMESTAMP - %s * INTERVAL '1 second'"
+            params = (max_age, missing_age, lease, limit)
+        where = f'''
+            ({METADATA_AGE_SQL} < {cutoff}
+             OR (kp_rating IS NULL AND imdb_rating IS NULL AND {METADATA_AGE_SQL} < {cutoff}))
+            AND (refresh_claimed_at IS NULL OR refresh_claimed_at < {cutoff})
+        '''
+        
+        if is_sqlite:
+            cur.execute(f'''
+                SELECT {columns} FROM items WHERE {where}
+                ORDER BY {METADATA_AGE_SQL}, id LIMIT ?
+            ''', params)
+            rows = cur.fetchall()
+            if rows:
+                ids = [row[0] for row in rows]
+                cur.execute(f'''
+                    UPDATE items SET refresh_claimed_at = CURRENT_TIMESTAMP
+                    WHERE id IN ({", ".join("?" * len(ids))})
+                ''', ids)
+        else:
+            # SKIP LOCKED: параллельный воркер возьмет следующую пачку, а не будет ждать
+            cur.execute(f'''
+                UPDATE items SET refresh_claimed_at = CURRENT_TIMESTAMP
+                WHERE id IN (
+                    SELECT id FROM items WHERE {where}
+                    ORDER BY {METADATA_AGE_SQL}, id LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING {columns}
+            ''', params)
+            rows = cur.fetchall()
+        
+        conn.commit()
+        return rows
+    except Exception as e:
+        broken = not rollback(conn)
+        logger.error(f"❌ Ошибка при выборке устаревших записей: {e}")
+        return []
+    finally:
+        release_connection(conn, broken=broken)
+
+@traced('db.update_items_metadata')
+def update_items_metadata(changes, checked_ids=(), released_ids=()):
+    """Записывает итог прохода фонового обновления одной транзакцией.
+    
+    changes - словарь {id: {колонка: значение}}. Проверенным записям (checked_ids)
+    ставится metadata_updated_at, с непроверенных (released_ids) аренда просто
+    снимается, и они попадут в следующий проход. Возвращает число измененных записей.
+    """
+    checked_ids = list(dict.fromkeys(list(checked_ids) + list(changes)))
+    released_ids = [item_id for item_id in released_ids if item_id not in changes]
+    if not checked_ids and not released_ids:
+        return 0
+    
+    conn = get_connection()
+    if not conn:
+        logger.error("❌ Нет подключения к БД")
+        return 0
+    
+    cur = conn.cursor()
+    broken = False
+    try:
+        is_sqlite = isinstance(conn, sqlite3.Connection)
+        ph = '?' if is_sqlite else '%s'
+        updated_ids = []
+        for item_id, fields in changes.items():
+            fields = {key: value for key, value in fields.items() if key in METADATA_COLUMNS}
+            if not fields:
+                continue
+            assignments = ", ".join(f"{key} = {ph}" for key in fields)
+            cur.execute(f"UPDATE items SET {assignments} WHERE id = {ph}", list(fields.values()) + [item_id])
+            if cur.rowcount > 0:
+                updated_ids.append(item_id)
+        
+        if checked_ids:
+            cur.execute(f'''
+                UPDATE items SET metadata_updated_at = CURRENT_TIMESTAMP, refresh_claimed_at = NULL
+                WHERE id IN ({", ".join([ph] * len(checked_ids))})
+            ''', checked_ids)
+        if released_ids:
+            cur.execute(f'''
+                UPDATE items SET refresh_claimed_at = NULL
+                WHERE id IN ({", ".join([ph] * len(released_ids))})
+            ''', released_ids)
+        
+        if updated_ids:
+            # Обновление затрагивает записи разных чатов
+            bump_item_versions(cur, is_sqlite, updated_ids)
+        conn.commit()
+        if updated_ids:
+            note_change()
+        return len(updated_ids)
+    except Exception as e:
+        broken = not rollback(conn)
+        logger.error(f"❌ Ошибка при обновлении метаданных: {e}")
+        return 0
+    finally:
+        release_connection(conn, broken=broken)
+
+# ========== СТАТИСТИКА ==========
+# Группировка статистики: тип, десятилетие (первые 3 цифры года), строка жанров
+STATS_VALUES_SQL = '''
+    type, COALESCE(SUBSTR(year, 1, 3), '') AS decade, COALESCE(genre, '') AS genre,
+    COUNT(*), SUM(CASE WHEN watched <> 0 THEN 1 ELSE 0 END),
+    COALESCE(SUM(kp_rating), 0), COUNT(kp_rating),
+    COALESCE(SUM(imdb_rating), 0), COUNT(imdb_rating)
+'''
+# Пересборка сводки для всех чатов сразу
+STATS_GROUP_SQL = f"SELECT chat_id, {STATS_VALUES_SQL} FROM items GROUP BY 1, 2, 3, 4"
+
+SUMMARY_VALUES = "type, decade, genre, total, watched, kp_sum, kp_count, imdb_sum, imdb_count"
+SUMMARY_COLUMNS = f"chat_id, {SUMMARY_VALUES}"
+
+def summary_upsert_sql(row, sign):
+    """SQL для прибавления (sign=1) или вычитания (sign=-1) строки items в сводке"""
+    return f'''
+        INSERT INTO items_summary ({SUMMARY_COLUMNS}) VALUES (
+            {row}.chat_id, {row}.type, COALESCE(SUBSTR({row}.year, 1, 3), ''), COALESCE({row}.genre, ''),
+            {sign}, {sign} * (CASE WHEN {row}.watched <> 0 THEN 1 ELSE 0 END),
+            {sign} * COALESCE({row}.kp_rating, 0), {sign} * (CASE WHEN {row}.kp_rating IS NULL THEN 0 ELSE 1 END),
+            {sign} * COALESCE({row}.imdb_rating, 0), {sign} * (CASE WHEN {row}.imdb_rating IS NULL THEN 0 ELSE 1 END)
+        )
+        ON CONFLICT (chat_id, type, decade, genre) DO UPDATE SET
+            total = items_summary.total + excluded.total,
+            watched = items_summary.watched + excluded.watched,
+            kp_sum = items_summary.kp_sum + excluded.kp_sum,
+            kp_count = items_summary.kp_count + excluded.kp_count,
+            imdb_sum = items_summary.imdb_sum + excluded.imdb_sum,
+            imdb_count = items_summary.imdb_count + excluded.imdb_count;
+    '''
+
+def summary_cleanup_sql(row):
+    """SQL удаления опустевшей строки сводки - только по ключу строки row, по первичному ключу"""
+    return f'''
+        DELETE FROM items_summary
+        WHERE chat_id = {row}.chat_id AND type = {row}.type
+          AND decade = COALESCE(SUBSTR({row}.year, 1, 3), '') AND genre = COALESCE({row}.genre, '')
+          AND total <= 0;
+    '''
+
+SQLITE_SUMMARY_TRIGGERS = ('items_summary_insert', 'items_summary_delete', 'items_summary_update')
+
+def drop_summary_triggers(cur, is_sqlite):
+    if is_sqlite:
+        for name in SQLITE_SUMMARY_TRIGGERS:
+            cur.execute(f"DROP TRIGGER IF EXISTS {name}")
+    else:
+        cur.execute("DROP TRIGGER IF EXISTS items_summary_sync ON items")
+
+def create_summary_triggers(cur, is_sqlite):
+    """(Пере)создает триггеры, которые поддерживают items_summary"""
+    drop_summary_triggers(cur, is_sqlite)
+    if is_sqlite:
+        cur.execute(f'''
+            CREATE TRIGGER items_summary_insert AFTER INSERT ON items BEGIN
+                {summary_upsert_sql('new', 1)}
+            END
+        ''')
+        cur.execute(f'''
+            CREATE TRIGGER items_summary_delete AFTER DELETE ON items BEGIN
+                {summary_upsert_sql('old', -1)}
+                {summary_cleanup_sql('old')}
+            END
+        ''')
+        cur.execute(f'''
+            CREATE TRIGGER items_summary_update
+            AFTER UPDATE OF chat_id, type, year, genre, watched, kp_rating, imdb_rating ON items BEGIN
+                {summary_upsert_sql('old', -1)}
+                {summary_upsert_sql('new', 1)}
+                {summary_cleanup_sql('old')}
+            END
+        ''')
+    else:
+        cur.execute(f'''
+            CREATE OR REPLACE FUNCTION items_summary_sync() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                    {summary_upsert_sql('OLD', -1)}
+                END IF;
+                IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                    {summary_upsert_sql('NEW', 1)}
+                END IF;
+                -- Опустеть может только строка сводки, из которой запись ушла
+                IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                    {summary_cleanup_sql('OLD')}
+                END IF;
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql
+        ''')
+        cur.execute('''
+            CREATE TRIGGER items_summary_sync
+            AFTER INSERT OR DELETE OR UPDATE OF chat_id, type, year, genre, watched, kp_rating, imdb_rating ON items
+            FOR EACH ROW EXECUTE FUNCTION items_summary_sync()
+        ''')
+
+def summary_triggers_exist(cur, is_sqlite):
+    if is_sqlite:
+        cur.execute(
+            f"SELECT COUNT(*) FROM sqlite_master WHERE type = 'trigger' AND name IN ({', '.join('?' * len(SQLITE_SUMMARY_TRIGGERS))})",
+            SQLITE_SUMMARY_TRIGGERS,
+        )
+        return cur.fetchone()[0] == len(SQLITE_SUMMARY_TRIGGERS)
+    cur.execute("SELECT COUNT(*) FROM pg_trigger WHERE tgname = 'items_summary_sync' AND tgrelid = 'items'::regclass")
+    return cur.fetchone()[0] > 0
+
+def rebuild_stats_summary(cur):
+    """Пересчитывает сводку целиком по таблице items"""
+    cur.execute("DELETE FROM items_summary")
+    cur.execute(f"INSERT INTO items_summary ({SUMMARY_COLUMNS}) {STATS_GROUP_SQL}")
+
+def init_stats_summary(cur, is_sqlite):
+    """Сверяет триггеры сводки с STATS_SUMMARY.
+
+    Триггеры создает миграция; при старте меняем их, только если сводку включили
+    или выключили, и пересобираем ее только после включения.
+    """
+    enabled = summary_triggers_exist(cur, is_sqlite)
+    if STATS_SUMMARY and not enabled:
+        create_summary_triggers(cur, is_sqlite)
+        rebuild_stats_summary(cur)
+        logger.info("✅ Сводная таблица статистики items_summary пересобрана")
+    elif not STATS_SUMMARY and enabled:
+        drop_summary_triggers(cur, is_sqlite)
+        logger.info("ℹ️ Сводная таблица статистики отключена (STATS_SUMMARY=0)")
+
+def rollup_stats(rows):
+    """Сворачивает сгруппированные строки (тип, десятилетие, жанры) в статистику"""
+    stats = {
+        'types': {},
+        'genres': {},
+        'decades': {},
+        'total': 0,
+        'watched': 0,
+    }
+    kp_sum = kp_count = imdb_sum = imdb_count = 0
+    
+    for item_type, decade, genre, total, watched, kp_s, kp_c, imdb_s, imdb_c in rows:
+        if not total:
+            continue
+        type_stats = stats['types'].setdefault(item_type, {'total': 0, 'watched': 0})
+        type_stats['total'] += total
+        type_stats['watched'] += watched
+        stats['total'] += total
+        stats['watched'] += watched
+        kp_sum += kp_s
+        kp_count += kp_c
+        imdb_sum += imdb_s
+        imdb_count += imdb_c
+        
+        if decade and decade.isdigit():
+            stats['decades'][f"{decade}0"] = stats['decades'].get(f"{decade}0", 0) + total
+        
+        for name in genre.split(','):
+            name = name.strip().lower()
+            if name:
+                stats['genres'][name] = stats['genres'].get(name, 0) + total
+    
+    stats['kp_avg'] = round(kp_sum / kp_count, 1) if kp_count else None
+    stats['imdb_avg'] = round(imdb_sum / imdb_count, 1) if imdb_count else None
+    stats['watched_ratio'] = stats['watched'] / stats['total'] if stats['total'] else 0.0
+    return stats
+
+@traced('db.get_stats')
+def get_stats(chat_id):
+    """Считает статистику чата одним агрегирующим запросом (или по сводной таблице)"""
+    conn = get_connection()
+    if not conn:
+        logger.error("❌ Нет подключения к БД")
+        return rollup_stats([])
+    
+    cur = conn.cursor()
+    try:
+        ph = '?' if isinstance(conn, sqlite3.Connection) else '%s'
+        if STATS_SUMMARY:
+            cur.execute(f"SELECT {SUMMARY_VALUES} FROM items_summary WHERE chat_id = {ph}", (chat_id,))
+        else:
+            cur.execute(f"SELECT {STATS_VALUES_SQL} FROM items WHERE chat_id = {ph} GROUP BY 1, 2, 3", (chat_id,))
+        return rollup_stats(cur.fetchall())
+    except Exception as e:
+        logger.error(f"❌ Ошибка при подсчете статистики: {e}")
+        return rollup_stats([])
+    finally:
+        release_connection(conn)
+
+# ========== СОСТОЯНИЯ ДИАЛОГОВ ==========
+STATE_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS user_states (
+        chat_id BIGINT PRIMARY KEY,
+        state TEXT NOT NULL,
+        expires_at DOUBLE PRECISION NOT NULL
+    )
+'''
+
+local_states_ready = False
+
+def local_state_connection():
+    """Соединение с локальной базой для состояний; таблица создается при первом обращении"""
+    global local_states_ready
+    
+    conn = get_sqlite_connection()
+    if not local_states_ready:
+        conn.execute(STATE_TABLE_SQL)
+        conn.commit()
+        local_states_ready = True
+    return conn
+
+class StateStore(ABC):
+    """Хранилище состояний многошаговых диалогов (состояние - dict с ключом 'state')"""
+
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+
+    @abstractmethod
+    def get(self, chat_id):
+        """Состояние чата или None"""
+
+    @abstractmethod
+    def set(self, chat_id, state):
+        """Сохраняет состояние чата на ttl секунд"""
+
+    @abstractmethod
+    def delete(self, chat_id):
+        """Сбрасывает состояние чата"""
+
+    def update(self, chat_id, **changes):
+        state = self.get(chat_id) or {}
+        state.update(changes)
+        self.set(chat_id, state)
+        return state
+
+class MemoryStateStore(StateStore):
+    """Состояния в памяти процесса - только для одного воркера"""
+
+    def __init__(self, ttl=3600):
+        super().__init__(ttl)
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def get(self, chat_id):
+        with self._lock:
+            entry = self._states.get(chat_id)
+            if entry is None:
+                return None
+            if entry[1] <= time.time():
+                del self._states[chat_id]
+                return None
+            return dict(entry[0])
+
+    def set(self, chat_id, state):
+        with self._lock:
+            self._states[chat_id] = (dict(state), time.time() + self.ttl)
+            # Заодно выбрасываем брошенные диалоги
+            if len(self._states) % 100 == 0:
+                now = time.time()
+                for key in [key for key, entry in self._states.items() if entry[1] <= now]:
+                    del self._states[key]
+
+    def delete(self, chat_id):
+        with self._lock:
+            self._states.pop(chat_id, None)
+
+class DatabaseStateStore(StateStore):
+    """Состояния в таблице user_states общей БД - видны всем воркерам и инстансам"""
+
+    PURGE_EVERY = 100
+
+    def __init__(self, ttl=3600):
+        super().__init__(ttl)
+        self._writes = 0
+
+    def _acquire(self):
+        # Пока PostgreSQL недоступен, диалоги живут в локальной базе рядом с буфером записей,
+        # иначе до отложенного добавления нельзя было бы дойти. После восстановления
+        # начатый во время сбоя диалог придется начать заново
+        conn = None if degraded() else get_connection()
+        if conn is None and DATABASE_URL:
+            conn = local_state_connection()
+        return conn
+
+    def _release(self, conn):
+        release_connection(conn)
+
+    @traced('db.user_states')
+    def _execute(self, query, params, fetch=False):
+        conn = self._acquire()
+        if not conn:
+            logger.error("❌ Нет подключения к БД для состояний")
+            return None
+        
+        cur = conn.cursor()
+        try:
+            if isinstance(conn, sqlite3.Connection):
+                query = query.replace('%s', '?')
+            cur.execute(query, params)
+            result = cur.fetchone() if fetch else None
+            conn.commit()
+            return result
+        except Exception as e:
+            logger.error(f"❌ Ошибка хранилища состояний: {e}")
+            return None
+        finally:
+            self._release(conn)
+
+    def get(self, chat_id):
+        row = self._execute(
+            "SELECT state FROM user_states WHERE chat_id = %s AND expires_at > %s",
+            (chat_id, time.time()), fetch=True
+        )
+        return json.loads(row[0]) if row else None
+
+    def set(self, chat_id, state):
+        now = time.time()
+        self._execute('''
+            INSERT INTO user_states (chat_id, state, expires_at) VALUES (%s, %s, %s)
+            ON CONFLICT (chat_id) DO UPDATE SET state = excluded.state, expires_at = excluded.expires_at
+        ''', (chat_id, json.dumps(state, ensure_ascii=False), now + self.ttl))
+        
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            self._execute("DELETE FROM user_states WHERE expires_at <= %s", (now,))
+
+    def delete(self, chat_id):
+        self._execute("DELETE FROM user_states WHERE chat_id = %s", (chat_id,))
+
+class SqliteStateStore(DatabaseStateStore):
+    """Состояния в отдельном SQLite файле - общий для процессов на одной машине"""
+
+    def __init__(self, path, ttl=3600):
+        super().__init__(ttl)
+        self.path = path
+        self._ready = False
+
+    def _acquire(self):
+        conn = sqlite3.connect(self.path, timeout=5)
+        if not self._ready:
+            # Файл и таблица создаются при первом обращении, а не при импорте бота.
+            # WAL: воркеры читают состояния, не дожидаясь чужой записи
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute(STATE_TABLE_SQL)
+            conn.commit()
+            self._ready = True
+        return conn
+
+    def _release(self, conn):
+        conn.close()
+
+def create_state_store(spec, ttl):
+    """Создает хранилище состояний по настройке STATE_STORE"""
+    if spec == 'memory':
+        return MemoryStateStore(ttl)
+    if spec == 'database':
+        return DatabaseStateStore(ttl)
+    if spec.startswith('sqlite:///'):
+        return SqliteStateStore(spec[len('sqlite:///'):], ttl)
+    raise ValueError(f"Неизвестное хранилище состояний: {spec}")
@@ -0,0 +1,25 @@
+import os
+
+# ========== СЕРВЕР ==========
+bind = f"0.0.0.0:{os.getenv('PORT', '10000')}"
+# Один воркер по умолчанию: очередь обновлений держит порядок чата только внутри
+# процесса, а квота фонового обновления рейтингов считается на процесс (с N воркерами
+# она вырастет в N раз). Больше воркеров - только если порядок и квота не важны
+workers = int(os.getenv('WEB_CONCURRENCY', 1))
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', 16))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 60))
+graceful_timeout = int(os.getenv('GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+accesslog = '-'
+
+# ========== ХУКИ ==========
+def on_starting(server):
+    """Разовая подготовка (схема БД, вебхук) в мастер-процессе, а не в каждом воркере"""
+    import bot
+    bot.bootstrap()
+
+def worker_exit(server, worker):
+    """Дорабатываем принятые обновления перед остановкой воркера"""
+    import bot
+    bot.shutdown(timeout=graceful_timeout)
@@ -0,0 +1,130 @@
+"""Логирование КиноБота: неблокирующая очередь, JSON-формат и выборка частых событий.
+
+Поток, который пишет в лог, только кладет запись в очередь. Сборка сообщения,
+форматирование и вывод происходят в отдельном потоке-слушателе.
+"""
+import os
+import sys
+import json
+import queue
+import random
+import atexit
+import logging
+import logging.handlers
+
+# ========== КОНФИГУРАЦИЯ ==========
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')  # text или json
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+# Доля частых событий (отмеченных SAMPLED), которая попадает в лог
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', 0.1))
+
+# Передается как extra= в вызовы логгера для событий на каждый запрос
+SAMPLED = {'sampled': True}
+
+TEXT_FORMAT = '%(levelname)s:%(name)s:%(message)s'
+
+# Стандартные поля LogRecord; все остальное пришло через extra= и попадает в JSON
+RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'sampled'}
+
+# ========== ФОРМАТ И ФИЛЬТРЫ ==========
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-строка на запись - удобно для сборщиков логов"""
+
+    def format(self, record):
+        payload = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in RECORD_FIELDS:
+                payload[key] = value
+        if record.exc_info:
+            payload['exc'] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+class SamplingFilter(logging.Filter):
+    """Пропускает только долю rate записей, отмеченных SAMPLED"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        self.sampled_out = 0
+
+    def filter(self, record):
+        if getattr(record, 'sampled', False) and random.random() >= self.rate:
+            self.sampled_out += 1
+            return False
+        return True
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Кладет запись в очередь без ожидания; при переполнении запись теряется"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Слушатель в том же процессе: сообщение соберет он, а не вызывающий поток
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+# ========== НАСТРОЙКА ==========
+queue_handler = None
+sampling_filter = None
+listener = None
+output_handler = None
+
+def start_listener():
+    global listener
+    queue_handler.queue = queue.Queue(LOG_QUEUE_SIZE)
+    listener = logging.handlers.QueueListener(queue_handler.queue, output_handler, respect_handler_level=True)
+    listener.start()
+
+def setup_logging():
+    """Направляет все логи процесса через очередь (повторный вызов ничего не делает)"""
+    global queue_handler, sampling_filter, output_handler
+
+    if queue_handler is not None:
+        return
+
+    output_handler = logging.StreamHandler(sys.stderr)
+    output_handler.setFormatter(JsonFormatter() if LOG_FORMAT == 'json' else logging.Formatter(TEXT_FORMAT))
+
+    queue_handler = NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    sampling_filter = SamplingFilter(LOG_SAMPLE_RATE)
+    queue_handler.addFilter(sampling_filter)
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+
+    start_listener()
+    atexit.register(stop_logging)
+    # Поток слушателя не переживает fork (воркеры gunicorn) - запускаем его заново
+    os.register_at_fork(after_in_child=start_listener)
+
+def stop_logging():
+    """Дописывает накопленные записи и останавливает слушателя"""
+    global listener
+
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+def logging_stats():
+    if queue_handler is None:
+        return None
+    return {
+        'queue_depth': queue_handler.queue.qsize(),
+        'dropped': queue_handler.dropped,
+        'sampled_out': sampling_filter.sampled_out,
+    }
@@ -0,0 +1,183 @@
+"""Метрики КиноБота: гистограммы, замеры участков (spans) и трассировка обновлений.
+
+Только стандартная библиотека, чтобы модуль можно было подключить и в слое данных.
+"""
+import os
+import time
+import threading
+import functools
+import contextvars
+import logging
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# ========== КОНФИГУРАЦИЯ ==========
+# Обновления дольше этого порога логируются с разбивкой по участкам
+SLOW_UPDATE_SECONDS = float(os.getenv('SLOW_UPDATE_SECONDS', 2))
+
+SPAN_METRIC = 'kinobot_span_seconds'
+
+# ========== ГИСТОГРАММЫ ==========
+class Histogram:
+    """Гистограмма длительностей с фиксированными корзинами (секунды)"""
+
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        with self._lock:
+            cumulative = 0
+            buckets = {}
+            for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+                cumulative += count
+                buckets['+Inf' if bound == float('inf') else str(bound)] = cumulative
+            return {
+                'count': self.count,
+                'sum': round(self.sum, 4),
+                'avg': round(self.sum / self.count, 4) if self.count else 0.0,
+                'buckets': buckets,
+            }
+
+# Запросы к БД занимают миллисекунды, поэтому для участков корзины мельче
+SPAN_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+histograms = {}
+histograms_lock = threading.Lock()
+
+def histogram(name, buckets=Histogram.BUCKETS, **labels):
+    """Возвращает гистограмму из общего реестра, создавая ее при первом обращении"""
+    key = (name, tuple(sorted(labels.items())))
+    found = histograms.get(key)
+    if found is None:
+        with histograms_lock:
+            found = histograms.get(key)
+            if found is None:
+                found = histograms[key] = Histogram(buckets)
+    return found
+
+# ========== ТРАССИРОВКА ==========
+current_trace = contextvars.ContextVar('kinobot_trace', default=None)
+
+class Trace:
+    """Участки, пройденные при обработке одного обновления"""
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.perf_counter()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.spans.append((name, seconds))
+
+    def summary(self):
+        """Время по участкам: 'provider.kinopoisk 1.204 с, db.add_item 0.011 с'"""
+        totals = {}
+        with self._lock:
+            for name, seconds in self.spans:
+                count, total = totals.get(name, (0, 0.0))
+                totals[name] = (count + 1, total + seconds)
+        parts = []
+        for name, (count, total) in sorted(totals.items(), key=lambda item: -item[1][1]):
+            parts.append(f"{name} {total:.3f} с" + (f" (x{count})" if count > 1 else ""))
+        return ", ".join(parts)
+
+@contextmanager
+def span(name):
+    """Замеряет участок: пишет в гистограмму и в текущую трассировку"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        histogram(SPAN_METRIC, SPAN_BUCKETS, span=name).observe(elapsed)
+        trace = current_trace.get()
+        if trace is not None:
+            trace.add(name, elapsed)
+
+def traced(name):
+    """Декоратор: каждый вызов функции - отдельный участок"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+@contextmanager
+def trace(name):
+    """Трассировка обработки одного обновления; медленные логируются с разбивкой"""
+    current = Trace(name)
+    token = current_trace.set(current)
+    try:
+        yield current
+    finally:
+        current_trace.reset(token)
+        elapsed = time.perf_counter() - current.started
+        histogram(SPAN_METRIC, SPAN_BUCKETS, span=name).observe(elapsed)
+        if elapsed >= SLOW_UPDATE_SECONDS:
+            logger.warning(f"🐢 Медленный {name}: {elapsed:.3f} с - {current.summary()}")
+
+def submit(executor, func, *args, **kwargs):
+    """executor.submit, который переносит текущую трассировку в рабочий поток"""
+    return executor.submit(contextvars.copy_context().run, func, *args, **kwargs)
+
+# ========== ЭКСПОРТ ==========
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+def stat_gauges(prefix, stats, **labels):
+    """Числовые поля словаря метрик -> (имя, метки, значение); вложенное пропускается"""
+    gauges = []
+    for key, value in (stats or {}).items():
+        if isinstance(value, (int, float)):
+            gauges.append((f"{prefix}_{key}", tuple(sorted(labels.items())), float(value)))
+    return gauges
+
+def render_prometheus(gauges=()):
+    """Все гистограммы реестра и переданные значения в текстовом формате Prometheus"""
+    lines = []
+
+    with histograms_lock:
+        registered = sorted(histograms.items())
+    declared = set()
+    for (name, labels), hist in registered:
+        if name not in declared:
+            lines.append(f"# TYPE {name} histogram")
+            declared.add(name)
+        snapshot = hist.snapshot()
+        for bound, count in snapshot['buckets'].items():
+            lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {count}")
+        lines.append(f"{name}_sum{format_labels(labels)} {snapshot['sum']}")
+        lines.append(f"{name}_count{format_labels(labels)} {snapshot['count']}")
+
+    # Строки одной метрики должны идти подряд
+    for name, labels, value in sorted(gauges, key=lambda gauge: gauge[0]):
+        if name not in declared:
+            lines.append(f"# TYPE {name} gauge")
+            declared.add(name)
+        lines.append(f"{name}{format_labels(labels)} {value:g}")
+
+    return "\n".join(lines) + "\n"
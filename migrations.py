@@ -0,0 +1,417 @@
+"""Миграции схемы КиноБота: версии в таблице schema_version, SQLite и PostgreSQL.
+
+Каждая миграция идемпотентна (IF NOT EXISTS, проверка колонок), поэтому ее можно
+безопасно применить к базе, созданной до появления миграций. Индексы в PostgreSQL
+строятся через CREATE INDEX CONCURRENTLY и не блокируют запись в таблицу.
+"""
+import os
+import time
+import sqlite3
+import logging
+
+import db
+from db import normalize_title, STATE_TABLE_SQL
+
+logger = logging.getLogger(__name__)
+
+# ========== КОНФИГУРАЦИЯ ==========
+# Сколько DDL ждет блокировку таблицы, прежде чем уступить живому трафику и повторить
+MIGRATION_LOCK_TIMEOUT = os.getenv('MIGRATION_LOCK_TIMEOUT', '5s')
+MIGRATION_LOCK_RETRIES = int(os.getenv('MIGRATION_LOCK_RETRIES', 5))
+
+# Сколько строк заполняется за одну транзакцию при переносе данных
+BACKFILL_BATCH_SIZE = int(os.getenv('MIGRATION_BACKFILL_BATCH_SIZE', 1000))
+
+# Ключ advisory lock: миграции применяет только один процесс за раз
+MIGRATION_LOCK_KEY = 7_402_318
+
+SCHEMA_VERSION_SQL = '''
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        name VARCHAR(100) NOT NULL,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+'''
+
+# ========== РЕЕСТР ==========
+MIGRATIONS = []
+
+def migration(version, name, transactional=True, optional=False):
+    """Регистрирует миграцию.
+
+    transactional=False - миграция выполняется без транзакции (нужно для
+    CREATE INDEX CONCURRENTLY). optional=True - ошибка не останавливает
+    остальные миграции, а сама миграция повторится при следующем старте.
+    """
+    def decorator(apply):
+        MIGRATIONS.append({
+            'version': version,
+            'name': name,
+            'apply': apply,
+            'transactional': transactional,
+            'optional': optional,
+        })
+        return apply
+    return decorator
+
+# ========== ПОМОЩНИКИ ==========
+def add_column(cur, is_sqlite, table, column, definition):
+    """ALTER TABLE ADD COLUMN, если колонки еще нет"""
+    if is_sqlite:
+        cur.execute(f"PRAGMA table_info({table})")
+        if column not in [row[1] for row in cur.fetchall()]:
+            cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    else:
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {definition}")
+
+def create_index(cur, is_sqlite, name, definition, unique=False):
+    """Создает индекс; в PostgreSQL - без блокировки записи (CONCURRENTLY)"""
+    kind = "UNIQUE INDEX" if unique else "INDEX"
+    if is_sqlite:
+        cur.execute(f"CREATE {kind} IF NOT EXISTS {name} ON {definition}")
+        return
+
+    # Прерванная CONCURRENTLY-сборка оставляет невалидный индекс - IF NOT EXISTS его пропустит
+    cur.execute('''
+        SELECT i.indisvalid FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid
+        WHERE c.relname = %s
+    ''', (name,))
+    row = cur.fetchone()
+    if row and not row[0]:
+        logger.warning(f"⚠️ Индекс {name} невалиден после прерванной сборки, пересоздаем")
+        cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+    cur.execute(f"CREATE {kind} CONCURRENTLY IF NOT EXISTS {name} ON {definition}")
+
+def drop_index(cur, is_sqlite, name):
+    if is_sqlite:
+        cur.execute(f"DROP INDEX IF EXISTS {name}")
+    else:
+        cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+
+# ========== МИГРАЦИИ ==========
+@migration(1, 'items')
+def create_items(cur, is_sqlite):
+    id_column = "INTEGER PRIMARY KEY AUTOINCREMENT" if is_sqlite else "SERIAL PRIMARY KEY"
+    cur.execute(f'''
+        CREATE TABLE IF NOT EXISTS items (
+            id {id_column},
+            type VARCHAR(20) NOT NULL,
+            title VARCHAR(255) NOT NULL,
+            original_title VARCHAR(255),
+            year VARCHAR(10),
+            genre VARCHAR(255),
+            kp_rating REAL,
+            imdb_rating REAL,
+            kp_url TEXT,
+            imdb_url TEXT,
+            watched INTEGER DEFAULT 0,
+            comment TEXT,
+            added_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+@migration(2, 'lookup_cache')
+def create_lookup_cache(cur, is_sqlite):
+    # Постоянный уровень кэша внешних провайдеров
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS lookup_cache (
+            provider VARCHAR(20) NOT NULL,
+            cache_key VARCHAR(255) NOT NULL,
+            payload TEXT,
+            expires_at DOUBLE PRECISION NOT NULL,
+            PRIMARY KEY (provider, cache_key)
+        )
+    ''')
+
+@migration(3, 'user_states')
+def create_user_states(cur, is_sqlite):
+    cur.execute(STATE_TABLE_SQL)
+
+@migration(4, 'items.chat_id')
+def add_chat_id(cur, is_sqlite):
+    # Константный DEFAULT: в PostgreSQL 11+ это изменение только метаданных, без перезаписи таблицы
+    add_column(cur, is_sqlite, 'items', 'chat_id', 'BIGINT NOT NULL DEFAULT 0')
+
+@migration(5, 'items.normalized_title')
+def add_normalized_title(cur, is_sqlite):
+    add_column(cur, is_sqlite, 'items', 'normalized_title', 'VARCHAR(255)')
+    # ALTER берет ACCESS EXCLUSIVE на items: фиксируем его сразу, а не держим до конца заполнения
+    cur.connection.commit()
+
+    # Заполняем для старых записей; повторы оставляем с NULL, чтобы уникальный индекс построился.
+    # Ключи считаем в Python, пишем пачками с коммитом: прерванное заполнение продолжится со следующего старта
+    cur.execute("SELECT chat_id, type, normalized_title FROM items WHERE normalized_title IS NOT NULL")
+    taken = set(cur.fetchall())
+    cur.execute("SELECT id, chat_id, type, title FROM items WHERE normalized_title IS NULL ORDER BY id")
+    updates = []
+    for item_id, chat_id, item_type, title in cur.fetchall():
+        key = (chat_id, item_type, normalize_title(title))
+        if key not in taken:
+            taken.add(key)
+            updates.append((key[2], item_id))
+
+    ph = '?' if is_sqlite else '%s'
+    for start in range(0, len(updates), BACKFILL_BATCH_SIZE):
+        cur.executemany(f"UPDATE items SET normalized_title = {ph} WHERE id = {ph}", updates[start:start + BACKFILL_BATCH_SIZE])
+        cur.connection.commit()
+    if updates:
+        logger.info(f"✅ normalized_title заполнен для {len(updates)} записей")
+
+@migration(6, 'idx_items_chat_type_normalized', transactional=False)
+def index_normalized_title(cur, is_sqlite):
+    # Одно и то же название может быть в списках разных чатов
+    create_index(cur, is_sqlite, 'idx_items_chat_type_normalized', 'items (chat_id, type, normalized_title)', unique=True)
+    drop_index(cur, is_sqlite, 'idx_items_type_normalized')
+
+@migration(7, 'idx_items_chat_type_title_id', transactional=False)
+def index_list_pages(cur, is_sqlite):
+    # Постраничный просмотр списка чата по курсору (title, id)
+    create_index(cur, is_sqlite, 'idx_items_chat_type_title_id', 'items (chat_id, type, title, id)')
+    drop_index(cur, is_sqlite, 'idx_items_type_title_id')
+
+@migration(8, 'idx_items_chat_watched', transactional=False)
+def index_watched(cur, is_sqlite):
+    create_index(cur, is_sqlite, 'idx_items_chat_watched', 'items (chat_id, watched)')
+
+@migration(9, 'items.metadata_updated_at')
+def add_metadata_updated_at(cur, is_sqlite):
+    add_column(cur, is_sqlite, 'items', 'metadata_updated_at', 'TIMESTAMP')
+
+@migration(10, 'idx_items_metadata_age', transactional=False)
+def index_metadata_age(cur, is_sqlite):
+    create_index(cur, is_sqlite, 'idx_items_metadata_age', f"items (({db.METADATA_AGE_SQL}), id)")
+
+@migration(11, 'items_summary')
+def create_items_summary(cur, is_sqlite):
+    # Триггеры и заполнение - в миграции 14, поэтому старую таблицу можно просто заменить
+    db.drop_summary_triggers(cur, is_sqlite)
+    cur.execute("DROP TABLE IF EXISTS items_summary")
+    cur.execute('''
+        CREATE TABLE items_summary (
+            chat_id BIGINT NOT NULL,
+            type VARCHAR(20) NOT NULL,
+            decade VARCHAR(3) NOT NULL,
+            genre VARCHAR(255) NOT NULL,
+            total INTEGER NOT NULL DEFAULT 0,
+            watched INTEGER NOT NULL DEFAULT 0,
+            kp_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+            kp_count INTEGER NOT NULL DEFAULT 0,
+            imdb_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+            imdb_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (chat_id, type, decade, genre)
+        )
+    ''')
+
+@migration(12, 'search_engine', optional=True)
+def create_search_engine(cur, is_sqlite):
+    if not is_sqlite:
+        cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        return
+
+    # Полнотекстовый индекс по триграммам, синхронизируется триггерами
+    cur.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS items_fts USING fts5(
+            title, original_title,
+            content='items', content_rowid='id', tokenize='trigram'
+        )
+    ''')
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS items_fts_insert AFTER INSERT ON items BEGIN
+            INSERT INTO items_fts (rowid, title, original_title) VALUES (new.id, new.title, new.original_title);
+        END
+    ''')
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS items_fts_delete AFTER DELETE ON items BEGIN
+            INSERT INTO items_fts (items_fts, rowid, title, original_title) VALUES ('delete', old.id, old.title, old.original_title);
+        END
+    ''')
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS items_fts_update AFTER UPDATE OF title, original_title ON items BEGIN
+            INSERT INTO items_fts (items_fts, rowid, title, original_title) VALUES ('delete', old.id, old.title, old.original_title);
+            INSERT INTO items_fts (rowid, title, original_title) VALUES (new.id, new.title, new.original_title);
+        END
+    ''')
+    cur.execute("INSERT INTO items_fts (items_fts) VALUES ('rebuild')")
+
+@migration(13, 'idx_items_trgm', transactional=False, optional=True)
+def index_trigrams(cur, is_sqlite):
+    if is_sqlite:
+        return
+    create_index(cur, is_sqlite, 'idx_items_title_trgm', 'items USING gin (LOWER(title) gin_trgm_ops)')
+    create_index(cur, is_sqlite, 'idx_items_original_title_trgm', 'items USING gin (LOWER(original_title) gin_trgm_ops)')
+
+@migration(14, 'items_summary triggers')
+def add_summary_triggers(cur, is_sqlite):
+    # Один раз заполняем сводку, дальше ее ведут триггеры. При STATS_SUMMARY=0
+    # триггеры создаст init_db, когда сводку включат
+    if not db.STATS_SUMMARY:
+        return
+    db.create_summary_triggers(cur, is_sqlite)
+    db.rebuild_stats_summary(cur)
+
+@migration(15, 'chat_versions')
+def create_chat_versions(cur, is_sqlite):
+    # Версии списков чатов, общие для всех воркеров: по ним сбрасываются кэши отрисовки
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS chat_versions (
+            chat_id BIGINT PRIMARY KEY,
+            version BIGINT NOT NULL DEFAULT 0
+        )
+    ''')
+
+@migration(16, 'items.refresh_claimed_at')
+def add_refresh_claimed_at(cur, is_sqlite):
+    # Аренда записи фоновым обновлением: metadata_updated_at ставится только после проверки
+    add_column(cur, is_sqlite, 'items', 'refresh_claimed_at', 'TIMESTAMP')
+
+@migration(17, 'items_fts chat_key')
+def scope_fts_by_chat(cur, is_sqlite):
+    # Индекс без чата возвращает совпадения из всех списков, и фильтр по chat_id
+    # отбрасывает их уже после чтения. Ключ чата в отдельной колонке сужает сам MATCH.
+    # Ключ обрамлен буквами: триграммы не находят короткие id и совпадения внутри чужих id
+    if not is_sqlite:
+        return
+    cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'items_fts'")
+    if not cur.fetchone():
+        # FTS5 недоступен (миграция 12 не применилась) - поиск работает через LIKE
+        return
+
+    for trigger in ('items_fts_insert', 'items_fts_delete', 'items_fts_update'):
+        cur.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    cur.execute("DROP TABLE items_fts")
+    cur.execute(f'''
+        CREATE VIEW IF NOT EXISTS items_fts_source AS
+        SELECT id, title, original_title, {db.FTS_CHAT_KEY_SQL.format(table='items')} AS chat_key FROM items
+    ''')
+    cur.execute('''
+        CREATE VIRTUAL TABLE items_fts USING fts5(
+            title, original_title, chat_key,
+            content='items_fts_source', content_rowid='id', tokenize='trigram'
+        )
+    ''')
+    new_key = db.FTS_CHAT_KEY_SQL.format(table='new')
+    old_key = db.FTS_CHAT_KEY_SQL.format(table='old')
+    cur.execute(f'''
+        CREATE TRIGGER items_fts_insert AFTER INSERT ON items BEGIN
+            INSERT INTO items_fts (rowid, title, original_title, chat_key) VALUES (new.id, new.title, new.original_title, {new_key});
+        END
+    ''')
+    cur.execute(f'''
+        CREATE TRIGGER items_fts_delete AFTER DELETE ON items BEGIN
+            INSERT INTO items_fts (items_fts, rowid, title, original_title, chat_key) VALUES ('delete', old.id, old.title, old.original_title, {old_key});
+        END
+    ''')
+    cur.execute(f'''
+        CREATE TRIGGER items_fts_update AFTER UPDATE OF title, original_title, chat_id ON items BEGIN
+            INSERT INTO items_fts (items_fts, rowid, title, original_title, chat_key) VALUES ('delete', old.id, old.title, old.original_title, {old_key});
+            INSERT INTO items_fts (rowid, title, original_title, chat_key) VALUES (new.id, new.title, new.original_title, {new_key});
+        END
+    ''')
+    cur.execute("INSERT INTO items_fts (items_fts) VALUES ('rebuild')")
+
+# ========== ПРИМЕНЕНИЕ ==========
+def applied_versions(cur):
+    cur.execute("SELECT version FROM schema_version")
+    return {row[0] for row in cur.fetchall()}
+
+def record_version(cur, is_sqlite, item):
+    ph = '?' if is_sqlite else '%s'
+    cur.execute(f"INSERT INTO schema_version (version, name) VALUES ({ph}, {ph})", (item['version'], item['name']))
+
+def is_lock_timeout(error):
+    # 55P03 lock_not_available: не дождались блокировки за MIGRATION_LOCK_TIMEOUT
+    return getattr(error, 'pgcode', None) == '55P03'
+
+def apply_migration(conn, is_sqlite, item):
+    """Применяет одну миграцию и записывает ее версию"""
+    cur = conn.cursor()
+    if is_sqlite or item['transactional']:
+        item['apply'](cur, is_sqlite)
+        record_version(cur, is_sqlite, item)
+        conn.commit()
+        return
+
+    # CONCURRENTLY нельзя выполнять в транзакции
+    conn.autocommit = True
+    try:
+        item['apply'](cur, is_sqlite)
+    finally:
+        conn.autocommit = False
+    record_version(cur, is_sqlite, item)
+    conn.commit()
+
+def run_migrations():
+    """Доводит схему до последней версии. Возвращает False, если обязательная миграция не прошла"""
+    conn = db.get_connection()
+    if not conn:
+        logger.error("❌ Не удалось подключиться к БД для миграций")
+        return False
+
+    is_sqlite = isinstance(conn, sqlite3.Connection)
+    cur = conn.cursor()
+    broken = False
+    try:
+        if not is_sqlite:
+            cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_KEY,))
+            cur.execute(f"SET lock_timeout = '{MIGRATION_LOCK_TIMEOUT}'")
+        cur.execute(SCHEMA_VERSION_SQL)
+        conn.commit()
+
+        done = applied_versions(cur)
+        # Закрываем транзакцию чтения: для CONCURRENTLY соединение переводится в autocommit
+        conn.commit()
+        pending = [item for item in sorted(MIGRATIONS, key=lambda item: item['version']) if item['version'] not in done]
+        if not pending:
+            logger.info(f"✅ Схема БД актуальна (версия {max(done, default=0)})")
+            return True
+
+        for item in pending:
+            for attempt in range(MIGRATION_LOCK_RETRIES + 1):
+                started = time.monotonic()
+                try:
+                    apply_migration(conn, is_sqlite, item)
+                    logger.info(f"✅ Миграция {item['version']} ({item['name']}) применена за {time.monotonic() - started:.2f} с")
+                    break
+                except Exception as e:
+                    conn.rollback()
+                    if is_lock_timeout(e) and attempt < MIGRATION_LOCK_RETRIES:
+                        logger.warning(f"⏳ Миграция {item['version']} ждет блокировку, повтор {attempt + 1}")
+                        time.sleep(1 + attempt)
+                        continue
+                    if item['optional']:
+                        logger.warning(f"⚠️ Необязательная миграция {item['version']} ({item['name']}) не применена: {e}")
+                        break
+                    logger.error(f"❌ Миграция {item['version']} ({item['name']}) не применена: {e}")
+                    return False
+        return True
+    except Exception as e:
+        logger.error(f"❌ Ошибка миграций: {e}")
+        broken = not is_sqlite
+        return False
+    finally:
+        if not is_sqlite and not broken:
+            try:
+                conn.rollback()
+                cur.execute("RESET lock_timeout")
+                cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_KEY,))
+                conn.commit()
+            except Exception:
+                broken = True
+        # Соединение с оборванной сессией не возвращаем в пул: вместе с ним уйдет и advisory lock
+        db.release_connection(conn, broken=broken)
+
+def current_version():
+    """Последняя примененная версия схемы (0, если миграций еще не было)"""
+    conn = db.get_connection()
+    if not conn:
+        return 0
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT MAX(version) FROM schema_version")
+        row = cur.fetchone()
+        return row[0] or 0
+    except Exception:
+        conn.rollback()
+        return 0
+    finally:
+        db.release_connection(conn)
@@ -0,0 +1,46 @@
+"""Общие настройки тестов: локальная база SQLite во временном каталоге, без PostgreSQL"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+# Настройки читаются при импорте модулей, поэтому задаем их до импорта db и bot
+os.environ.pop('DATABASE_URL', None)
+os.environ.setdefault('TELEGRAM_TOKEN', '123456:test')
+os.environ['SQLITE_PATH'] = os.path.join(tempfile.mkdtemp(prefix='kinobot-tests-'), 'kinobot.db')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+
+
+@pytest.fixture
+def database():
+    """Схема после миграций и пустые списки"""
+    db.init_db()
+    conn = db.get_connection()
+    conn.execute("DELETE FROM items")
+    conn.execute("DELETE FROM chat_versions")
+    conn.commit()
+    db.release_connection(conn)
+    # Версии, прочитанные прошлым тестом, относятся к удаленным данным
+    db.checked_versions.clear()
+    return db
+
+
+@pytest.fixture
+def chat_id():
+    return 42
+
+
+@pytest.fixture
+def movies(database, chat_id):
+    """25 фильмов чата, добавленных не по алфавиту, и один фильм другого чата.
+
+    Возвращает id в порядке списка: по названию, затем по id.
+    """
+    titles = [f"Фильм {index:02d}" for index in reversed(range(25))]
+    assert database.add_items_bulk(chat_id, [{'type': 'movie', 'title': title} for title in titles]) == 25
+    database.add_items_bulk(chat_id + 1, [{'type': 'movie', 'title': 'Чужой список'}])
+    return [database.find_item_id(chat_id, 'movie', f"Фильм {index:02d}") for index in range(25)]
@@ -0,0 +1,85 @@
+import time
+
+from db import CircuitBreaker
+
+
+def trip(breaker):
+    for _ in range(breaker.threshold):
+        assert breaker.allow()
+        breaker.failed(OSError('connection refused'))
+
+
+def test_opens_after_threshold_failures():
+    breaker = CircuitBreaker(threshold=3, reset_timeout=60)
+    breaker.failed(OSError('refused'))
+    breaker.failed(OSError('refused'))
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+
+    breaker.failed(OSError('refused'))
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+    stats = breaker.stats()
+    assert stats['trips'] == 1
+    assert stats['rejected'] == 1
+    assert stats['last_error'] == 'refused'
+
+
+def test_success_resets_failure_count():
+    breaker = CircuitBreaker(threshold=2, reset_timeout=60)
+    breaker.failed(OSError('refused'))
+    breaker.succeeded()
+    breaker.failed(OSError('refused'))
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_half_open_lets_one_probe_through():
+    breaker = CircuitBreaker(threshold=1, reset_timeout=0.05)
+    trip(breaker)
+    assert not breaker.allow()
+
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    # Пока идет проба, остальные получают отказ сразу
+    assert not breaker.allow()
+
+
+def test_failed_probe_reopens():
+    breaker = CircuitBreaker(threshold=3, reset_timeout=0.05)
+    trip(breaker)
+    time.sleep(0.06)
+    assert breaker.allow()
+
+    breaker.failed(OSError('still down'))
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.stats()['trips'] == 2
+    assert not breaker.allow()
+
+
+def test_successful_probe_recovers_and_notifies():
+    recovered = []
+    breaker = CircuitBreaker(threshold=1, reset_timeout=0.05, on_recover=lambda: recovered.append(True))
+    trip(breaker)
+    time.sleep(0.06)
+    assert breaker.allow()
+
+    breaker.succeeded()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert recovered == [True]
+    assert breaker.allow() and breaker.allow()
+
+    # Успех в закрытом состоянии восстановлением не считается
+    breaker.succeeded()
+    assert recovered == [True]
+
+
+def test_abandoned_probe_can_be_retried():
+    breaker = CircuitBreaker(threshold=1, reset_timeout=0.05)
+    trip(breaker)
+    time.sleep(0.06)
+    assert breaker.allow()
+
+    breaker.abandon()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow()
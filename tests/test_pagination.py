@@ -0,0 +1,44 @@
+import db
+
+
+def page_ids(rows):
+    return [row.id for row in rows]
+
+
+def test_first_page(chat_id, movies):
+    rows, has_prev, has_next = db.get_items_page(chat_id, 'movie', limit=10)
+    assert page_ids(rows) == movies[:10]
+    assert (has_prev, has_next) == (False, True)
+
+
+def test_walks_forward_and_back(chat_id, movies):
+    expected = movies
+    first, _, _ = db.get_items_page(chat_id, 'movie', limit=10)
+    second, has_prev, has_next = db.get_items_page(chat_id, 'movie', first[-1].id, 'next', limit=10)
+    assert page_ids(second) == expected[10:20]
+    assert (has_prev, has_next) == (True, True)
+
+    last, has_prev, has_next = db.get_items_page(chat_id, 'movie', second[-1].id, 'next', limit=10)
+    assert page_ids(last) == expected[20:]
+    assert (has_prev, has_next) == (True, False)
+
+    back, has_prev, has_next = db.get_items_page(chat_id, 'movie', last[0].id, 'prev', limit=10)
+    assert page_ids(back) == expected[10:20]
+    assert (has_prev, has_next) == (True, True)
+
+    start, has_prev, _ = db.get_items_page(chat_id, 'movie', back[0].id, 'prev', limit=10)
+    assert page_ids(start) == expected[:10]
+    assert has_prev is False
+
+
+def test_deleted_cursor_restarts_from_first_page(chat_id, movies):
+    assert db.delete_item(chat_id, movies[-1])
+    rows, has_prev, _ = db.get_items_page(chat_id, 'movie', movies[-1], 'next', limit=10)
+    assert page_ids(rows) == movies[:10]
+    assert has_prev is False
+
+
+def test_cursor_from_another_chat_is_ignored(chat_id, movies):
+    foreign = db.find_item_id(chat_id + 1, 'movie', 'Чужой список')
+    rows, _, _ = db.get_items_page(chat_id, 'movie', foreign, 'next', limit=10)
+    assert page_ids(rows) == movies[:10]
@@ -0,0 +1,119 @@
+import threading
+import time
+
+import pytest
+
+from db import ConnectionPool, PoolTimeout
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = 0
+        self.pings = 0
+
+    def cursor(self):
+        return self
+
+    def execute(self, query):
+        if self.closed:
+            raise RuntimeError('connection closed')
+        self.pings += 1
+
+    def close(self):
+        self.closed = 1
+
+    def rollback(self):
+        pass
+
+    def get_transaction_status(self):
+        return 0
+
+
+def make_pool(**kwargs):
+    opened = []
+
+    def connect():
+        conn = FakeConnection()
+        opened.append(conn)
+        return conn
+
+    kwargs.setdefault('check_idle', 60.0)
+    return ConnectionPool(connect, **kwargs), opened
+
+
+def test_prewarms_minconn_and_reuses_idle():
+    pool, opened = make_pool(minconn=2, maxconn=4)
+    assert len(opened) == 2
+
+    conn = pool.getconn()
+    pool.putconn(conn)
+    assert pool.getconn() is conn
+    assert pool.stats()['created'] == 2
+
+
+def test_grows_up_to_maxconn_then_times_out():
+    pool, _ = make_pool(minconn=0, maxconn=2, timeout=0.05)
+    first, second = pool.getconn(), pool.getconn()
+    assert first is not second
+
+    with pytest.raises(PoolTimeout):
+        pool.getconn()
+    stats = pool.stats()
+    assert stats['in_use'] == 2
+    assert stats['timeouts'] == 1
+
+
+def test_waiting_caller_gets_released_connection():
+    pool, _ = make_pool(minconn=1, maxconn=1, timeout=2.0)
+    held = pool.getconn()
+    threading.Timer(0.05, pool.putconn, args=(held,)).start()
+
+    assert pool.getconn() is held
+    assert pool.stats()['wait_time_max'] > 0
+
+
+def test_broken_connection_frees_its_slot():
+    pool, opened = make_pool(minconn=0, maxconn=1, timeout=0.05)
+    conn = pool.getconn()
+    pool.putconn(conn, broken=True)
+
+    assert conn.closed
+    replacement = pool.getconn()
+    assert replacement is not conn
+    assert len(opened) == 2
+    assert pool.stats()['recycled'] == 1
+
+
+def test_dead_idle_connection_is_replaced():
+    pool, opened = make_pool(minconn=1, maxconn=1, check_idle=0.0)
+    opened[0].close()
+
+    conn = pool.getconn()
+    assert conn is opened[1]
+    assert pool.stats()['recycled'] == 1
+
+
+def test_idle_connection_is_pinged_only_after_check_idle():
+    pool, opened = make_pool(minconn=1, maxconn=1, check_idle=0.05)
+    pool.putconn(pool.getconn())
+    assert opened[0].pings == 0
+
+    time.sleep(0.06)
+    pool.putconn(pool.getconn())
+    assert opened[0].pings == 1
+
+
+def test_failed_connect_does_not_leak_a_slot():
+    attempts = []
+
+    def connect():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise OSError('connection refused')
+        return FakeConnection()
+
+    pool = ConnectionPool(connect, minconn=0, maxconn=1, timeout=0.05)
+    with pytest.raises(OSError):
+        pool.getconn()
+    assert pool.getconn() is not None
+    assert pool.stats()['size'] == 1
@@ -0,0 +1,18 @@
+def test_search_stays_in_chat(database, chat_id):
+    database.add_items_bulk(chat_id, [{'type': 'movie', 'title': 'Матрица', 'original_title': 'The Matrix'}])
+    database.add_items_bulk(chat_id + 1, [{'type': 'movie', 'title': 'Матрица: Перезагрузка'}])
+    database.add_items_bulk(chat_id * 10 + 2, [{'type': 'movie', 'title': 'Матрица: Революция'}])
+
+    rows = database.search_items(chat_id, 'матр')
+    assert [row.title for row in rows] == ['Матрица']
+    assert [row.title for row in database.search_items(chat_id, 'matrix')] == ['Матрица']
+    assert [row.title for row in database.search_items(chat_id + 1, 'матр')] == ['Матрица: Перезагрузка']
+    assert database.search_items(-chat_id, 'матр') == []
+
+
+def test_fts_follows_renames(database, chat_id):
+    database.add_items_bulk(chat_id, [{'type': 'movie', 'title': 'Чужой'}])
+    item_id = database.find_item_id(chat_id, 'movie', 'Чужой')
+    assert database.update_item(chat_id, item_id, title='Чужие')
+    assert [row.id for row in database.search_items(chat_id, 'чужие')] == [item_id]
+    assert database.search_items(chat_id, 'чужой') == []
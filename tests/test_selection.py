@@ -0,0 +1,70 @@
+import pytest
+
+import bot
+import db
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    """Ответы бота, записанные вместо запросов к Telegram"""
+    sent = []
+    monkeypatch.setattr(bot.bot, 'edit_message_reply_markup', lambda **kwargs: sent.append(('markup', kwargs['reply_markup'])))
+    monkeypatch.setattr(bot.bot, 'answer_callback_query', lambda call_id, text=None, **kwargs: sent.append(('answer', text)))
+    return sent
+
+
+class Call:
+    def __init__(self, chat_id, data):
+        self.id = 'call'
+        self.data = data
+        self.message = type('Message', (), {'message_id': 1, 'chat': type('Chat', (), {'id': chat_id})})()
+
+
+def button_data(markup):
+    return [button.callback_data for row in markup.keyboard for button in row]
+
+
+def test_checksum_depends_on_page_ids(chat_id, movies):
+    rows, _, _ = db.get_items_page(chat_id, 'movie', limit=10)
+    assert bot.page_checksum(rows) == bot.page_checksum(list(rows))
+    assert bot.page_checksum(rows) != bot.page_checksum(rows[1:])
+    assert len(bot.page_checksum(rows)) == 8
+
+
+def test_callback_data_fits_telegram_limit():
+    data = bot.select_data('D', 'series', 'p', 2 ** 40, 2 ** db.PAGE_SIZE - 1, 'ffffffff')
+    assert len(data.encode()) <= 64
+    assert data.split('_')[1:] == ['D', 'series', 'p', str(2 ** 40), format(2 ** db.PAGE_SIZE - 1, 'x'), 'ffffffff']
+
+
+def test_item_buttons_toggle_their_bit(chat_id, movies):
+    rows, _, _ = db.get_items_page(chat_id, 'movie')
+    markup = bot.select_keyboard(rows, 'movie', 'n', None, 0b101)
+    masks = [int(data.split('_')[5], 16) for data in button_data(markup)[:len(rows)]]
+    assert masks[0] == 0b100
+    assert masks[1] == 0b111
+    assert masks[2] == 0b001
+    assert masks[3] == 0b1101
+
+
+def test_selection_applies_to_marked_items(sent, chat_id, movies):
+    rows, _, _ = db.get_items_page(chat_id, 'movie')
+    checksum = bot.page_checksum(rows)
+    bot.handle_selection(Call(chat_id, bot.select_data('w', 'movie', 'n', None, 0b11, checksum)))
+
+    assert sent[-1] == ('answer', '✅ Отмечено: 2')
+    watched = [row.id for row in db.get_items_page(chat_id, 'movie')[0] if row.watched]
+    assert watched == movies[:2]
+
+
+def test_stale_checksum_resets_selection(sent, chat_id, movies):
+    rows, _, _ = db.get_items_page(chat_id, 'movie')
+    checksum = bot.page_checksum(rows)
+    # Пока пользователь выбирал, первую запись удалили - позиции в маске указывают на другие записи
+    db.delete_item(chat_id, movies[0])
+    bot.handle_selection(Call(chat_id, bot.select_data('D', 'movie', 'n', None, 0b1, checksum)))
+
+    assert sent[-1] == ('answer', '🔄 Список изменился, выбор сброшен')
+    assert db.get_items_page(chat_id, 'movie')[0][0].id == movies[1]
+    markup = sent[-2][1]
+    assert all(int(data.split('_')[5], 16) == 0 for data in button_data(markup) if data.startswith('sel_x'))
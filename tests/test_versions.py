@@ -0,0 +1,21 @@
+def test_own_writes_change_version_without_rereading(database, chat_id, monkeypatch):
+    first = database.data_version(chat_id, max_age=60)
+    reads = []
+    monkeypatch.setattr(database, 'read_version', lambda chat: reads.append(chat) or 0)
+
+    assert database.data_version(chat_id, max_age=60) == first
+    database.add_items_bulk(chat_id, [{'type': 'movie', 'title': 'Солярис'}])
+    assert database.data_version(chat_id, max_age=60) != first
+    assert reads == []
+
+
+def test_other_workers_writes_seen_after_max_age(database, chat_id):
+    before = database.data_version(chat_id, max_age=60)
+    conn = database.get_connection()
+    # Запись другого воркера: только таблица, без счетчиков этого процесса
+    database.bump_version(conn.cursor(), True, chat_id)
+    conn.commit()
+    database.release_connection(conn)
+
+    assert database.data_version(chat_id, max_age=60) == before
+    assert database.data_version(chat_id, max_age=0) != before
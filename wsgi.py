@@ -0,0 +1,4 @@
+"""Точка входа для production WSGI-сервера: gunicorn -c gunicorn.conf.py wsgi:app"""
+from bot import create_app
+
+app = create_app()